@@ -0,0 +1,102 @@
+"""
+Asyncio interface to the storage backends
+
+AsyncStorageBase mirrors the parts of the storage interface the backup and
+restore drivers need, as coroutines, so many requests can be in flight at
+once from a single event loop.
+
+There is no non-blocking transport yet. The existing backends are
+synchronous, and ExecutorAdapter runs each of their calls in a worker
+thread, so every request in flight still occupies a thread. The pool size is
+the limit on concurrent requests. Further calls queue up behind the running
+ones instead of failing. A backend with its own non-blocking transport
+would implement AsyncStorageBase directly.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+
+class AsyncStorageBase:
+    """Base class defining the asyncio storage interface"""
+
+    async def upload_file(self, name, content):
+        """Uploads a file
+
+        :param content: A file-like object open for reading
+        :returns: The metadata dict from the storage backend
+        """
+        raise NotImplementedError()
+
+    async def download_buffer(self, name, byte_range=None):
+        """Downloads a file, or a byte range of it, into a bytes-like
+        object
+
+        See StorageBase.download_buffer()
+        """
+        raise NotImplementedError()
+
+    async def delete(self, name):
+        raise NotImplementedError()
+
+    async def list_files(self, prefix, start_name=None, max_count=1000):
+        """Lists up to max_count files with the given prefix in name order,
+        starting at start_name
+
+        Returns a list of metadata dicts, as from
+        StorageBase.get_files_by_prefix(). An empty list means there are no
+        more files.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class ExecutorAdapter(AsyncStorageBase):
+    """Adapts a synchronous StorageBase to the asyncio interface by running
+    its calls in a thread pool
+
+    Each call blocks one of the adapter's worker threads for its duration. The wrapped storage must be
+    safe to use from several threads at once, which all the current
+    backends are once set_concurrency() is called.
+
+    :param storage: The storage backend to wrap
+    :type storage: backathon.storage.StorageBase
+    :param max_in_flight: The number of worker threads, and so the number of
+        requests that may be running at once
+    """
+    def __init__(self, storage, max_in_flight=64):
+        self.storage = storage
+        self.max_in_flight = max_in_flight
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_in_flight,
+        )
+        storage.set_concurrency(max_in_flight)
+
+    def _run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    async def upload_file(self, name, content):
+        return await self._run(self.storage.upload_file, name, content)
+
+    async def download_buffer(self, name, byte_range=None):
+        return await self._run(self.storage.download_buffer, name, byte_range)
+
+    async def delete(self, name):
+        return await self._run(self.storage.delete, name)
+
+    async def list_files(self, prefix, start_name=None, max_count=1000):
+        return await self._run(functools.partial(
+            self._list_files, prefix, start_name, max_count,
+        ))
+
+    def _list_files(self, prefix, start_name, max_count):
+        return list(itertools.islice(
+            self.storage.get_files_by_prefix(prefix, start_name=start_name),
+            max_count,
+        ))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
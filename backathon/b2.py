@@ -58,8 +58,11 @@ b2_get_download_authorization
 
 """
 import base64
+import collections
+import concurrent.futures
 import io
 import os
+import random
 import time
 import urllib.parse
 import hashlib
@@ -68,10 +71,12 @@ import tempfile
 import threading
 from logging import getLogger
 
+import requests.adapters
 import requests.exceptions
 from django.utils.functional import cached_property
 
 from .storage import StorageBase
+from . import util
 
 logger = getLogger("backathon.b2")
 
@@ -82,6 +87,8 @@ extra_headers = {
 # Timeout used in HTTP calls
 TIMEOUT = 5
 
+AUTH_URL = "https://api.backblazeb2.com/b2api/v1/b2_authorize_account"
+
 class B2ResponseError(IOError):
     def __init__(self, data):
         super().__init__(data['message'])
@@ -94,110 +101,307 @@ class B2ResponseError(IOError):
             self.data['message'],
         )
 
+def _retry_after(response):
+    """Returns the seconds to wait from a response's Retry-After header"""
+    try:
+        return int(response.headers.get('Retry-After', 1))
+    except ValueError:
+        return 1
+
+class _UploadRetry(Exception):
+    """An upload failed in a way that B2 says to handle by getting a new
+    upload URL and trying again
+
+    The error to raise if no more retries are left is in the error attribute
+    """
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+UploadUrl = collections.namedtuple("UploadUrl", ["url", "token", "created"])
+
+class _UploadUrlPool:
+    """A thread-safe pool of upload URLs and their authorization tokens
+
+    B2 requires each concurrent upload to use its own upload URL, but a URL
+    can be reused for any number of uploads one after another. Workers take
+    a URL from the pool for each upload and return it when the upload
+    succeeds, so URLs are only requested from B2 when the pool runs dry.
+
+    A URL that fails an upload is discarded instead of returned, as the B2
+    documentation instructs. URLs are also refreshed once they reach MAX_AGE,
+    well before B2 expires them after 24 hours.
+    """
+    MAX_AGE = 12 * 3600
+
+    def __init__(self, fetch, size):
+        """
+        :param fetch: A callable that returns a new (url, token) pair
+        :param size: The number of idle URLs to keep
+        """
+        self.fetch = fetch
+        self.size = size
+        self._free = collections.deque()
+        self._lock = threading.Lock()
+
+        # Counters for diagnostics
+        self.fetched = 0
+        self.discarded = 0
+
+    def get(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._free:
+                entry = self._free.pop()
+                if now - entry.created < self.MAX_AGE:
+                    return entry
+                self.discarded += 1
+        url, token = self.fetch()
+        with self._lock:
+            self.fetched += 1
+        return UploadUrl(url, token, now)
+
+    def put(self, entry):
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(entry)
+
+    def discard(self, entry):
+        with self._lock:
+            self.discarded += 1
+
 class B2Bucket(StorageBase):
     """Represents a B2 Bucket, a container for objects
 
-    This object should be thread safe, as it keeps a thread-local
-    requests.Session object for API calls, as well as thread-local
-    authorization tokens.
+    This object is thread safe. All threads share one authorization token,
+    one requests.Session whose connection pool is sized to the number of
+    concurrent workers, and a pool of upload URLs. Starting another worker
+    thread costs no additional B2 calls.
 
     """
+    # Files larger than this are uploaded in parts with the large file API.
+    # Parts are uploaded concurrently and retried individually, so a failure
+    # doesn't restart the whole upload. B2 requires parts of at least 5MB,
+    # except for the last, and at least 2 parts.
+    LARGE_FILE_THRESHOLD = 2**27
+    PART_SIZE = 2**26
+
+    # Number of parts of a large file to upload at once. This also bounds the
+    # number of parts held in memory.
+    part_concurrency = 4
+
+    # Number of times to try each upload before giving up
+    UPLOAD_TRIES = 5
+
+    # Number of times to get a new auth token and retry an API call that B2
+    # rejects because its token expired
+    API_AUTH_TRIES = 5
+
+    # Authorization tokens are valid for 24 hours. Cached authorizations are
+    # not reused after this many seconds, so a cached token is unlikely to
+    # expire partway through a run. If one does, it is refreshed
+    # transparently.
+    AUTH_CACHE_LIFETIME = 23 * 3600
+
     def __init__(self,
                  account_id,
                  application_key,
                  bucket_name,
+                 auth_url=None,
                  ):
         self.account_id = account_id
         self.application_key = application_key
         self.bucket_name = bucket_name
-
-        # Thread local variables hold the requests Session object, as well as
-        # various authorization tokens acquired from B2
-        self._local = threading.local()
+        # Only set for testing against something other than the real B2
+        self.auth_url = auth_url
+
+        # Number of threads expected to use this bucket at once. See
+        # set_concurrency()
+        self.concurrency = 1
+
+        # The account authorization shared by all threads. Set by
+        # _authorize_account()
+        self._auth = None
+        self._auth_lock = threading.Lock()
+
+        self._bucket_id = None
+        self._bucket_id_lock = threading.Lock()
+
+        # Callbacks set by the repository to persist the authorization and
+        # bucket ID between runs, which saves two class C transactions at
+        # the start of each run. auth_loader() returns the dict last passed
+        # to on_auth(), or None.
+        self.auth_loader = None
+        self.on_auth = None
+
+        self._upload_urls = _UploadUrlPool(self._get_upload_url,
+                                           self.concurrency)
+
+        # Shared by all threads to back off together when B2 is overloaded.
+        # See util.ConcurrencyLimiter.
+        self.limiter = util.ConcurrencyLimiter(
+            self.concurrency * self.part_concurrency
+        )
 
     def get_params(self):
-        return {
+        params = {
             'account_id': self.account_id,
             'application_key': self.application_key,
             'bucket_name': self.bucket_name,
         }
+        if self.auth_url is not None:
+            params['auth_url'] = self.auth_url
+        return params
+
+    def set_concurrency(self, concurrency):
+        self.concurrency = concurrency
+        self._upload_urls.size = concurrency
+        self.limiter.set_max(concurrency * self.part_concurrency)
+        if "session" in self.__dict__:
+            self._mount_adapter(self.session)
+
+    def _mount_adapter(self, session):
+        # Each worker may upload part_concurrency parts at once, each
+        # needing its own connection. Connections beyond the pool size
+        # still work, but aren't kept alive.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=self.concurrency * self.part_concurrency,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
 
-    @property
+    @cached_property
     def session(self):
-        # Initialize a new requests.Session for this thread if one doesn't
-        # exist
-        try:
-            return self._local.session
-        except AttributeError:
-            logger.debug("Initializing session for thread id {}".format(
-                threading.get_ident()
-            ))
-            session = requests.Session()
-            session.headers.update(extra_headers)
-            self._local.session = session
-            return session
+        # Shared by all threads. The connection pool underneath is thread
+        # safe, and keeps connections alive between calls.
+        session = requests.Session()
+        session.headers.update(extra_headers)
+        self._mount_adapter(session)
+        return session
 
     def _post_with_backoff_retry(self, *args, **kwargs):
         """Calls self.session.post with the given arguments
 
-        Implements automatic retries and backoffs as per the B2 documentation
+        Implements automatic retries and backoffs as per the B2 documentation.
+        Each attempt holds a slot from the shared limiter, and throttling
+        responses shrink the limit for all threads.
         """
         kwargs.setdefault('timeout', TIMEOUT)
 
         delay = 1
         max_delay = 64
         while True:
-            try:
-                response = self.session.post(*args, **kwargs)
-            except (requests.exceptions.ConnectionError,
-                    requests.exceptions.Timeout):
-                # No response from server at all
-                if max_delay < delay:
-                    # Give up
-                    logger.info("Timeout in B2 call. Giving up")
-                    raise
-                logger.debug("Timeout in B2 call, retrying in {}s".format(
-                    delay))
-                time.sleep(delay)
-                delay *= 2
-            else:
-                if response.status_code == 503:
-                    # Service unavailable
+            with self.limiter.request() as slot:
+                try:
+                    response = self.session.post(*args, **kwargs)
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout):
+                    # No response from server at all
+                    slot.throttled()
                     if max_delay < delay:
                         # Give up
-                        logger.info("B2 service unavailable. Giving up")
-                        return response
-                    logger.debug("B2 service unavailable, retrying in "
+                        logger.info("Timeout in B2 call. Giving up")
+                        raise
+                    logger.debug("Timeout in B2 call, retrying in "
                                  "{}s".format(delay))
-                    time.sleep(delay)
-                    delay *= 2
-                elif response.status_code == 429:
-                    # Too many requests
-                    delay = int(response.headers.get('Retry-After', 1))
-                    logger.debug("B2 returned 429 Too Many Requests. "
-                                  "Retrying in {}s".format(delay))
-                    time.sleep(delay)
-                    delay = 1
+                    response = None
                 else:
-                    # Success. Or at least, not a response that we want to retry
-                    return response
+                    if response.status_code == 503:
+                        # Service unavailable
+                        slot.throttled()
+                        if max_delay < delay:
+                            # Give up
+                            logger.info("B2 service unavailable. Giving up")
+                            return response
+                        logger.debug("B2 service unavailable, retrying in "
+                                     "{}s".format(delay))
+                    elif response.status_code == 429:
+                        # Too many requests. The limiter holds back all
+                        # threads until the Retry-After time has passed.
+                        retry_after = _retry_after(response)
+                        slot.throttled(retry_after)
+                        logger.debug("B2 returned 429 Too Many Requests. "
+                                     "Retrying in {}s".format(retry_after))
+                        delay = 1
+                        continue
+                    else:
+                        # Success. Or at least, not a response that we want
+                        # to retry
+                        return response
+
+            # Sleep without holding a slot. The jitter keeps threads that
+            # failed together from all retrying at the same moment.
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+
+    def _get_auth(self):
+        """Returns the shared authorization, authorizing first if needed"""
+        auth = self._auth
+        if auth is None:
+            with self._auth_lock:
+                if self._auth is None:
+                    self._load_cached_auth()
+            auth = self._auth
+        if auth is None:
+            auth = self._authorize_account()
+        return auth
+
+    def _load_cached_auth(self):
+        """Uses the cached authorization and bucket ID from a previous run,
+        if there is one and it's still valid"""
+        if self.auth_loader is None:
+            return
+        cache = self.auth_loader()
+        if cache is None:
+            return
+        if (cache.get('account_id') != self.account_id or
+                cache.get('bucket_name') != self.bucket_name or
+                cache.get('auth_url') != self.auth_url or
+                cache.get('expires', 0) <= time.time()):
+            return
+        logger.debug("Using cached authorization token")
+        self._auth = cache['auth']
+        if self._bucket_id is None:
+            self._bucket_id = cache.get('bucket_id')
+
+    def _save_cached_auth(self):
+        if self.on_auth is None or self._auth is None:
+            return
+        self.on_auth({
+            'account_id': self.account_id,
+            'bucket_name': self.bucket_name,
+            'auth_url': self.auth_url,
+            'auth': self._auth,
+            'bucket_id': self._bucket_id,
+            'expires': self._auth['obtained'] + self.AUTH_CACHE_LIFETIME,
+        })
 
-    def _authorize_account(self):
+    def _authorize_account(self, expired=None):
         """Calls b2_authorize_account to get a session authorization token
 
-        If successful, sets the authorization_token and api_url
+        If successful, sets and returns the shared authorization dict with
+        the authorization_token, api_url and download_url
 
         If unsuccessful, raises an IOError with a description of the error
 
         This costs one class C transaction. This generally needs to be called
-        once per thread at the start of the session, but extremely long
-        sessions may need to refresh the authorization token.
+        once at the start of the session, but extremely long sessions may
+        need to refresh the authorization token. Callers refreshing an
+        expired token pass the expired authorization dict. If another thread
+        has already replaced it, the new one is returned without another
+        call.
         """
-        logger.debug("Acquiring authorization token for thread id {}".format(
-            threading.get_ident()
-        ))
+        with self._auth_lock:
+            if self._auth is not None and self._auth is not expired:
+                return self._auth
+            self._auth = self._request_authorization()
+            self._save_cached_auth()
+            return self._auth
+
+    def _request_authorization(self):
+        logger.debug("Acquiring authorization token")
         response = self._post_with_backoff_retry(
-            "https://api.backblazeb2.com/b2api/v1/b2_authorize_account",
+            self.auth_url or AUTH_URL,
             headers={
                 'Authorization': 'Basic {}'.format(
                     base64.b64encode("{}:{}".format(
@@ -219,57 +423,61 @@ class B2Bucket(StorageBase):
         if response.status_code != 200:
             raise B2ResponseError(data)
 
-        self._local.authorization_token = data['authorizationToken']
-        self._local.api_url = data['apiUrl']
-        self._local.download_url = data['downloadUrl']
+        return {
+            'authorization_token': data['authorizationToken'],
+            'api_url': data['apiUrl'],
+            'download_url': data['downloadUrl'],
+            'obtained': time.time(),
+        }
 
     def _call_api(self, api_name, data):
         """Calls the given API with the given json data
 
         If the account hasn't been authorized yet, calls b2_authorize_account
-        first to obtain the authorization token
+        first to obtain the authorization token. If B2 rejects the token as
+        expired, gets a new one and retries, up to API_AUTH_TRIES times.
 
         If successful, returns the response json object
 
         If unsuccessful, raises an IOError with a description of the error
         """
-        api_url = getattr(self._local, 'api_url', None)
-        authorization_token = getattr(self._local, 'authorization_token', None)
-        if api_url is None or authorization_token is None:
-            self._authorize_account()
-
-        response = self._post_with_backoff_retry(
-            "{}/b2api/v1/{}".format(self._local.api_url, api_name),
-            headers = {
-                'Authorization': self._local.authorization_token,
-            },
-            json=data,
-        )
-        logger.debug("{} {} {:.2f}s".format(
-            api_name,
-            response.status_code,
-            response.elapsed.total_seconds(),
-        ))
-
-        try:
-            data = response.json()
-        except ValueError:
-            response.raise_for_status()
-            raise IOError("Invalid json response from B2 on call to {}".format(api_name))
+        for tries in range(self.API_AUTH_TRIES + 1):
+            auth = self._get_auth()
+
+            response = self._post_with_backoff_retry(
+                "{}/b2api/v1/{}".format(auth['api_url'], api_name),
+                headers = {
+                    'Authorization': auth['authorization_token'],
+                },
+                json=data,
+            )
+            logger.debug("{} {} {:.2f}s".format(
+                api_name,
+                response.status_code,
+                response.elapsed.total_seconds(),
+            ))
 
-        if response.status_code == 401 and data['code'] == "expired_auth_token":
-            # Auth token has expired. Retry after getting a new one.
-            self._local.api_url = None
-            self._local.authorization_token = None
-            logger.info("Auth token expired")
-            return self._call_api(api_name, data)
+            try:
+                response_data = response.json()
+            except ValueError:
+                response.raise_for_status()
+                raise IOError("Invalid json response from B2 on call to {}".format(api_name))
+
+            if response.status_code == 401 and \
+                    response_data['code'] == "expired_auth_token" and \
+                    tries < self.API_AUTH_TRIES:
+                # Auth token has expired. Retry after getting a new one.
+                logger.info("Auth token expired")
+                self._authorize_account(expired=auth)
+                continue
+            break
 
         if response.status_code != 200:
-            raise B2ResponseError(data)
+            raise B2ResponseError(response_data)
 
-        return data
+        return response_data
 
-    @cached_property
+    @property
     def bucket_id(self):
         """The bucket ID
 
@@ -277,8 +485,22 @@ class B2Bucket(StorageBase):
         the name is part of our config, we have to query for the ID.
 
         This costs one class C transaction, and the result is cached for the
-        lifetime of this B2Bucket instance.
+        lifetime of this B2Bucket instance, and between runs along with the
+        authorization. Threads that need it at the same time wait for a
+        single lookup.
         """
+        if self._bucket_id is None:
+            # Loads the cached bucket ID too, if there is one
+            self._get_auth()
+        if self._bucket_id is None:
+            with self._bucket_id_lock:
+                if self._bucket_id is None:
+                    self._bucket_id = self._lookup_bucket_id()
+                    with self._auth_lock:
+                        self._save_cached_auth()
+        return self._bucket_id
+
+    def _lookup_bucket_id(self):
         data = self._call_api("b2_list_buckets", {'accountId': self.account_id})
         for bucketinfo in data['buckets']:
             if bucketinfo['bucketName'] == self.bucket_name:
@@ -287,15 +509,77 @@ class B2Bucket(StorageBase):
         raise IOError("No such bucket name {}".format(self.bucket_name))
 
     def _get_upload_url(self):
-        """Sets the upload_url and upload_token or raises IOError
+        """Returns a new (upload url, upload token) pair or raises IOError
+
+        This is called by the upload URL pool when it has no free URLs.
 
         This costs one class A transaction
         """
         logger.debug("Getting a new upload url")
         data = self._call_api("b2_get_upload_url",
                               data={'bucketId': self.bucket_id})
-        self._local.upload_url = data['uploadUrl']
-        self._local.upload_token = data['authorizationToken']
+        return data['uploadUrl'], data['authorizationToken']
+
+    def _get_upload_part_url(self, file_id):
+        """Returns a new (upload url, upload token) pair for uploading parts
+        of the given large file
+
+        This costs one class A transaction
+        """
+        data = self._call_api("b2_get_upload_part_url", {'fileId': file_id})
+        return data['uploadUrl'], data['authorizationToken']
+
+    def _post_upload(self, url, token, headers, data):
+        """Makes one request to an upload URL from b2_get_upload_url or
+        b2_get_upload_part_url
+
+        Returns the response json. Raises _UploadRetry for errors that should
+        be retried with a new upload URL, and B2ResponseError for any other
+        errors.
+        """
+        headers = dict(headers, Authorization=token)
+        with self.limiter.request() as slot:
+            try:
+                response = self.session.post(
+                    url,
+                    headers=headers,
+                    timeout=TIMEOUT,
+                    data=data,
+                )
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                slot.throttled()
+                raise _UploadRetry(IOError(str(e))) from e
+            if response.status_code == 429:
+                slot.throttled(_retry_after(response))
+            elif response.status_code in (408, 503):
+                slot.throttled()
+
+        logger.debug("upload {} {:.2f}s".format(
+            response.status_code,
+            response.elapsed.total_seconds(),
+        ))
+
+        try:
+            response_data = response.json()
+        except ValueError:
+            raise IOError("Invalid json returned from B2 API")
+
+        if response.status_code == 401 and \
+                response_data['code'] == "expired_auth_token":
+            raise _UploadRetry(B2ResponseError(response_data))
+
+        if response.status_code in (408, 429) or \
+                500 <= response.status_code <= 599:
+            # Request timeout, too many requests or any server errors. The
+            # limiter has already delayed further requests if B2 asked.
+            raise _UploadRetry(B2ResponseError(response_data))
+
+        # Any other errors indicate a permanent problem with the request
+        if response.status_code != 200:
+            raise B2ResponseError(response_data)
+
+        return response_data
 
     def upload_file(self, name, content):
         """Calls b2_upload_file to upload the given data to the given name
@@ -311,27 +595,34 @@ class B2Bucket(StorageBase):
             metadata
 
         This costs one class A transaction for the upload, and possibly a
-        second for the call to b2_get_upload_url
+        second for the call to b2_get_upload_url if no upload URL is free in
+        the pool
 
+        Files larger than LARGE_FILE_THRESHOLD are uploaded with
+        upload_large_file() instead.
         """
         logger.info("Uploading {!r}".format(name))
 
-        response = None
-        response_data = None
-        exc_str = None
-
-        filename = urllib.parse.quote(name, encoding="utf-8")
-
         content.seek(0, os.SEEK_END)
         filesize = content.tell()
 
-        content.seek(0)
-        digest = hashlib.sha1()
-        while True:
-            chunk = content.read(io.DEFAULT_BUFFER_SIZE)
-            if not chunk:
-                break
-            digest.update(chunk)
+        if filesize > self.LARGE_FILE_THRESHOLD:
+            content.seek(0)
+            return self.upload_large_file(name, content)
+
+        filename = urllib.parse.quote(name, encoding="utf-8")
+
+        if isinstance(content, util.BytesReader):
+            # Hash the buffer directly instead of reading it in pieces
+            digest = hashlib.sha1(content.buf)
+        else:
+            content.seek(0)
+            digest = hashlib.sha1()
+            while True:
+                chunk = content.read(io.DEFAULT_BUFFER_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
 
         headers = {
             'X-Bz-File-Name': filename,
@@ -343,144 +634,257 @@ class B2Bucket(StorageBase):
         # We don't use the usual backoff handler when uploading. As per the B2
         # documentation, for most problems we can just get a new upload URL
         # with b2_get_upload_url and try again immediately
-        for _ in range(5):
-            if (getattr(self._local, "upload_url", None) is None or
-                getattr(self._local, "upload_token", None) is None
-            ):
-                self._get_upload_url()
-
-            headers['Authorization'] = self._local.upload_token
-
-            response = None
-            response_data = None
-            exc_str = None
-            
+        error = None
+        for _ in range(self.UPLOAD_TRIES):
+            upload_url = self._upload_urls.get()
+
             content.seek(0)
 
             try:
-                response = self.session.post(
-                    self._local.upload_url,
-                    headers = headers,
-                    timeout=TIMEOUT,
-                    data=content,
+                response_data = self._post_upload(
+                    upload_url.url,
+                    upload_url.token,
+                    headers,
+                    content,
                 )
-            except (requests.exceptions.ConnectionError,
-                    requests.exceptions.Timeout) as e:
+            except _UploadRetry as e:
                 logger.info("Error when uploading ({})".format(e))
-                exc_str = str(e)
-                del self._local.upload_url
+                error = e.error
+                self._upload_urls.discard(upload_url)
                 continue
 
-            logger.debug("b2_upload_file {} {:.2f}s".format(
-                response.status_code,
-                response.elapsed.total_seconds(),
-            ))
+            self._upload_urls.put(upload_url)
+            return response_data
 
-            try:
-                response_data = response.json()
-            except ValueError():
-                raise IOError("Invalid json returned from B2 API")
+        # All tries failed. Raise the error from the last try.
+        raise error
 
-            if response.status_code == 401 and response_data['code'] == "expired_auth_token":
-                logger.info("Expired auth token when uploading")
-                del self._local.upload_url
-                continue
+    def upload_large_file(self, name, content):
+        """Uploads a file in parts using the B2 large file API
 
-            if response.status_code == 408:
-                # Request timeout
-                logger.info("Request timeout when uploading")
-                del self._local.upload_url
-                continue
+        Calls b2_start_large_file, then b2_upload_part for each part of
+        PART_SIZE bytes, then b2_finish_large_file. Up to part_concurrency
+        parts are uploaded at once, each with its own upload part URL, and a
+        failed part is retried with a new URL without affecting the others.
+        Each part's SHA-1 is calculated as it is read.
 
-            if 500 <= response.status_code <= 599:
-                # Any server errors
-                logger.info("Server error when uploading")
-                del self._local.upload_url
-                continue
+        If the upload fails, the large file is canceled so B2 doesn't keep
+        the uploaded parts.
+
+        :param content: A file-like object open for reading in binary mode
 
-            # Any other errors indicate a permanent problem with the request
-            if response.status_code != 200:
-                raise B2ResponseError(response_data)
+        This costs one class A transaction to start the file, one to finish
+        it, and one per part plus one per upload part URL.
+        """
+        data = self._call_api("b2_start_large_file", {
+            'bucketId': self.bucket_id,
+            'fileName': name,
+            'contentType': "b2/x-auto",
+        })
+        file_id = data['fileId']
+
+        # Upload part URLs for this file. Each can only be used for one
+        # upload at a time.
+        part_urls = _UploadUrlPool(
+            lambda: self._get_upload_part_url(file_id),
+            self.part_concurrency,
+        )
 
+        part_sha1s = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.part_concurrency) as executor:
+                pending = set()
+                part_number = 1
+                while True:
+                    part = content.read(self.PART_SIZE)
+                    if not part:
+                        break
+                    sha1 = hashlib.sha1(part).hexdigest()
+                    part_sha1s[part_number] = sha1
+
+                    if len(pending) >= self.part_concurrency:
+                        done, pending = concurrent.futures.wait(
+                            pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED,
+                        )
+                        for f in done:
+                            f.result()
+                    pending.add(executor.submit(
+                        self._upload_part, file_id, part_urls,
+                        part_number, part, sha1,
+                    ))
+                    part_number += 1
+                    del part
+
+                for f in concurrent.futures.as_completed(pending):
+                    f.result()
+
+            return self._call_api("b2_finish_large_file", {
+                'fileId': file_id,
+                'partSha1Array': [part_sha1s[n]
+                                  for n in sorted(part_sha1s)],
+            })
+        except BaseException:
+            try:
+                self._call_api("b2_cancel_large_file", {'fileId': file_id})
+            except IOError as e:
+                logger.warning("Could not cancel large file {}: {}".format(
+                    name, e
+                ))
+            raise
+
+    def _upload_part(self, file_id, part_urls, part_number, data, sha1):
+        """Uploads one part of a large file, retrying with a new upload part
+        URL on failure
+
+        :type part_urls: _UploadUrlPool
+        """
+        headers = {
+            'X-Bz-Part-Number': str(part_number),
+            'Content-Length': str(len(data)),
+            'X-Bz-Content-Sha1': sha1,
+        }
+
+        error = None
+        for _ in range(self.UPLOAD_TRIES):
+            upload_url = part_urls.get()
+
+            try:
+                response_data = self._post_upload(
+                    upload_url.url, upload_url.token, headers, data,
+                )
+            except _UploadRetry as e:
+                logger.info("Error when uploading part {} ({})".format(
+                    part_number, e))
+                error = e.error
+                part_urls.discard(upload_url)
+                continue
+
+            part_urls.put(upload_url)
             return response_data
 
-        # The loop exited, so all 5 tries failed. See if we can raise an
-        # appropriate error from the last try
-        if response_data is not None:
-            raise B2ResponseError(response_data)
-        if response is not None:
-            response.raise_for_status()
-        # This path could be hit if the last failure was due to a connection
-        # error or timeout
-        if exc_str:
-            raise IOError(exc_str)
-        raise IOError("Upload failed, unknown reason")
+        raise error
 
-    def download_file(self, name):
-        """Downloads a file by name
+    # Size of the pieces a download is read and verified in
+    DOWNLOAD_CHUNK_SIZE = 2**16
 
-        Returns (metadata dict, file handle)
+    # Number of times to retry a download that B2 rejects as too busy, or
+    # because the auth token expired
+    DOWNLOAD_TRIES = 5
 
-        file handle is open for reading in binary mode.
+    def _open_download(self, name, byte_range=None):
+        """Starts downloading a file by name and returns the streaming
+        response once its status has been checked
 
-        Raises IOError if there was a problem downloading the file
+        :param byte_range: An optional (start, end) tuple of byte offsets to
+            download only part of the file. end is exclusive, or None to read
+            to the end of the file.
 
-        This costs one class B transaction
+        Raises IOError if there was a problem downloading the file
         """
         logger.debug("Downloading {}".format(name))
-        f = tempfile.SpooledTemporaryFile(
-            suffix=".b2tmp",
-            max_size=2**21,
-        )
-
-        if (getattr(self._local, "download_url", None) is None or
-            getattr(self._local, "authorization_token", None) is None
-        ):
-            self._authorize_account()
-
-        digest = hashlib.sha1()
 
         filename = urllib.parse.quote(name, encoding="utf-8")
 
-        response = self.session.get(
-            "{}/file/{}/{}".format(
-                self._local.download_url,
-                self.bucket_name,
-                filename,
-            ),
-            timeout=TIMEOUT,
-            headers={
-                'Authorization': self._local.authorization_token,
-            },
-            stream=True,
-        )
+        headers = {}
+        if byte_range is not None:
+            range_start, range_end = byte_range
+            headers['Range'] = "bytes={}-{}".format(
+                range_start,
+                "" if range_end is None else range_end - 1,
+            )
+
+        tries = 0
+        auth_tries = 0
+        while True:
+            auth = self._get_auth()
+            headers['Authorization'] = auth['authorization_token']
+            with self.limiter.request() as slot:
+                response = self.session.get(
+                    "{}/file/{}/{}".format(
+                        auth['download_url'],
+                        self.bucket_name,
+                        filename,
+                    ),
+                    timeout=TIMEOUT,
+                    headers=headers,
+                    stream=True,
+                )
+                if response.status_code == 429:
+                    slot.throttled(_retry_after(response))
+                elif response.status_code == 503:
+                    slot.throttled()
+            if response.status_code == 401 and \
+                    auth_tries < self.DOWNLOAD_TRIES and \
+                    response.json().get('code') == "expired_auth_token":
+                # Retry after getting a new auth token
+                auth_tries += 1
+                logger.info("Auth token expired")
+                response.close()
+                self._authorize_account(expired=auth)
+                continue
+            if response.status_code in (429, 503) and \
+                    tries < self.DOWNLOAD_TRIES:
+                # The limiter holds back this and other requests for
+                # a 429. Back off a little more for a 503.
+                tries += 1
+                logger.debug("B2 returned {} for download, retrying".format(
+                    response.status_code))
+                response.close()
+                if response.status_code == 503:
+                    time.sleep(2 ** tries * random.uniform(0.25, 0.75))
+                continue
+            break
 
         logger.debug("b2_download_file_by_name {} {:.2f}s".format(
             response.status_code,
             response.elapsed.total_seconds(),
         ))
 
-        with response:
-            if response.status_code != 200:
+        expected_status = 200 if byte_range is None else 206
+        if response.status_code != expected_status:
+            with response:
                 try:
                     resp_json = response.json()
                 except ValueError:
                     response.raise_for_status()
-                    raise IOError("Non-200 status code returned for download "
-                                  "request")
+                    raise IOError("Unexpected status code {} returned for "
+                                  "download request".format(
+                        response.status_code))
                 raise B2ResponseError(resp_json)
 
-            for chunk in response.iter_content(chunk_size=io.DEFAULT_BUFFER_SIZE):
-                digest.update(chunk)
-                f.write(chunk)
+        return response
+
+    def _iter_response(self, response, verify):
+        """Yields the body of a download response in pieces
+
+        If verify is true, the SHA-1 of the body is checked as it is read,
+        and IOError is raised after the last piece if it doesn't match. The
+        consumer must not trust anything it has read until the iterator is
+        exhausted.
+        """
+        # Files uploaded with the large file API don't have a SHA-1 of the
+        # whole file, only of each part, so they can't be checked here.
+        expected_sha1 = response.headers['X-Bz-Content-Sha1']
+        if expected_sha1 == "none":
+            verify = False
+        digest = hashlib.sha1()
 
-        if not hmac.compare_digest(
+        with response:
+            for chunk in response.iter_content(
+                    chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                if verify:
+                    digest.update(chunk)
+                yield chunk
+
+        if verify and not hmac.compare_digest(
                 digest.hexdigest(),
-                response.headers['X-Bz-Content-Sha1'],
+                expected_sha1,
         ):
-            f.close()
             raise IOError("Corrupt download: Sha1 doesn't match")
 
+    def _response_metadata(self, response):
         data = {
             'fileId': response.headers['X-Bz-File-Id'],
             'fileName': urllib.parse.unquote(response.headers['X-Bz-File-Name']),
@@ -496,17 +900,68 @@ class B2Bucket(StorageBase):
                 data['fileInfo'][h[10:]] = urllib.parse.unquote(
                         response.headers[h]
                 )
+        return data
+
+    def download_file(self, name):
+        """Downloads a file by name
+
+        Returns (metadata dict, file handle)
+
+        file handle is open for reading in binary mode.
+
+        Raises IOError if there was a problem downloading the file
+
+        This costs one class B transaction
+        """
+        f = tempfile.SpooledTemporaryFile(
+            suffix=".b2tmp",
+            max_size=2**21,
+        )
+
+        response = self._open_download(name)
+        try:
+            for chunk in self._iter_response(response, verify=True):
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            raise
 
         f.seek(0)
-        return data, f
+        return self._response_metadata(response), f
 
-    def get_files_by_prefix(self, prefix):
+    def download_buffer(self, name, byte_range=None):
+        """Downloads a file by name into memory
+
+        The contents are read directly into a bytearray of the response's
+        length, rather than through a temporary file.
+
+        This costs one class B transaction
+        """
+        response = self._open_download(name, byte_range)
+        size = int(response.headers['Content-Length'])
+        buf = bytearray(size)
+        pos = 0
+        for chunk in self._iter_response(response,
+                                         verify=byte_range is None):
+            if pos + len(chunk) > size:
+                raise IOError("Download of {} is longer than "
+                              "expected".format(name))
+            buf[pos:pos+len(chunk)] = chunk
+            pos += len(chunk)
+        if pos != size:
+            raise IOError("Download of {} is truncated".format(name))
+        return buf
+
+    def get_files_by_prefix(self, prefix, start_name=None):
         """Calls b2_list_file_names to get a list of files in the bucket
 
         :param prefix: A file name prefix. This is not a directory path,
         but a string prefix. All objects in the bucket with the given prefix
         will be returned.
 
+        :param start_name: If given, the listing starts at this name, as with
+        the startFileName parameter of b2_list_file_names
+
         :returns: An iterator over metadata dictionaries
 
         Note: we fetch 1000 items at a time from the underlying API, so this
@@ -516,7 +971,7 @@ class B2Bucket(StorageBase):
         up)
         """
 
-        start_filename = None
+        start_filename = start_name
 
         while True:
             data = self._call_api(
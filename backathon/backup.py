@@ -3,7 +3,11 @@ import os
 import stat
 import io
 import datetime
+import math
+import collections
+import contextlib
 import concurrent.futures
+import asyncio
 
 from django.db.transaction import atomic
 from django.db import connections
@@ -14,10 +18,17 @@ import umsgpack
 
 from . import models
 from . import chunker
+from . import util
 from .exceptions import DependencyError
 
 logger = getLogger("backathon.backup")
 
+# Yielded by backup_iterator() in place of a payload for files large enough
+# to be split into ranges. The caller pushes the chunks of each range,
+# possibly in parallel, and sends back the list of (position, Object) for
+# all chunks of the file in order.
+FileRanges = collections.namedtuple("FileRanges", ["path", "ranges"])
+
 def backup(repo, progress=None):
     """Perform a backup
 
@@ -55,9 +66,55 @@ def backup(repo, progress=None):
     backup_total = to_backup.count()
     backup_count = 0
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    # A new budget for each run, so a changed backup_memory_limit applies
+    repo.memory_budget = util.MemoryBudget(repo.backup_memory_limit)
+
+    # One worker backs up entries, and the range workers (if any) push
+    # chunks of large files alongside it. In asyncio mode the async
+    # storage's workers push the chunks instead, and it sets the
+    # concurrency itself.
+    use_asyncio = repo.io_mode == "asyncio"
+    if use_asyncio:
+        _ = repo.async_storage
+    elif repo.backup_concurrency > 1:
+        repo.storage.set_concurrency(repo.backup_concurrency + 1)
+    else:
+        repo.storage.set_concurrency(1)
+
+    # Ranges of large files are processed by a separate pool of workers.
+    # They can't share the executor below: an entry waiting on its ranges
+    # would then hold a worker that its own ranges may need.
+    with contextlib.ExitStack() as stack:
+        range_executor = None
+        if repo.backup_concurrency > 1 and not use_asyncio:
+            range_executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=repo.backup_concurrency,
+                )
+            )
+        executor = stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        )
         tasks = set()
 
+        def collect(timeout):
+            """Waits for tasks to finish and reports progress on them"""
+            nonlocal tasks, backup_count
+            try:
+                done, tasks = concurrent.futures.wait(tasks, timeout=timeout)
+            except KeyboardInterrupt:
+                print()
+                print("Ctrl-C received. Finishing current uploads, "
+                      "please wait...")
+                import sys
+                sys.exit(1)
+
+            for f in done:
+                f.result()
+                backup_count += 1
+                if progress is not None:
+                    progress(backup_count, backup_total)
+
         while to_backup.exists():
             ct = 0
 
@@ -76,7 +133,7 @@ def backup(repo, progress=None):
                 assert entry.obj_id is None
 
                 tasks.add(
-                    executor.submit(backup_entry, repo, entry)
+                    executor.submit(backup_entry, repo, entry, range_executor)
                 )
 
                 # Check if any are done yet. If all workers are busy,
@@ -85,24 +142,15 @@ def backup(repo, progress=None):
                 # in a timely manner, interfering with shutdown requests from
                 # e.g. ctrl-C.
                 if len(tasks) < executor._max_workers+1:
-                    timeout = 0
+                    collect(timeout=0)
                 else:
-                    timeout = None
+                    collect(timeout=None)
 
-                try:
-                    done, tasks = concurrent.futures.wait(tasks, timeout=timeout)
-                except KeyboardInterrupt:
-                    print()
-                    print("Ctrl-C received. Finishing current uploads, "
-                          "please wait...")
-                    import sys
-                    sys.exit(1)
-
-                for f in done:
-                    f.result()
-                    backup_count += 1
-                    if progress is not None:
-                        progress(backup_count, backup_total)
+            # Wait for the entries still in flight before querying again.
+            # Otherwise an entry finishing in between the two queries could
+            # be selected a second time, or, if it was the last entry,
+            # leave the next pass with nothing to select.
+            collect(timeout=None)
 
             # Sanity check: if we entered the outer loop but the inner loop's
             # query didn't select anything, then we're not making progress and
@@ -112,34 +160,66 @@ def backup(repo, progress=None):
             # all their dependent children backed up.
             assert ct > 0
 
+    # Make sure every object is durable before any snapshot refers to it
+    repo.storage.flush()
+
     now = timezone.now()
 
     for root in models.FSEntry.objects.using(repo.db).filter(
         parent__isnull=True
     ):
         assert root.obj_id is not None
-        with atomic():
+        with atomic(using=repo.db):
             ss = models.Snapshot.objects.using(repo.db).create(
                 path=root.path,
                 root_id=root.obj_id,
                 date=now,
             )
+            models.Object.add_references(repo.db, [root.obj_id])
             repo.put_snapshot(ss)
+    repo.storage.flush()
 
     with connections[repo.db].cursor() as cursor:
         cursor.execute("ANALYZE")
 
-def backup_entry(repo, entry):
+    logger.info("Peak in-flight file data during backup: {} bytes".format(
+        repo.memory_budget.peak))
+
+def backup_entry(repo, entry, range_executor=None):
+    """Backs up a single entry by driving its backup_iterator()
+
+    If range_executor is given, large files are split into ranges which are
+    submitted to the executor and pushed in parallel. In the repository's
+    asyncio I/O mode, the chunks of large files are pushed concurrently from
+    an event loop instead.
+    """
+    use_asyncio = repo.io_mode == "asyncio"
     iterator = backup_iterator(
         entry,
         inline_threshold=repo.backup_inline_threshold,
+        range_size=(repo.backup_range_size
+                    if range_executor is not None or use_asyncio
+                    else None),
+        budget=repo.memory_budget,
     )
 
     try:
         yielded = next(iterator)
         while True:
-            obj = repo.push_object(*yielded)
-            yielded = iterator.send(obj)
+            if isinstance(yielded, FileRanges):
+                try:
+                    if use_asyncio:
+                        result = backup_ranges_async(repo, yielded)
+                    else:
+                        result = backup_ranges(repo, yielded, range_executor)
+                except OSError as e:
+                    # Let the generator handle read errors the same way it
+                    # handles errors reading the file itself
+                    yielded = iterator.throw(e)
+                    continue
+            else:
+                result = repo.push_object(*yielded)
+            yielded = iterator.send(result)
     except StopIteration:
         pass
 
@@ -149,12 +229,156 @@ def backup_entry(repo, entry):
     assert entry.obj_id is not None or entry.id is None
 
 
-def backup_iterator(fsentry, inline_threshold=2 ** 21):
+def backup_ranges(repo, file_ranges, executor):
+    """Pushes the chunks of each range of a file in parallel
+
+    :type file_ranges: FileRanges
+    :type executor: concurrent.futures.Executor
+
+    Returns a list of (position, Object) for every chunk in the file,
+    in order.
+    """
+    futures = [
+        executor.submit(backup_range, repo, file_ranges.path, start, end)
+        for start, end in file_ranges.ranges
+    ]
+    try:
+        chunks = []
+        for f in futures:
+            chunks.extend(f.result())
+        return chunks
+    finally:
+        for f in futures:
+            f.cancel()
+
+def backup_range(repo, path, start, end):
+    """Reads, chunks, and pushes one range of a file
+
+    The file is opened separately for each range so ranges can be read
+    concurrently. end may be None to read to the end of the file.
+
+    Returns a list of (position, Object) for each chunk in the range
+    """
+    chunks = []
+    with _open_file(path) as fobj:
+        fobj.seek(start)
+        for pos, chunk in _reserve_chunks(
+                chunker.FixedChunker(fobj, end=end), repo.memory_budget):
+            chunk_obj = repo.push_object(
+                _pack_blob(chunk), models.Object(type="blob"), [],
+            )
+            chunks.append((pos, chunk_obj))
+    return chunks
+
+def backup_ranges_async(repo, file_ranges):
+    """Pushes the chunks of a file concurrently from an event loop
+
+    The file is read serially, but up to repo.async_max_in_flight chunks are
+    hashed, encrypted and uploaded at once, subject to the memory budget.
+
+    Returns a list of (position, Object) for every chunk in the file,
+    in order.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _push_chunks_async(repo, file_ranges.path)
+        )
+    finally:
+        loop.close()
+
+async def _push_chunks_async(repo, path):
+    loop = asyncio.get_event_loop()
+    budget = repo.memory_budget
+    chunk_size = chunker.FixedChunker.chunk_size
+    in_flight = asyncio.Semaphore(repo.async_max_in_flight)
+
+    async def push(pos, chunk):
+        try:
+            chunk_obj = await repo.push_object_async(
+                _pack_blob(chunk), models.Object(type="blob"), [],
+            )
+        finally:
+            budget.release(chunk_size)
+            in_flight.release()
+        return pos, chunk_obj
+
+    tasks = []
+    try:
+        with _open_file(path) as fobj:
+            chunks = iter(chunker.FixedChunker(fobj))
+            while True:
+                await in_flight.acquire()
+                # Waiting on the budget blocks, so do it in a worker thread.
+                # The budget may be held by this loop's own pushes, which
+                # release it as they finish.
+                await loop.run_in_executor(None, budget.acquire, chunk_size)
+                item = None
+                try:
+                    item = await loop.run_in_executor(None, next, chunks, None)
+                finally:
+                    if item is None:
+                        budget.release(chunk_size)
+                        in_flight.release()
+                if item is None:
+                    break
+                tasks.append(asyncio.ensure_future(push(*item)))
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def _reserve_chunks(chunks, budget):
+    """Iterates over (pos, chunk) from a chunker, reserving memory budget
+    for each chunk before it's read
+
+    Each reservation is held until the consumer asks for the next chunk.
+    """
+    iterator = iter(chunks)
+    while True:
+        with budget.reserve(chunker.FixedChunker.chunk_size):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+
+def _split_ranges(size, range_size):
+    """Splits a file of the given size into a list of (start, end) ranges
+
+    Range boundaries are aligned to the chunk size so the chunks are
+    identical to those from chunking the file serially. The last range has
+    an end of None so it picks up any data appended since the file was
+    stat'd.
+    """
+    chunk_size = chunker.FixedChunker.chunk_size
+    range_size = max(1, range_size // chunk_size) * chunk_size
+    starts = list(range(0, size, range_size))
+    ends = starts[1:] + [None]
+    return list(zip(starts, ends))
+
+def _pack_blob(chunk):
+    buf = io.BytesIO()
+    umsgpack.pack("blob", buf)
+    umsgpack.pack(chunk, buf)
+    buf.seek(0)
+    return buf
+
+def backup_iterator(fsentry, inline_threshold=2 ** 21, range_size=None,
+                    budget=None):
     """Back up an FSEntry object
 
     :type fsentry: models.FSEntry
     :param inline_threshold: Threshold in bytes below which file contents are
         inlined into the inode payload.
+    :param range_size: If given, files larger than this are split into
+        ranges of about this size, which the caller may push in parallel.
+    :param budget: A util.MemoryBudget that file data is reserved from
+        before it's read. Reservations are held until the caller sends back
+        the Object for the payload.
+    :type budget: util.MemoryBudget
 
     This is a generator function. Its job is to take the given models.FSEntry
     object and create the models.Object object for the local cache database
@@ -191,7 +415,11 @@ def backup_iterator(fsentry, inline_threshold=2 ** 21):
     entries in an order to avoid dependency issues.
 
     For files: yields one or more payloads for the file's contents,
-    then finally a payload for the inode entry.
+    then finally a payload for the inode entry. Files larger than
+    range_size instead yield a single FileRanges instance for their
+    contents, and the caller sends back a list of (position, Object) for
+    every chunk of the file, in order. Errors reading the ranges should be
+    thrown into the generator with throw().
 
     IMPORTANT: every exit point from this function must either update
     this entry's obj field to a non-null value, OR delete the entry before
@@ -207,6 +435,9 @@ def backup_iterator(fsentry, inline_threshold=2 ** 21):
 
     fsentry.update_stat_info(stat_result)
 
+    if budget is None:
+        budget = util.MemoryBudget(math.inf)
+
     obj = models.Object()
     relations = [] # type: list[models.ObjectRelation]
 
@@ -235,56 +466,75 @@ def backup_iterator(fsentry, inline_threshold=2 ** 21):
         )
         umsgpack.pack(info, inode_buf)
 
-        try:
-            with _open_file(fsentry.path) as fobj:
-                if stat_result.st_size < inline_threshold:
-                    # If the file size is below this threshold, put the contents
-                    # as a blob right in the inode object. Don't bother with
-                    # separate blob objects
-                    umsgpack.pack(("immediate", fobj.read()), inode_buf)
-
-                else:
-                    # Break the file's contents into chunks and upload
-                    # each chunk individually
-                    chunk_list = []
-                    for pos, chunk in chunker.FixedChunker(fobj):
-                        buf = io.BytesIO()
-                        umsgpack.pack("blob", buf)
-                        umsgpack.pack(chunk, buf)
-                        buf.seek(0)
-                        chunk_obj = yield (buf, models.Object(type="blob"), [])
-                        chunk_list.append((pos, chunk_obj.objid))
-                        relations.append(
+        # Inline file contents are held in memory until the inode payload
+        # is pushed, so that much of the memory budget is reserved until
+        # then. Chunked files reserve each chunk as it's read instead.
+        inline = stat_result.st_size < inline_threshold
+        with budget.reserve(stat_result.st_size if inline else 0):
+            try:
+                with _open_file(fsentry.path) as fobj:
+                    if inline:
+                        # If the file size is below this threshold, put the
+                        # contents as a blob right in the inode object.
+                        # Don't bother with separate blob objects
+                        umsgpack.pack(("immediate", fobj.read()), inode_buf)
+
+                    elif range_size and stat_result.st_size > range_size:
+                        # Large files are split into ranges that the caller
+                        # reads and pushes in parallel
+                        chunks = yield FileRanges(
+                            fsentry.path,
+                            _split_ranges(stat_result.st_size, range_size),
+                        )
+                        relations.extend(
                             models.ObjectRelation(child=chunk_obj)
+                            for _, chunk_obj in chunks
                         )
-                    umsgpack.pack(("chunklist", chunk_list), inode_buf)
-
-        except FileNotFoundError:
-            logger.info("File disappeared: {}".format(fsentry))
-            fsentry.delete()
-            return
-        except OSError:
-            # This happens with permission denied errors
-            logger.exception("Error in system call when reading file "
-                             "{}".format(fsentry))
-            # In order to not crash the entire backup, we must delete
-            # this entry so that the parent directory can still be backed
-            # up. This code path may leave one or more objects saved to
-            # the remote storage, but there's not much we can do about
-            # that here. (Basically, since every exit from this method
-            # must either acquire and save an obj or delete itself,
-            # we have no choice)
-            fsentry.delete()
-            return
-
-        inode_buf.seek(0)
-
-        # Pass the object and payload to the caller for uploading
-        fsentry.obj = yield (inode_buf, obj, relations)
-        logger.info("Backed up file into {} objects: {}".format(
-            len(relations)+1,
-            fsentry
-        ))
+                        umsgpack.pack(("chunklist", [
+                            (pos, chunk_obj.objid)
+                            for pos, chunk_obj in chunks
+                        ]), inode_buf)
+
+                    else:
+                        # Break the file's contents into chunks and upload
+                        # each chunk individually
+                        chunk_list = []
+                        for pos, chunk in _reserve_chunks(
+                                chunker.FixedChunker(fobj), budget):
+                            chunk_obj = yield (_pack_blob(chunk),
+                                               models.Object(type="blob"), [])
+                            chunk_list.append((pos, chunk_obj.objid))
+                            relations.append(
+                                models.ObjectRelation(child=chunk_obj)
+                            )
+                        umsgpack.pack(("chunklist", chunk_list), inode_buf)
+
+            except FileNotFoundError:
+                logger.info("File disappeared: {}".format(fsentry))
+                fsentry.delete()
+                return
+            except OSError:
+                # This happens with permission denied errors
+                logger.exception("Error in system call when reading file "
+                                 "{}".format(fsentry))
+                # In order to not crash the entire backup, we must delete
+                # this entry so that the parent directory can still be backed
+                # up. This code path may leave one or more objects saved to
+                # the remote storage, but there's not much we can do about
+                # that here. (Basically, since every exit from this method
+                # must either acquire and save an obj or delete itself,
+                # we have no choice)
+                fsentry.delete()
+                return
+
+            inode_buf.seek(0)
+
+            # Pass the object and payload to the caller for uploading
+            fsentry.obj = yield (inode_buf, obj, relations)
+            logger.info("Backed up file into {} objects: {}".format(
+                len(relations)+1,
+                fsentry
+            ))
 
     elif stat.S_ISDIR(fsentry.st_mode):
         # Directory
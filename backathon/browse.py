@@ -0,0 +1,160 @@
+"""
+Browses the contents of snapshots without restoring them
+
+Paths inside a snapshot are resolved one component at a time through the
+ObjectRelation table, which is indexed on (parent, name), and directory
+listings come from the same table. Sizes and modification times of
+entries are read from the Object table. Full metadata for stat() comes
+from the tree and inode payloads in the local cache, so browsing doesn't
+contact the remote repository. Only cat() downloads data: the blobs of the
+one file being read, or its inode if the file's contents are inline, since
+inline contents aren't kept in the local cache.
+
+Errors use the built in OSError subclasses, as they would for a local
+filesystem: FileNotFoundError, NotADirectoryError and IsADirectoryError.
+"""
+import collections
+import errno
+import fnmatch
+import os
+import posixpath
+
+import umsgpack
+
+from . import models
+from . import restore
+from .exceptions import CorruptedRepository
+
+Entry = collections.namedtuple("Entry", ["name", "obj"])
+
+def resolve(repo, snapshot, path, key=None):
+    """Returns the Object at the path within the snapshot
+
+    :type snapshot: models.Snapshot
+    :param path: A path relative to the snapshot's root. "" or "/" is the
+        root itself.
+    :param key: The key to decrypt tree objects, needed only for names that
+        aren't valid UTF-8 in trees whose payloads aren't in the local cache
+    :rtype: models.Object
+    """
+    obj = snapshot.root
+    for name in path.split("/"):
+        if name in ("", "."):
+            continue
+        if obj.type != "tree":
+            raise _error(NotADirectoryError, errno.ENOTDIR, path)
+        obj = _lookup(repo, obj, name, key)
+        if obj is None:
+            raise _error(FileNotFoundError, errno.ENOENT, path)
+    return obj
+
+def _error(cls, code, path):
+    return cls(code, os.strerror(code), path)
+
+def _lookup(repo, tree, name, key):
+    try:
+        name.encode("utf-8")
+    except UnicodeEncodeError:
+        pass
+    else:
+        relation = models.ObjectRelation.objects.using(repo.db)\
+            .filter(parent=tree, name=name)\
+            .select_related("child")\
+            .first()
+        if relation is not None:
+            return relation.child
+
+    # Names that aren't valid UTF-8 are stored lossily in the relation
+    # table, so compare against the raw names in the tree's payload
+    raw_name = os.fsencode(name)
+    _, _, entries = _parse(repo, tree, key)
+    for entry_name, objid in entries:
+        if entry_name == raw_name:
+            return models.Object.objects.using(repo.db).get(objid=objid)
+    return None
+
+def ls(repo, obj):
+    """Returns the entries of a tree object as a list of Entry tuples,
+    sorted by name"""
+    if obj.type != "tree":
+        raise _error(NotADirectoryError, errno.ENOTDIR, obj.objid.hex())
+    return [
+        Entry(r.name, r.child) for r in
+        models.ObjectRelation.objects.using(repo.db)
+        .filter(parent=obj)
+        .select_related("child")
+        .order_by("name")
+    ]
+
+def stat(repo, obj, key=None):
+    """Returns the metadata of a tree or inode object
+
+    The dict has the fields recorded at backup time (mode, uid, gid, mtime,
+    size, etc.) plus the object's type.
+
+    :param key: The key to decrypt the object, needed only if its payload
+        isn't in the local cache
+    """
+    obj_type, info, _ = _parse(repo, obj, key, contents=False)
+    return dict(info, type=obj_type)
+
+def find(repo, obj, pattern=None):
+    """Yields (path, Object) for everything under a tree object
+
+    Paths are relative to obj. The walk is depth first and makes one query
+    per directory. If pattern is given, only entries whose name matches
+    that shell-style pattern are yielded.
+    """
+    stack = [("", iter(ls(repo, obj)))]
+    while stack:
+        path, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        entry_path = posixpath.join(path, entry.name)
+        if pattern is None or fnmatch.fnmatchcase(entry.name, pattern):
+            yield entry_path, entry.obj
+        if entry.obj.type == "tree":
+            stack.append((entry_path, iter(ls(repo, entry.obj))))
+
+def cat(repo, obj, out, key=None):
+    """Writes the contents of an inode object to the binary file object out
+
+    Chunks are downloaded one at a time and written as they arrive, except
+    chunks of all zeros, which aren't fetched.
+
+    :raises CorruptedRepository: if a chunk can't be fetched or is invalid
+    """
+    obj_type, info, contents = _parse(repo, obj, key)
+    if obj_type != "inode":
+        raise _error(IsADirectoryError, errno.EISDIR, obj.objid.hex())
+
+    payload_type, payload_contents = contents
+    if payload_type == "immediate":
+        out.write(payload_contents)
+        return
+
+    zero_objid = restore.zero_chunk_objid(repo)
+    for pos, chunk_id, length in restore._chunk_ranges(payload_contents,
+                                                       info['size']):
+        if chunk_id == zero_objid:
+            out.write(bytes(length))
+            continue
+        items = restore.unpack_payload(
+            repo.get_object(chunk_id, key, use_cache=False)
+        )
+        try:
+            blob_type = next(items)
+            blob_contents = next(items)
+        except (StopIteration, umsgpack.UnpackException):
+            blob_type = None
+        if blob_type != "blob":
+            raise CorruptedRepository(
+                "Object {} is not a valid blob".format(chunk_id.hex()))
+        out.write(blob_contents)
+
+def _parse(repo, obj, key, contents=True):
+    items = restore.unpack_payload(
+        repo.get_object(bytes(obj.objid), key, contents=contents))
+    return next(items), next(items), next(items)
@@ -4,19 +4,32 @@ class FixedChunker:
 
     Yields (position, byteslike) for each chunk in a given file object
 
+    If end is given, chunking stops at that byte position instead of at the
+    end of the file. Along with seeking the file object before iterating,
+    this lets callers chunk a single range of a file. Ranges must start on a
+    multiple of chunk_size to produce the same chunks as chunking the
+    whole file.
+
     """
-    def __init__(self, fileobj):
+    chunk_size = 2**20
+
+    def __init__(self, fileobj, end=None):
         self.f = fileobj
+        self.end = end
         self.pos = 0
 
     def _get_chunksize(self):
-        return 2**20
+        return self.chunk_size
 
     def __iter__(self):
         while True:
             pos = self.f.tell()
-            data = self.f.read(self._get_chunksize())
+            size = self._get_chunksize()
+            if self.end is not None:
+                size = min(size, self.end - pos)
+                if size <= 0:
+                    return
+            data = self.f.read(size)
             if not data:
                 return
             yield pos, data
-
@@ -1,3 +1,4 @@
+import resource
 import time
 
 import tqdm
@@ -34,4 +35,13 @@ class Command(CommandBase):
             pbar.update(0)
 
         repo.backup(progress=progress)
+        pbar.close()
+
+        # ru_maxrss is in kilobytes on Linux
+        print("Peak memory: {} of file data in flight, {} process RSS".format(
+            filesizeformat(repo.memory_budget.peak),
+            filesizeformat(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            ),
+        ))
 
@@ -0,0 +1,112 @@
+import datetime
+import getpass
+import stat
+import sys
+
+from django.template.defaultfilters import filesizeformat
+
+from .. import browse
+from .. import models
+from ..exceptions import CorruptedRepository
+from ..repository import KeyRequired
+from . import CommandBase, CommandError
+
+class Command(CommandBase):
+    help = "Look inside a snapshot without restoring it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("snapshot", type=int,
+                            help="The snapshot ID, as listed by restore")
+        parser.add_argument("action", choices=["ls", "stat", "find", "cat"])
+        parser.add_argument("path", nargs="?", default="",
+                            help="Path relative to the snapshot root")
+        parser.add_argument("--name",
+                            help="With find, only list entries whose name "
+                                 "matches this shell-style pattern")
+
+    def handle(self, options):
+        repo = self.get_repo()
+
+        try:
+            snapshot = models.Snapshot.objects.using(repo.db)\
+                .get(id=options.snapshot)
+        except models.Snapshot.DoesNotExist:
+            raise CommandError("No such snapshot")
+
+        # Fetched only once an object is needed that isn't in the local
+        # cache
+        self.key = None
+
+        try:
+            obj = self.with_key(repo, browse.resolve, repo, snapshot,
+                                options.path)
+
+            if options.action == "ls":
+                if obj.type == "tree":
+                    for entry in browse.ls(repo, obj):
+                        self.print_entry(entry.name, entry.obj)
+                else:
+                    self.print_entry(options.path, obj)
+
+            elif options.action == "stat":
+                info = self.with_key(repo, browse.stat, repo, obj)
+                print("Type: {}".format(info.pop('type')))
+                print("Mode: {}".format(stat.filemode(info.pop('mode'))))
+                for field, value in sorted(info.items()):
+                    if field in ("atime", "mtime", "ctime"):
+                        # Recorded in nanoseconds
+                        value = datetime.datetime.fromtimestamp(value / 1e9)
+                    print("{}: {}".format(field.capitalize(), value))
+
+            elif options.action == "find":
+                for path, _ in browse.find(repo, obj, options.name):
+                    print(path)
+
+            elif options.action == "cat":
+                # Contents are always downloaded, and output can't be
+                # retried once written, so get the key first
+                if self.key is None:
+                    self.key = self.get_key(repo)
+                browse.cat(repo, obj, sys.stdout.buffer, self.key)
+                sys.stdout.buffer.flush()
+
+        except (OSError, CorruptedRepository) as e:
+            raise CommandError(str(e))
+
+    def print_entry(self, name, obj):
+        if obj.type == "tree":
+            name += "/"
+            size = "-"
+        else:
+            size = filesizeformat(obj.file_size or 0)
+        mtime = obj.last_modified_time
+        print("{:>10} {:>16} {}".format(
+            size,
+            "-" if mtime is None else mtime.strftime("%Y-%m-%d %H:%M"),
+            name,
+        ))
+
+    def with_key(self, repo, func, *args):
+        """Calls func(*args, key=...), first with the key fetched so far
+
+        Trees and inodes are read from the local cache without a key, but
+        ones whose payloads aren't cached (e.g. objects backed up before
+        payloads were cached) are downloaded and fail to decrypt without
+        it. In that case the key is fetched and func is called again.
+        """
+        try:
+            return func(*args, key=self.key)
+        except CorruptedRepository:
+            if self.key is not None:
+                raise
+            self.key = self.get_key(repo)
+            return func(*args, key=self.key)
+
+    def get_key(self, repo):
+        try:
+            # Succeeds without a password if the repository isn't encrypted
+            # or the key agent holds its key
+            return repo.get_decryption_key()
+        except KeyRequired:
+            sys.stderr.write("Enter your encryption password\n")
+            return repo.get_decryption_key(getpass.getpass())
@@ -0,0 +1,22 @@
+from .. import models
+from . import CommandBase
+
+class Command(CommandBase):
+    help = "Check the reference counts used to find garbage objects"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repair", action="store_true",
+                            help="Correct any counts that are wrong")
+
+    def handle(self, options):
+        repo = self.get_repo()
+
+        wrong = models.Object.check_refcounts(repo.db, repair=options.repair)
+        for objid, recorded, actual in wrong:
+            print("{}: recorded {}, actual {}".format(
+                objid.hex(), recorded, actual,
+            ))
+        print("{} objects with wrong reference counts{}".format(
+            len(wrong),
+            ", repaired" if wrong and options.repair else "",
+        ))
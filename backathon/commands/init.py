@@ -3,6 +3,7 @@ import getpass
 from . import CommandBase
 from .. import repository
 from .. import encryption
+from .. import models
 
 class Command(CommandBase):
     help = "Initialize a new repository and local cache database"
@@ -45,6 +46,17 @@ class Command(CommandBase):
         else:
             print("Compression already configured. Skipping...")
 
+        if "OBJID_HASH" not in repo.settings:
+            if "ENCRYPTION_SETTINGS" not in repo.settings and \
+                    not models.Object.objects.using(repo.db).exists():
+                # New repositories use keyed BLAKE2b for object IDs, which
+                # is quicker than HMAC-SHA256
+                repo.set_objid_hash("blake2b")
+            else:
+                # Repositories created before this setting existed keep
+                # SHA-256. Converting would re-upload the whole backup set.
+                repo.settings['OBJID_HASH'] = repo.objid_hash
+
         if "ENCRYPTION_SETTINGS" not in repo.settings:
             if self.input_yn("Would you like to enable encryption?", default=True):
                 while True:
@@ -56,7 +68,7 @@ class Command(CommandBase):
                 print("Do not lose your password. You will need it to recover "
                       "files")
                 print("Generating encryption keys...")
-                encrypter = encryption.NaclSealedBox.init_new(password)
+                encrypter = encryption.NaclHybridBox.init_new(password)
                 repo.set_encrypter(encrypter)
             else:
                 print("Encryption disabled. Remote repository contents will be")
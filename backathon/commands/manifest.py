@@ -0,0 +1,47 @@
+from django.db.models import Sum
+from django.template.defaultfilters import filesizeformat
+
+from .. import manifest
+from .. import models
+from . import CommandBase
+
+class Command(CommandBase):
+    help = "Show or update the local manifest of files in the remote " \
+           "repository"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sync", action="store_true",
+                            help="Reconcile the manifest with a listing of "
+                                 "the remote repository")
+        parser.add_argument("--pages", type=int,
+                            help="With --sync, list at most this many pages "
+                                 "of {} names. The next run resumes where "
+                                 "this one stops.".format(manifest.PAGE_SIZE))
+        parser.add_argument("--check", action="store_true",
+                            help="List objects in the local cache that are "
+                                 "missing from the manifest")
+
+    def handle(self, options):
+        repo = self.get_repo()
+
+        if options.sync:
+            stats, complete = manifest.reconcile(repo, max_pages=options.pages)
+            print("{} added, {} updated, {} removed".format(
+                stats['added'], stats['updated'], stats['removed'],
+            ))
+            if not complete:
+                print("Stopped before the end of the listing. Run again to "
+                      "continue.")
+
+        files = models.RemoteFile.objects.using(repo.db)
+        print("{} remote files totaling {}".format(
+            files.count(),
+            filesizeformat(files.aggregate(size=Sum("size"))['size'] or 0),
+        ))
+
+        if options.check:
+            missing = 0
+            for objid in manifest.missing_objects(repo):
+                print("Missing: {}".format(objid.hex()))
+                missing += 1
+            print("{} objects missing from the manifest".format(missing))
@@ -0,0 +1,27 @@
+from .. import encryption
+from . import CommandBase, CommandError
+
+class Command(CommandBase):
+    help = "Show or change the hash function used for object IDs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--set", choices=encryption.OBJID_HASHES,
+                            help="Convert the repository to this hash "
+                                 "function")
+
+    def handle(self, options):
+        repo = self.get_repo()
+
+        print("Object IDs are hashed with {}".format(repo.objid_hash))
+
+        if options.set is None or options.set == repo.objid_hash:
+            return
+
+        print("Changing the hash function changes the ID of every object.")
+        print("The next backup will upload the entire backup set again.")
+        if not self.input_yn("Continue?", default=False):
+            raise CommandError("Canceled")
+
+        repo.set_objid_hash(options.set)
+        repo.save_metadata()
+        print("Object IDs are now hashed with {}".format(repo.objid_hash))
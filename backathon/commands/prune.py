@@ -0,0 +1,77 @@
+import tqdm
+
+from .. import models
+from .. import prune
+from . import CommandBase, CommandError
+
+class Command(CommandBase):
+    help = "Delete old snapshots and the objects no longer referenced"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--keep-last", type=int, default=0,
+                            help="Keep the most recent N snapshots")
+        for period in prune.PERIODS:
+            parser.add_argument(
+                "--keep-" + period, type=int, default=0,
+                help="Keep the most recent snapshot of each of the last N "
+                     "{} periods that have one".format(period))
+        parser.add_argument("--full", action="store_true",
+                            help="Also sweep every object in the cache for "
+                                 "unreachable objects, instead of relying "
+                                 "only on reference counts")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only list the snapshots that would be "
+                                 "deleted")
+
+    def handle(self, options):
+        repo = self.get_repo()
+
+        try:
+            expired = prune.select_expired(
+                models.Snapshot.objects.using(repo.db).all(),
+                keep_last=options.keep_last,
+                keep_hourly=options.keep_hourly,
+                keep_daily=options.keep_daily,
+                keep_weekly=options.keep_weekly,
+                keep_monthly=options.keep_monthly,
+            )
+        except ValueError:
+            raise CommandError("Specify at least one --keep option")
+
+        print("{} snapshot{} to delete{}".format(
+            len(expired),
+            "s" if len(expired) != 1 else "",
+            ":" if expired else "",
+        ))
+        for ss in expired:
+            print("{}\t{} of {}".format(ss.id, ss.date, ss.printablepath))
+
+        if options.dry_run:
+            return
+
+        pbar = None
+
+        def progress(num, total):
+            nonlocal pbar
+            if pbar is None:
+                pbar = tqdm.tqdm(total=total, unit=" files")
+            pbar.n = num
+            pbar.total = total
+            pbar.update(0)
+
+        try:
+            stats = repo.prune(expired, progress=progress,
+                               full=options.full)
+        finally:
+            if pbar is not None:
+                pbar.close()
+
+        print("Deleted {} snapshots and {} objects".format(
+            stats['snapshots'], stats['objects'],
+        ))
+        print("Deleted {} files from the remote repository".format(
+            stats['files']
+        ))
+        if stats['failed']:
+            print("{} files failed to delete and will be retried by the next "
+                  "prune".format(stats['failed']))
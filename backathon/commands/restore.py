@@ -3,11 +3,21 @@ import getpass
 import logging
 
 from .. import models
+from ..repository import KeyRequired
 from . import CommandBase, CommandError
 
 class Command(CommandBase):
     help = "Restore one or more files or directories"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--incremental", action="store_true",
+                            help="Skip files at the destination whose size "
+                                 "and modification time match the snapshot")
+        parser.add_argument("--compare-chunks", action="store_true",
+                            help="With --incremental, compare files that "
+                                 "don't match chunk by chunk, and only "
+                                 "rewrite the chunks that differ")
+
     def handle(self, options):
 
         repo = self.get_repo()
@@ -41,15 +51,18 @@ class Command(CommandBase):
 
         root = ss.root
 
-        if repo.encrypter.password_required:
+        try:
+            # Succeeds without a password if the repository isn't encrypted
+            # or the key agent holds its key
+            key = repo.get_decryption_key()
+        except KeyRequired:
             print("Enter your encryption password")
-            pwd = getpass.getpass()
-        else:
-            pwd = None
+            key = repo.get_decryption_key(getpass.getpass())
 
         print("Restoring files...")
 
         logging.getLogger("backathon.restore").addHandler(
             logging.StreamHandler()
         )
-        repo.restore(root, dest_dir, pwd)
+        repo.restore(root, dest_dir, key=key, incremental=options.incremental,
+                     compare_chunks=options.compare_chunks)
@@ -0,0 +1,39 @@
+import getpass
+
+from .. import encryption
+from . import CommandBase, CommandError
+
+class Command(CommandBase):
+    help = "Unlock the repository's decryption key and hold it in the key " \
+           "agent, so restores don't ask for the password"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lifetime", type=int,
+                            help="Seconds to hold the key for. Defaults to "
+                                 "the repository's KEY_AGENT_LIFETIME "
+                                 "setting")
+        parser.add_argument("--lock", action="store_true",
+                            help="Remove the key from the agent instead")
+
+    def handle(self, options):
+        repo = self.get_repo()
+
+        if options.lock:
+            repo.lock()
+            print("Key removed from the agent")
+            return
+
+        if not repo.encrypter.password_required:
+            print("This repository is not encrypted")
+            return
+
+        print("Enter your encryption password")
+        pwd = getpass.getpass()
+        try:
+            repo.unlock(pwd, options.lifetime)
+        except encryption.DecryptionError:
+            raise CommandError("Wrong password")
+
+        print("Key unlocked for {} seconds".format(
+            options.lifetime or repo.key_agent_lifetime
+        ))
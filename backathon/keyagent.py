@@ -0,0 +1,222 @@
+"""
+A small agent process that holds unlocked decryption keys in memory
+
+Deriving the decryption key from the password is deliberately slow (argon2id
+with the "sensitive" limits uses about 1GiB of memory and several seconds of
+CPU). Scripts that run many restores would pay that cost every time. The
+'unlock' command derives the key once and hands it to this agent, which
+keeps it for a limited time. Later commands ask the agent for the key
+instead of prompting for the password.
+
+The agent listens on a Unix socket that only the current user can access,
+and also checks the peer credentials of every connection. Each request is
+one line of JSON, and each response is one line of JSON. The agent exits
+once all the keys it holds have expired.
+
+Run the agent directly with: python -m backathon.keyagent [SOCKET]
+"""
+import json
+import os
+import os.path
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+from logging import getLogger
+
+logger = getLogger("backathon.keyagent")
+
+# Seconds a newly started agent waits for its first key before exiting
+STARTUP_GRACE = 10
+
+def default_socket_path():
+    """Returns the path to the agent's socket for the current user
+
+    The BACKATHON_AGENT_SOCK environment variable overrides the default
+    location.
+    """
+    try:
+        return os.environ['BACKATHON_AGENT_SOCK']
+    except KeyError:
+        pass
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "backathon", "agent.sock")
+    return os.path.join("/tmp", "backathon-{}".format(os.getuid()),
+                        "agent.sock")
+
+class KeyAgent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The agent server. Holds keys in memory until they expire"""
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = {} # name -> (key, expiration time)
+        self.lock = threading.Lock()
+
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+        if os.stat(dirname).st_uid != os.getuid():
+            raise PermissionError("Agent socket directory {} is not owned by "
+                                  "this user".format(dirname))
+        if os.path.exists(path):
+            # Left over from an agent that didn't exit cleanly
+            os.unlink(path)
+
+        super().__init__(path, _RequestHandler)
+        os.chmod(path, 0o600)
+
+    def put(self, name, key, lifetime):
+        with self.lock:
+            self.keys[name] = (key, time.monotonic() + lifetime)
+
+    def get(self, name):
+        with self.lock:
+            self._expire()
+            try:
+                return self.keys[name][0]
+            except KeyError:
+                return None
+
+    def forget(self, name=None):
+        with self.lock:
+            if name is None:
+                self.keys.clear()
+            else:
+                self.keys.pop(name, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        for name in [n for n, (_, expires) in self.keys.items()
+                     if expires <= now]:
+            del self.keys[name]
+
+    def dispatch(self, request):
+        op = request.get("op")
+        if op == "put":
+            self.put(request['name'], request['key'], request['lifetime'])
+            return {"ok": True}
+        elif op == "get":
+            return {"ok": True, "key": self.get(request['name'])}
+        elif op == "forget":
+            self.forget(request.get('name'))
+            return {"ok": True}
+        return {"ok": False, "error": "Unknown operation {!r}".format(op)}
+
+    def run(self, startup_grace=STARTUP_GRACE):
+        """Serves requests until all keys have expired
+
+        The agent starts out with no keys, so it also waits up to
+        startup_grace seconds for the first one to be sent.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        started = time.monotonic()
+        try:
+            while True:
+                time.sleep(1)
+                with self.lock:
+                    self._expire()
+                    if not self.keys and \
+                            time.monotonic() - started >= startup_grace:
+                        break
+        finally:
+            self.shutdown()
+            self.server_close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # The socket's permissions should already keep other users out,
+        # but check the peer's credentials too
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            logger.warning("Rejected agent connection from uid {}".format(uid))
+            return
+
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line.decode("utf-8"))
+            response = self.server.dispatch(request)
+        except (ValueError, KeyError, TypeError) as e:
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+class KeyAgentClient:
+    """Talks to a running KeyAgent
+
+    Keys are passed in and returned as bytes. get() returns None if the agent
+    doesn't have the key or isn't running.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_socket_path()
+
+    def _request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline().decode("utf-8"))
+        if not response.get("ok"):
+            raise IOError("Key agent error: {}".format(response.get("error")))
+        return response
+
+    def is_running(self):
+        try:
+            self._request({"op": "get", "name": ""})
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def get(self, name):
+        try:
+            key = self._request({"op": "get", "name": name})['key']
+        except (OSError, ValueError):
+            return None
+        if key is None:
+            return None
+        return bytes.fromhex(key)
+
+    def put(self, name, key, lifetime):
+        self._request({"op": "put", "name": name, "key": key.hex(),
+                       "lifetime": lifetime})
+
+    def forget(self, name=None):
+        try:
+            self._request({"op": "forget", "name": name})
+        except (OSError, ValueError):
+            pass
+
+    def start(self):
+        """Starts an agent process in the background if one isn't running"""
+        if self.is_running():
+            return
+        subprocess.Popen(
+            [sys.executable, "-m", "backathon.keyagent", self.path],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + 5
+        while not self.is_running():
+            if time.monotonic() > deadline:
+                raise IOError("Key agent did not start")
+            time.sleep(0.05)
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else default_socket_path()
+    agent = KeyAgent(path)
+    agent.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Maintains the local manifest of files in the remote repository
+
+Every upload through the Repository records the file in the RemoteFile
+table along with the metadata the storage backend returned. Since the
+manifest is only as good as the uploads that went through this cache,
+reconcile() brings it in line with the actual remote listing. Listings can
+be very long and costly (one B2 class C transaction per thousand names), so
+reconciliation proceeds in pages and saves a checkpoint after each one. An
+interrupted or page-limited run resumes from its checkpoint the next time.
+"""
+import collections
+import itertools
+from logging import getLogger
+
+from . import models
+from .util import atomic_immediate
+
+logger = getLogger("backathon.manifest")
+
+# Number of names listed and compared per transaction. This matches the
+# number of names returned by one b2_list_file_names call.
+PAGE_SIZE = 1000
+
+def _from_metadata(name, metadata):
+    sha1 = metadata.get('contentSha1')
+    if sha1 == "none":
+        # B2 has no whole-file SHA-1 for large files
+        sha1 = None
+    size = metadata.get('contentLength')
+    return models.RemoteFile(
+        name=name,
+        file_id=metadata.get('fileId'),
+        size=None if size is None else int(size),
+        sha1=sha1,
+    )
+
+def record_upload(repo, name, metadata):
+    """Records a file uploaded to the remote storage
+
+    :param metadata: The dict returned from the storage's upload_file()
+    """
+    _from_metadata(name, metadata).save(using=repo.db)
+
+def record_delete(repo, name):
+    """Records a file deleted from the remote storage"""
+    models.RemoteFile.objects.using(repo.db).filter(name=name).delete()
+
+def reconcile(repo, prefix="", max_pages=None):
+    """Updates the manifest to match the remote storage's listing of files
+    with the given prefix
+
+    Files missing from the manifest are added, files no longer in the
+    listing are removed, and metadata that differs is updated.
+
+    :param max_pages: If given, stop after this many pages of PAGE_SIZE
+        names. The next call resumes where this one stopped.
+    :returns: A (stats, complete) tuple. stats counts the names added,
+        updated and removed, and complete is True if the listing was read to
+        the end.
+    """
+    manifest = models.RemoteFile.objects.using(repo.db)
+
+    checkpoint = repo.settings.get('MANIFEST_CHECKPOINT', "null")
+    if checkpoint is not None and checkpoint['prefix'] == prefix:
+        last = checkpoint['last']
+        logger.info("Resuming manifest reconciliation after {}".format(last))
+    else:
+        last = None
+
+    start = last
+    listing = (
+        metadata for metadata in
+        repo.storage.get_files_by_prefix(prefix, start_name=start)
+        # B2's start name is inclusive, but the name at the checkpoint has
+        # already been processed
+        if start is None or metadata['fileName'] > start
+    )
+
+    stats = collections.Counter()
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        page = list(itertools.islice(listing, PAGE_SIZE))
+
+        range_qs = manifest.filter(name__startswith=prefix)
+        if last is not None:
+            range_qs = range_qs.filter(name__gt=last)
+
+        if not page:
+            # Reached the end of the listing. Anything left in the manifest
+            # past the last listed name no longer exists.
+            with atomic_immediate(using=repo.db):
+                stats['removed'] += range_qs.delete()[0]
+                models.Setting.objects.using(repo.db).filter(
+                    key='MANIFEST_CHECKPOINT').delete()
+            return stats, True
+
+        page_last = page[-1]['fileName']
+        with atomic_immediate(using=repo.db):
+            existing = {
+                f.name: f for f in range_qs.filter(name__lte=page_last)
+            }
+            to_create = []
+            for metadata in page:
+                listed = _from_metadata(metadata['fileName'], metadata)
+                try:
+                    current = existing.pop(listed.name)
+                except KeyError:
+                    to_create.append(listed)
+                    continue
+                # Keep what the manifest knows that the listing doesn't say
+                changed = False
+                for field in ("file_id", "size", "sha1"):
+                    value = getattr(listed, field)
+                    if value is not None and value != getattr(current, field):
+                        setattr(current, field, value)
+                        changed = True
+                if changed:
+                    current.save(using=repo.db)
+                    stats['updated'] += 1
+
+            manifest.bulk_create(to_create)
+            stats['added'] += len(to_create)
+
+            # Names in this range of the manifest that weren't listed
+            stale = list(existing)
+            for i in range(0, len(stale), 500):
+                manifest.filter(name__in=stale[i:i+500]).delete()
+            stats['removed'] += len(stale)
+
+            repo.settings['MANIFEST_CHECKPOINT'] = {
+                'prefix': prefix,
+                'last': page_last,
+            }
+
+        last = page_last
+        pages += 1
+
+    return stats, False
+
+def missing_objects(repo):
+    """Yields the IDs of objects in the local cache that aren't in the
+    manifest
+
+    This is the manifest's view of the remote repository, so reconcile it
+    first for an up to date answer.
+    """
+    objids = models.Object.objects.using(repo.db)\
+        .values_list("objid", flat=True)\
+        .iterator()
+    while True:
+        batch = [bytes(objid) for objid in itertools.islice(objids, 500)]
+        if not batch:
+            return
+        names = {repo._get_path(objid): objid for objid in batch}
+        present = set(
+            models.RemoteFile.objects.using(repo.db)
+            .filter(name__in=list(names))
+            .values_list("name", flat=True)
+        )
+        for name, objid in names.items():
+            if name not in present:
+                yield objid
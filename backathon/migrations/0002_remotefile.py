@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backathon', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RemoteFile',
+            fields=[
+                ('name', models.TextField(primary_key=True, serialize=False)),
+                ('file_id', models.TextField(blank=True, help_text='Backend specific identifier for the file, if any', null=True)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('sha1', models.CharField(blank=True, help_text='Hex SHA-1 of the file contents, if the backend provides it', max_length=40, null=True)),
+            ],
+            options={
+                'db_table': 'remote_files',
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backathon', '0002_remotefile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='object',
+            name='payload',
+            field=models.BinaryField(blank=True, help_text='For tree and inode objects, the zlib compressed payload', null=True),
+        ),
+    ]
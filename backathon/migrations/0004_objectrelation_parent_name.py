@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backathon', '0003_object_payload'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='objectrelation',
+            index=models.Index(fields=['parent', 'name'], name='object_rela_parent__ac1451_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backathon', '0004_objectrelation_parent_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingDelete',
+            fields=[
+                ('name', models.TextField(primary_key=True, serialize=False)),
+            ],
+            options={
+                'db_table': 'pending_deletes',
+            },
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='name',
+            field=models.TextField(blank=True, help_text="Name of this snapshot's file in the remote repository", null=True),
+        ),
+    ]
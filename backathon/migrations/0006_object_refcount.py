@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backathon', '0005_pendingdelete_snapshot_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='object',
+            name='refcount',
+            field=models.PositiveIntegerField(default=0, help_text='Number of ObjectRelation and Snapshot rows referencing this object'),
+        ),
+        # Count the references of objects already in the cache
+        migrations.RunSQL(
+            """
+            UPDATE objects SET refcount =
+                (SELECT COUNT(*) FROM object_relations
+                 WHERE child_id=objects.objid)
+                + (SELECT COUNT(*) FROM snapshots
+                   WHERE root_id=objects.objid)
+            """,
+            migrations.RunSQL.noop,
+        ),
+        # Only unreferenced objects are indexed. See Object.unreferenced()
+        migrations.RunSQL(
+            "CREATE INDEX objects_unreferenced_idx ON objects(refcount) "
+            "WHERE refcount=0",
+            "DROP INDEX objects_unreferenced_idx",
+        ),
+    ]
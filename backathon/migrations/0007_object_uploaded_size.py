@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backathon', '0006_object_refcount'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='object',
+            name='uploaded_size',
+            field=models.PositiveIntegerField(blank=True, help_text="Size in bytes of the object's file in the remote storage, after compression and encryption. Objects pushed by older versions recorded the size before compression and encryption instead.", null=True),
+        ),
+    ]
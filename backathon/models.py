@@ -1,11 +1,11 @@
+import collections
 import os
 import os.path
 import stat
 import logging
-import math
-import random
 
 from django.db import models, IntegrityError
+from django.db.models import F
 from django.db.transaction import atomic
 from django.db import connections
 
@@ -23,16 +23,25 @@ class Object(models.Model):
 
     The payload field is only filled in for tree and inode object types. Blob
     types are not stored locally. In other words, we only cache metadata type
-    objects locally.
+    objects locally. Payloads are stored zlib compressed.
 
     The children relation is used in the calculation of garbage objects. If
     an object depends on another in any way, it is added as a "child". Then,
     when a root object is deleted, a set of unreachable garbage objects can
     be calculated.
+
+    Each object also keeps a count of the relations and snapshots that
+    reference it, updated as they're saved and deleted. Objects whose count
+    is zero are garbage, and are found through a partial index without
+    walking the object graph. See add_references() and check_refcounts().
     """
 
     class Meta:
         db_table = "objects"
+        # Migration 0006 also creates a partial index over refcount=0, so
+        # finding garbage costs time proportional to the amount of garbage.
+        # It's created with raw SQL since the ORM can't declare partial
+        # indexes before Django 2.2.
 
     # This is the binary representation of the hash of the payload.
     # To get the int representation, you can use int.from_bytes(objid, 'little')
@@ -58,8 +67,10 @@ class Object(models.Model):
     uploaded_size = models.PositiveIntegerField(
         blank=True,
         null=True,
-        help_text="Size of the uploaded payload, after compression and "
-                  "encryption",
+        help_text="Size in bytes of the object's file in the remote "
+                  "storage, after compression and encryption. Objects "
+                  "pushed by older versions recorded the size before "
+                  "compression and encryption instead.",
     )
     file_size = models.PositiveIntegerField(
         blank=True, null=True,
@@ -69,6 +80,15 @@ class Object(models.Model):
         blank=True, null=True,
         help_text="For inode and tree objects, this is the last modified time",
     )
+    payload = models.BinaryField(
+        blank=True, null=True,
+        help_text="For tree and inode objects, the zlib compressed payload",
+    )
+    refcount = models.PositiveIntegerField(
+        default=0,
+        help_text="Number of ObjectRelation and Snapshot rows referencing "
+                  "this object",
+    )
 
     def __repr__(self):
         return "<Object {}>".format(self.objid.hex())
@@ -76,6 +96,68 @@ class Object(models.Model):
     def __str__(self):
         return self.objid.hex()
 
+    @classmethod
+    def add_references(cls, using, objids, delta=1):
+        """Adds delta to the reference counts of the given objects
+
+        An object ID given more than once is adjusted once for each time it's
+        given. Call this in the same transaction that saves or deletes the
+        referencing rows.
+        """
+        by_count = collections.defaultdict(list)
+        for objid, count in collections.Counter(
+                bytes(objid) for objid in objids).items():
+            by_count[count].append(objid)
+
+        for count, group in by_count.items():
+            # Keep each query under SQLite's limit of 999 parameters
+            for i in range(0, len(group), 500):
+                cls.objects.using(using)\
+                    .filter(objid__in=group[i:i+500])\
+                    .update(refcount=F("refcount") + count * delta)
+
+    @classmethod
+    def unreferenced(cls, using):
+        """Returns a queryset of objects no relation or snapshot references
+
+        Besides garbage, this includes objects uploaded by a backup that
+        hasn't finished, since objects are pushed before their parents.
+        """
+        return cls.objects.using(using).filter(refcount=0)
+
+    @classmethod
+    def check_refcounts(cls, using, repair=False):
+        """Recounts every object's references from scratch
+
+        Returns a list of (objid, recorded count, actual count) tuples for
+        objects whose recorded count is wrong. If repair is True, the
+        recorded counts are corrected.
+
+        This reads the whole Object table, so it's meant as an occasional
+        consistency check, not part of routine pruning.
+        """
+        query = """
+        SELECT objid, refcount, actual FROM (
+            SELECT objid, refcount,
+                (SELECT COUNT(*) FROM object_relations
+                 WHERE child_id=objects.objid)
+                + (SELECT COUNT(*) FROM snapshots
+                   WHERE root_id=objects.objid) AS actual
+            FROM objects
+        ) WHERE refcount != actual
+        """
+        with connections[using].cursor() as c:
+            c.execute(query)
+            wrong = [(bytes(objid), recorded, actual)
+                     for objid, recorded, actual in c]
+
+        if repair and wrong:
+            with atomic_immediate(using=using):
+                for objid, _, actual in wrong:
+                    cls.objects.using(using).filter(objid=objid)\
+                        .update(refcount=actual)
+        return wrong
+
     @classmethod
     def collect_garbage(cls, using):
         """Yields garbage objects from the Object table.
@@ -87,85 +169,59 @@ class Object(models.Model):
         try to reference that object. Leaving an un-referenced object on the
         backing store doesn't hurt anything except by taking up space.
 
-        """
-        # The approach implemented below is to construct a simple bloom filter
-        # such that we collect about 95% of all garbage objects.
-
-        # This approach was chosen because it should be quick (2 passes over
-        # the database, where the first pass is read-only) and memory
-        # efficient (uses about 760k for a million objects in the table)
+        The yielded objects are loaded without their payloads.
 
-        # One alternative is to perform a query for objects with no
-        # references, which is quick due to indices on the
-        # object_relations table, but requires many queries in a loop
-        # to collect all garbage. It's theoretically possible to do this with
-        # a single recursive query, but that requires holding the entire
-        # garbage set in memory, which could get big.
+        """
+        # Every object not reachable from a snapshot is garbage.
+        # REACHABLE_QUERY walks the hierarchy, and SQLite tests each object
+        # against the reachable set itself: it keeps the reachable IDs in a
+        # temporary index, which spills to a temporary file if it gets big,
+        # and only the IDs of garbage objects come back to Python. This
+        # collects all the garbage in a single read-only query.
 
         # Another approach is a traditional garbage collection strategy such as
         # mark-and-sweep. Problem with that is it would involve writing each
         # row on the first pass, which is a lot more IO and would probably be
         # slower.
 
-        num_objects = cls.objects.using(using).all().count()
-
-        # m - number of bits in the filter. Depends on num_objects
-        # k - number of hash functions needed. Should be 4 for p=0.05
-        p = 0.05
-        m = int(math.ceil((num_objects * math.log(p)) / math.log(1 / math.pow(
-            2, math.log(2)))))
-        k = int(round(math.log(2) * m / num_objects))
-
-        arr_size = int(math.ceil(m/8))
-        bloom = bytearray(arr_size)
-
-        # The "hash" functions will just be a random number that will be
-        # xor'd with the object IDs. Using a different random int each time
-        # also guards against false positives from collisions happening from
-        # the same two objects each run.
-        r = random.SystemRandom()
-        hashes = [r.getrandbits(256) for _ in range(k)]
-
-        # This query iterates over all the reachable objects by walking the
-        # hierarchy formed using the Snapshot table as the roots and
-        # traversing the links in the ManyToMany relation.
-        query = """
-        WITH RECURSIVE reachable(id) AS (
-            SELECT root_id FROM snapshots
-            UNION ALL
-            SELECT child_id FROM object_relations
-            INNER JOIN reachable ON reachable.id=parent_id
-        ) SELECT id FROM reachable
-        """
         with connections[using].cursor() as c:
-            c.execute(query)
-            for row in c:
-                objid_int = int.from_bytes(row[0], 'little')
-
-                for h in hashes:
-                    h ^= objid_int
-                    h %= m
-                    bytepos, bitpos = divmod(h, 8)
-                    bloom[bytepos] |= 1 << bitpos
-
-        def hash_match(h, objid):
-            h ^= objid
-            h %= m
-            bytepos, bitpos = divmod(h, 8)
-            return bloom[bytepos] & (1 << bitpos)
-
-        # Now we can iterate over all objects. If an object does not appear
-        # in the bloom filter, we can guarantee it's not reachable.
-        for obj in cls.objects.using(using).all().iterator():
-            objid = int.from_bytes(obj.objid, 'little')
-
-            if not all(hash_match(h, objid) for h in hashes):
-                yield obj
+            c.execute("SELECT objid FROM objects WHERE objid NOT IN "
+                      "({})".format(REACHABLE_QUERY))
+            for rows in iter(lambda: c.fetchmany(GC_BATCH_SIZE), []):
+                garbage = [objid for objid, in rows]
+
+                # Only garbage objects are loaded as model instances
+                for i in range(0, len(garbage), 500):
+                    yield from cls.objects.using(using)\
+                        .filter(objid__in=garbage[i:i+500])\
+                        .defer("payload")
+
+# This query iterates over all the reachable objects by walking the
+# hierarchy formed using the Snapshot table as the roots and traversing the
+# links in the ManyToMany relation. UNION (rather than UNION ALL) discards
+# objects already visited, so a subtree shared by many snapshots is only
+# walked once instead of once per snapshot, and each reachable object is
+# yielded once. SQLite keeps a temporary index of the visited IDs to do that.
+REACHABLE_QUERY = """
+WITH RECURSIVE reachable(id) AS (
+    SELECT root_id FROM snapshots
+    UNION
+    SELECT child_id FROM object_relations
+    INNER JOIN reachable ON reachable.id=parent_id
+) SELECT id FROM reachable
+"""
+
+# Number of garbage object IDs fetched at once by Object.collect_garbage()
+GC_BATCH_SIZE = 10000
 
 class ObjectRelation(models.Model):
     """Keeps track of the dependency graph between objects"""
     class Meta:
         db_table = "object_relations"
+        indexes = [
+            # For looking up directory entries by name when browsing
+            models.Index(fields=["parent", "name"]),
+        ]
 
     parent = models.ForeignKey(
         "Object",
@@ -413,6 +469,10 @@ class Snapshot(models.Model):
         on_delete=models.PROTECT,
     )
     date = models.DateTimeField(db_index=True)
+    name = models.TextField(
+        blank=True, null=True,
+        help_text="Name of this snapshot's file in the remote repository",
+    )
 
     @property
     def printablepath(self):
@@ -422,6 +482,50 @@ class Snapshot(models.Model):
         bytepath = os.fsencode(self.path)
         return bytepath.decode("utf-8", errors="replace")
 
+class RemoteFile(models.Model):
+    """A local manifest of the files in the remote repository
+
+    A row is recorded for each file uploaded, with the metadata the storage
+    backend returned. Operations that need to know what exists remotely
+    consult this table instead of listing the remote storage, which for B2
+    costs a class C transaction per thousand names. See manifest.py for how
+    it's kept in sync with the remote listing.
+    """
+    class Meta:
+        db_table = "remote_files"
+
+    name = models.TextField(primary_key=True)
+    file_id = models.TextField(
+        blank=True, null=True,
+        help_text="Backend specific identifier for the file, if any",
+    )
+    size = models.BigIntegerField(blank=True, null=True)
+    sha1 = models.CharField(
+        max_length=40,
+        blank=True, null=True,
+        help_text="Hex SHA-1 of the file contents, if the backend provides "
+                  "it",
+    )
+
+    def __str__(self):
+        return self.name
+
+class PendingDelete(models.Model):
+    """Files waiting to be deleted from the remote repository
+
+    Pruning deletes snapshot and object rows and queues their files here in
+    the same transaction, then deletes the files. A queue entry is removed
+    once its file is deleted, so files left by an interrupted prune are
+    deleted by the next one. See prune.py.
+    """
+    class Meta:
+        db_table = "pending_deletes"
+
+    name = models.TextField(primary_key=True)
+
+    def __str__(self):
+        return self.name
+
 class Setting(models.Model):
     """Configuration table for settings set at runtime"""
     class Meta:
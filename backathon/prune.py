@@ -0,0 +1,298 @@
+"""
+Removes old snapshots and the objects only they referenced
+
+Pruning happens in three steps:
+
+1. Expired snapshots are deleted from the Snapshot table, and their files
+   are queued in the PendingDelete table in the same transaction. The
+   reference counts of their root objects are decremented.
+2. Objects whose reference count is zero are deleted in batches of
+   BATCH_SIZE, each batch in its own short transaction that also queues
+   their files and decrements the counts of their children. Children whose
+   count reaches zero are picked up by a later batch, so the work done is
+   proportional to the amount of garbage, not the size of the repository.
+3. Queued files are deleted from the remote storage by a pool of threads,
+   since each delete is a round trip to the storage backend (one
+   b2_hide_file call for B2). As deletes finish, their queue entries and
+   manifest rows are removed, again in batches.
+
+Steps 2 and 3 overlap: each batch of objects is handed to the delete threads
+as soon as its transaction commits.
+
+Rows are always deleted before their files. If a row remained whose file was
+gone, a later backup could reference the missing object and corrupt the
+repository, while a file whose row is gone only takes up space. The queue
+makes sure such files are still deleted: entries left by an interrupted
+prune are picked up by the next one.
+
+A full prune additionally sweeps the whole Object table with
+Object.collect_garbage(), which finds unreachable objects without relying on
+the reference counts. It's a fallback in case the counts are ever wrong, so
+it then repairs the counts with Object.check_refcounts() before step 2
+deletes anything by its count.
+
+Prune must not run at the same time as a backup. Objects uploaded by a
+backup in progress aren't referenced by anything until the backup
+finishes, so they would be collected as garbage.
+"""
+import collections
+import concurrent.futures
+import datetime
+from logging import getLogger
+
+from django.db import connections
+
+from . import models
+from .util import atomic_immediate
+
+logger = getLogger("backathon.prune")
+
+# Number of rows deleted per transaction. SQLite limits a query to 999
+# parameters, and a batch is used in a single IN clause.
+BATCH_SIZE = 500
+
+# Retention periods, from shortest to longest. Each maps a UTC datetime to a
+# key that is the same for all times within one period.
+PERIODS = collections.OrderedDict([
+    ("hourly", lambda d: (d.year, d.month, d.day, d.hour)),
+    ("daily", lambda d: d.date()),
+    ("weekly", lambda d: d.isocalendar()[:2]),
+    ("monthly", lambda d: (d.year, d.month)),
+])
+
+def select_expired(snapshots, keep_last=0, keep_hourly=0, keep_daily=0,
+                   keep_weekly=0, keep_monthly=0):
+    """Returns the snapshots that no retention rule keeps
+
+    Rules are applied separately to the snapshots of each backup root path.
+    keep_last keeps that many of the most recent snapshots. The periodic
+    rules keep the most recent snapshot in each of that many of the most
+    recent hours, days, ISO weeks or months that have a snapshot. Periods
+    are computed in UTC. A snapshot kept by any rule is kept.
+
+    :param snapshots: An iterable of models.Snapshot
+    :returns: A list of the expired snapshots, oldest first
+    :raises ValueError: if no rule is given, which would expire everything
+    """
+    counts = {
+        "hourly": keep_hourly,
+        "daily": keep_daily,
+        "weekly": keep_weekly,
+        "monthly": keep_monthly,
+    }
+    if keep_last <= 0 and not any(n > 0 for n in counts.values()):
+        raise ValueError("At least one retention rule is required")
+
+    by_path = collections.defaultdict(list)
+    for snapshot in snapshots:
+        by_path[snapshot.path].append(snapshot)
+
+    expired = []
+    for path_snapshots in by_path.values():
+        path_snapshots.sort(key=lambda s: s.date, reverse=True)
+        keep = set(s.id for s in path_snapshots[:keep_last])
+
+        for period, key_func in PERIODS.items():
+            remaining = counts[period]
+            last_key = None
+            for snapshot in path_snapshots:
+                if remaining <= 0:
+                    break
+                key = key_func(snapshot.date.astimezone(datetime.timezone.utc))
+                if key != last_key:
+                    # The newest snapshot of a period is seen first
+                    keep.add(snapshot.id)
+                    last_key = key
+                    remaining -= 1
+
+        expired.extend(s for s in path_snapshots if s.id not in keep)
+
+    expired.sort(key=lambda s: s.date)
+    return expired
+
+def prune(repo, expired, progress=None, full=False):
+    """Deletes the given snapshots and all objects no longer referenced by
+    any remaining snapshot, along with their files in the remote storage
+
+    :param expired: Snapshots to delete, e.g. from select_expired()
+    :param progress: If given, called as progress(deleted, queued) as files
+        are deleted from the remote storage
+    :param full: Also sweep the whole Object table for unreachable objects
+        with Object.collect_garbage(), and repair the reference counts
+    :returns: A Counter of snapshots and objects deleted from the local
+        cache, files deleted from the remote storage, and files that failed
+        to delete. Failed files stay queued and are retried by the next
+        prune.
+    """
+    stats = collections.Counter()
+
+    with atomic_immediate(using=repo.db):
+        names = []
+        for snapshot in expired:
+            if snapshot.name is None:
+                logger.warning("Snapshot {} has no recorded file name. Its "
+                               "file won't be deleted".format(snapshot.id))
+            else:
+                names.append(snapshot.name)
+        models.Snapshot.objects.using(repo.db)\
+            .filter(id__in=[s.id for s in expired])\
+            .delete()
+        models.Object.add_references(repo.db,
+                                     [s.root_id for s in expired], -1)
+        _queue(repo, names)
+    stats['snapshots'] = len(expired)
+
+    repo.storage.set_concurrency(repo.prune_concurrency)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=repo.prune_concurrency) as executor:
+        deleter = _Deleter(repo, executor, stats, progress)
+
+        # Includes the snapshot files queued above, and any files left
+        # queued by an earlier prune
+        deleter.submit(list(
+            models.PendingDelete.objects.using(repo.db)
+            .values_list("name", flat=True)
+        ))
+
+        if full:
+            # Collect the garbage up front. Rows can't be deleted from the
+            # Object table while collect_garbage() is still iterating over
+            # it. Objects this leaves unreferenced are deleted below.
+            garbage = [bytes(obj.objid) for obj in
+                       models.Object.collect_garbage(repo.db)]
+            logger.info("Full sweep found {} garbage objects".format(
+                len(garbage)))
+            for i in range(0, len(garbage), BATCH_SIZE):
+                with atomic_immediate(using=repo.db):
+                    names = _delete_objects(repo, garbage[i:i+BATCH_SIZE])
+                stats['objects'] += len(names)
+                deleter.submit(names)
+
+            # Don't trust the counts below if they've gone wrong. A live
+            # object with a count of zero would be deleted.
+            wrong = models.Object.check_refcounts(repo.db, repair=True)
+            if wrong:
+                logger.warning("Repaired the reference counts of {} "
+                               "objects".format(len(wrong)))
+
+        unreferenced = models.Object.unreferenced(repo.db)\
+            .values_list("objid", flat=True)
+        while True:
+            with atomic_immediate(using=repo.db):
+                batch = [bytes(objid) for objid in unreferenced[:BATCH_SIZE]]
+                if not batch:
+                    break
+                names = _delete_objects(repo, batch)
+            stats['objects'] += len(batch)
+            deleter.submit(names)
+
+        deleter.finish()
+
+    return stats
+
+def _queue(repo, names):
+    # A name may already be queued by an earlier prune that was interrupted
+    with connections[repo.db].cursor() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO pending_deletes (name) VALUES (?)",
+            [(name,) for name in names],
+        )
+
+def _delete_objects(repo, objids):
+    """Deletes the given objects, which must be unreferenced or unreachable,
+    and queues their files
+
+    Must be called in a transaction. Returns the queued file names.
+    """
+    objids = list(
+        models.Object.objects.using(repo.db)
+        .filter(objid__in=objids)
+        .values_list("objid", flat=True)
+    )
+    children = models.ObjectRelation.objects.using(repo.db)\
+        .filter(parent_id__in=objids)\
+        .values_list("child_id", flat=True)
+    models.Object.add_references(repo.db, list(children), -1)
+
+    # This also deletes the objects' relations and clears references from
+    # FSEntry rows, so those files are backed up again. Payloads aren't
+    # needed to do that.
+    models.Object.objects.using(repo.db)\
+        .filter(objid__in=objids)\
+        .only("objid")\
+        .delete()
+
+    names = [repo._get_path(bytes(objid)) for objid in objids]
+    _queue(repo, names)
+    return names
+
+def _delete_file(storage, name):
+    try:
+        storage.delete(name)
+    except FileNotFoundError:
+        # Already gone, e.g. deleted by a prune that was interrupted before
+        # it could remove the queue entry
+        pass
+
+class _Deleter:
+    """Deletes files from the remote storage in a thread pool
+
+    Database writes stay in the calling thread. Finished deletes are
+    collected whenever the number in flight reaches a limit, and their queue
+    entries are removed in batches.
+    """
+    def __init__(self, repo, executor, stats, progress):
+        self.repo = repo
+        self.executor = executor
+        self.stats = stats
+        self.progress = progress
+        # Enough to keep every worker busy between collections without
+        # holding a future for every queued file
+        self.max_in_flight = repo.prune_concurrency * 4
+        self.in_flight = {}
+        self.deleted = []
+        self.queued = 0
+
+    def submit(self, names):
+        for name in names:
+            while len(self.in_flight) >= self.max_in_flight:
+                self._collect(concurrent.futures.FIRST_COMPLETED)
+            future = self.executor.submit(_delete_file, self.repo.storage,
+                                          name)
+            self.in_flight[future] = name
+            self.queued += 1
+
+    def finish(self):
+        while self.in_flight:
+            self._collect(concurrent.futures.ALL_COMPLETED)
+        self._flush()
+
+    def _collect(self, return_when):
+        done, _ = concurrent.futures.wait(self.in_flight,
+                                          return_when=return_when)
+        for future in done:
+            name = self.in_flight.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                # Left in the queue for the next prune to retry
+                logger.warning("Failed to delete {}: {}".format(name, e))
+                self.stats['failed'] += 1
+            else:
+                self.deleted.append(name)
+                self.stats['files'] += 1
+
+        if len(self.deleted) >= BATCH_SIZE:
+            self._flush()
+        if self.progress is not None:
+            self.progress(self.stats['files'], self.queued)
+
+    def _flush(self):
+        while self.deleted:
+            batch = self.deleted[:BATCH_SIZE]
+            del self.deleted[:BATCH_SIZE]
+            with atomic_immediate(using=self.repo.db):
+                models.PendingDelete.objects.using(self.repo.db)\
+                    .filter(name__in=batch).delete()
+                models.RemoteFile.objects.using(self.repo.db)\
+                    .filter(name__in=batch).delete()
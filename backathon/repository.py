@@ -1,5 +1,7 @@
+import asyncio
 import io
 import uuid
+import hashlib
 import hmac
 import json
 import os.path
@@ -16,12 +18,21 @@ import umsgpack
 from .util import atomic_immediate
 from . import models
 from . import util
+from . import aiostorage
 from .exceptions import CorruptedRepository
 from . import encryption
+from . import keyagent
+from . import manifest
 from . import storage
 
+# Ends the cached payload of an inode whose inline file contents were
+# removed, in place of ("immediate", contents)
+STRIPPED_CONTENTS = umsgpack.packb(("immediate", None))
+
 
 class KeyRequired(Exception):
+    """Raised when a decryption key is needed but no password was given
+    and the key agent doesn't have the key"""
     pass
 
 
@@ -137,6 +148,57 @@ class Repository:
     # Good values for this probably range from between 1 and 10 megabytes.
     backup_inline_threshold = SimpleSetting("BACKUP_INLINE_THRESHOLD", 2 ** 21)
 
+    # Files larger than this are split into ranges of about this many bytes
+    # (rounded down to a multiple of the chunk size), and the ranges are
+    # read, hashed, and uploaded in parallel. Smaller files are processed
+    # serially by a single worker.
+    backup_range_size = SimpleSetting("BACKUP_RANGE_SIZE", 2 ** 26)
+
+    # Number of worker threads available for processing file ranges in
+    # parallel. With one worker, large files are processed serially.
+    backup_concurrency = SimpleSetting("BACKUP_CONCURRENCY", 4)
+
+    # Limits how many bytes of file data backup workers may hold in memory
+    # at once. Workers block before reading more data once this is
+    # exhausted, so memory usage doesn't grow with the concurrency or the
+    # size of the backup set. Compression and encryption make temporary
+    # copies of each payload, so actual memory use is a small multiple of
+    # this.
+    backup_memory_limit = SimpleSetting("BACKUP_MEMORY_LIMIT", 2 ** 28)
+
+    # Number of objects downloaded and decrypted at once during a restore
+    # in the "threads" I/O mode. With 1, the tree is restored one object at
+    # a time.
+    restore_concurrency = SimpleSetting("RESTORE_CONCURRENCY", 8)
+
+    # Blobs used more than once in the tree being restored are kept in
+    # memory, up to this many bytes, until their last use, so each is
+    # downloaded once
+    restore_cache_size = SimpleSetting("RESTORE_CACHE_SIZE", 2 ** 28)
+
+    # Number of files deleted from the remote repository at once when
+    # pruning
+    prune_concurrency = SimpleSetting("PRUNE_CONCURRENCY", 16)
+
+    # Number of seconds the key agent holds this repository's decryption key
+    # after it is unlocked
+    key_agent_lifetime = SimpleSetting("KEY_AGENT_LIFETIME", 900)
+
+    # How the backup and restore drivers move object data. "threads" uses
+    # pools of backup_concurrency and restore_concurrency workers. "asyncio"
+    # drives the transfers for each large file being backed up, and for
+    # the whole restore, from an event loop, with up to async_max_in_flight
+    # requests outstanding at once. This helps when each request has high
+    # latency, as with remote storage. The requests themselves still run in
+    # a pool of async_max_in_flight threads (see aiostorage.ExecutorAdapter).
+    io_mode = SimpleSetting("IO_MODE", "threads")
+    async_max_in_flight = SimpleSetting("ASYNC_MAX_IN_FLIGHT", 64)
+
+    @cached_property
+    def memory_budget(self):
+        # Replaced at the start of each backup
+        return util.MemoryBudget(self.backup_memory_limit)
+
     @cached_property
     def encrypter(self):
         data = self.settings['ENCRYPTION_SETTINGS']
@@ -144,9 +206,12 @@ class Repository:
         settings = data['settings']
 
         cls = {"none": encryption.NullEncryption,
-               "nacl": encryption.NaclSealedBox, }[cls_name]
+               "nacl": encryption.NaclSealedBox,
+               "hybrid": encryption.NaclHybridBox, }[cls_name]
 
-        return cls.init_from_private(settings)
+        encrypter = cls.init_from_private(settings)
+        self._init_encrypter(encrypter)
+        return encrypter
 
     def set_encrypter(self, encrypter):
         """Sets this repo's encrypter instance
@@ -156,13 +221,87 @@ class Repository:
         :type encrypter: encryption.BaseEncryption
         """
         cls_name = {encryption.NullEncryption: "none",
-                    encryption.NaclSealedBox: "nacl", }[type(encrypter)]
+                    encryption.NaclSealedBox: "nacl",
+                    encryption.NaclHybridBox: "hybrid", }[type(encrypter)]
         settings = encrypter.get_private_params()
 
         self.settings['ENCRYPTION_SETTINGS'] = {'class': cls_name,
                                                 'settings': settings, }
+        self._init_encrypter(encrypter)
         self.__dict__["encrypter"] = encrypter
 
+    def _init_encrypter(self, encrypter):
+        """Configures the encrypter with repository level settings, and
+        connects its session key callbacks if it has them"""
+        encrypter.objid_hash = self.objid_hash
+        if isinstance(encrypter, encryption.NaclHybridBox):
+            encrypter.on_new_key = self._save_session_key
+            encrypter.key_loader = self._load_session_key
+
+    def _save_session_key(self, keyid, sealed_key):
+        """Saves a newly generated sealed session key
+
+        Called by the encrypter before it encrypts anything with a new
+        session key. The sealed key is uploaded to the repository so it can
+        be recovered with just the password, and saved locally along with
+        the rest of the encryption settings.
+        """
+        self._upload_file(
+            "keys/{}".format(keyid.hex()),
+            util.BytesReader(sealed_key),
+        )
+        # The encrypter adds the key to its own list after this returns
+        params = self.encrypter.get_private_params()
+        params['session_keys'][keyid.hex()] = sealed_key.hex()
+        data = self.settings['ENCRYPTION_SETTINGS']
+        data['settings'] = params
+        self.settings['ENCRYPTION_SETTINGS'] = data
+
+    def _load_session_key(self, keyid):
+        """Downloads a sealed session key that isn't in the local cache"""
+        _, file = self.storage.download_file("keys/{}".format(keyid.hex()))
+        with file:
+            return file.read()
+
+    @cached_property
+    def objid_hash(self):
+        # Repositories created before this setting existed use sha256
+        return self.settings.get('OBJID_HASH', json.dumps("sha256"))
+
+    def set_objid_hash(self, objid_hash):
+        """Sets the hash function used to calculate object IDs
+
+        See encryption.OBJID_HASHES for the choices. This is recorded in the
+        repository metadata.
+
+        If the local cache already has objects, the cache is converted:
+        the old hash function is remembered so existing objects can still
+        be verified, and every entry in the backup set is marked dirty so
+        the next backup pushes it again under its new object ID. Since
+        objects are stored by ID, the next backup re-uploads the entire
+        backup set. Objects with old IDs are cleaned up once the snapshots
+        that reference them are pruned.
+        """
+        if objid_hash not in encryption.OBJID_HASHES:
+            raise ValueError("Unknown objid hash {}".format(objid_hash))
+
+        old_hash = self.objid_hash
+        if objid_hash == old_hash:
+            return
+
+        with atomic_immediate(using=self.db):
+            if models.Object.objects.using(self.db).exists():
+                history = self.settings.get('OBJID_HASH_HISTORY', "[]")
+                if old_hash not in history:
+                    history.append(old_hash)
+                self.settings['OBJID_HASH_HISTORY'] = history
+                models.FSEntry.objects.using(self.db).update(obj=None)
+            self.settings['OBJID_HASH'] = objid_hash
+
+        self.__dict__['objid_hash'] = objid_hash
+        if "encrypter" in self.__dict__:
+            self.encrypter.objid_hash = objid_hash
+
     @cached_property
     def compression(self):
         try:
@@ -184,20 +323,41 @@ class Repository:
         settings = data['settings']
 
         if cls_name == "local":
-            cls = storage.FilesystemStorage
+            return storage.FilesystemStorage(**settings)
         elif cls_name == "b2":
             from .b2 import B2Bucket
-            cls = B2Bucket
+            bucket = B2Bucket(**settings)
+            bucket.auth_loader = self._load_b2_auth
+            bucket.on_auth = self._save_b2_auth
+            return bucket
         else:
             raise KeyError("Unknown storage class {}".format(cls_name))
 
-        return cls(**settings)
+    @cached_property
+    def async_storage(self):
+        return aiostorage.ExecutorAdapter(self.storage,
+                                          self.async_max_in_flight)
+
+    def _load_b2_auth(self):
+        """Returns the B2 authorization cached by a previous run"""
+        return self.settings.get('B2_AUTH_CACHE', "null")
+
+    def _save_b2_auth(self, data):
+        """Caches the B2 authorization and bucket ID for the next run
+
+        The authorization token grants the same access as the application
+        key, which is already stored in the storage settings.
+        """
+        self.settings['B2_AUTH_CACHE'] = data
 
     def set_storage(self, cls_name, settings):
         self.settings['STORAGE_SETTINGS'] = {'class': cls_name,
                                              'settings': settings, }
 
         self.__dict__.pop("storage", None)
+        async_storage = self.__dict__.pop("async_storage", None)
+        if async_storage is not None:
+            async_storage.close()
         return self.storage
 
     ################
@@ -252,6 +412,13 @@ class Repository:
             return zlib.decompress(b)
         return b
 
+    def _upload_file(self, name, content):
+        """Uploads a file to the storage backend and records it in the
+        remote file manifest"""
+        metadata = self.storage.upload_file(name, content)
+        manifest.record_upload(self, name, metadata)
+        return metadata
+
     def _get_path(self, objid):
         """Returns the path to use in the remote repository for the given
         objid
@@ -301,34 +468,169 @@ class Repository:
         view = payload.getbuffer()
         objid = self.encrypter.calculate_objid(view)
 
-        with atomic_immediate():
+        existing = self._find_object(objid)
+        if existing is not None:
+            return existing
+
+        # Object wasn't in the database. Upload it first, then commit the
+        # row, so that a row in the Object table always implies the object
+        # exists in the repository. Uploading outside of a transaction lets
+        # several workers upload at once without holding the database
+        # write lock.
+        to_upload = self._encode_payload(view)
+        obj.payload = self._cacheable_payload(obj, view)
+
+        path = self._get_path(objid)
+        metadata = self.storage.upload_file(
+            path,
+            util.BytesReader(to_upload),
+        )
+
+        return self._commit_object(objid, obj, relations, path, metadata,
+                                   len(to_upload))
+
+    async def push_object_async(self, payload, obj, relations):
+        """Pushes the given payload to the remote repository through
+        async_storage
+
+        This is the coroutine version of push_object(), with the same
+        arguments and return value. Hashing, compression, encryption and
+        database queries run in the async storage's worker threads along
+        with the uploads, so the event loop never waits on SQLite's lock.
+        """
+        loop = asyncio.get_event_loop()
+        executor = self.async_storage.executor
+
+        view = payload.getbuffer()
+        objid = await loop.run_in_executor(
+            executor, self.encrypter.calculate_objid, view
+        )
+
+        existing = await loop.run_in_executor(
+            executor, self._find_object, objid
+        )
+        if existing is not None:
+            return existing
+
+        to_upload = await loop.run_in_executor(
+            executor, self._encode_payload, view
+        )
+        obj.payload = await loop.run_in_executor(
+            executor, self._cacheable_payload, obj, view
+        )
+
+        path = self._get_path(objid)
+        metadata = await self.async_storage.upload_file(
+            path,
+            util.BytesReader(to_upload),
+        )
+
+        return await loop.run_in_executor(
+            executor, self._commit_object,
+            objid, obj, relations, path, metadata, len(to_upload),
+        )
+
+    def _find_object(self, objid):
+        """Returns the Object with the given ID, or None if there isn't
+        one"""
+        try:
+            return models.Object.objects.using(self.db).get(objid=objid)
+        except models.Object.DoesNotExist:
+            return None
+
+    def _encode_payload(self, view):
+        """Compresses and encrypts a payload for upload"""
+        return self.encrypter.encrypt_bytes(self.compress_bytes(view))
+
+    def _cacheable_payload(self, obj, view):
+        """Returns the compressed payload to keep in the local cache for
+        the object, or None for blobs
+
+        Tree and inode payloads are kept so listing snapshots and planning
+        restores doesn't need the remote repository. Only blob data is
+        downloaded during a restore.
+
+        Inodes holding their file's contents inline are cached with the
+        contents removed, so the cache doesn't keep a second copy of every
+        small file. Their metadata is still cached.
+        """
+        if obj.type not in ("tree", "inode"):
+            return None
+        if obj.type == "inode":
+            buf = io.BytesIO(view)
+            umsgpack.unpack(buf)
+            umsgpack.unpack(buf)
+            contents_start = buf.tell()
+            if umsgpack.unpack(buf)[0] == "immediate":
+                return zlib.compress(
+                    bytes(view[:contents_start]) + STRIPPED_CONTENTS
+                )
+        return zlib.compress(view)
+
+    def _get_cached_payload(self, objid, contents=True):
+        """Returns the object's payload from the local cache, or None if
+        it isn't cached
+
+        See get_object() for the contents argument.
+        """
+        data = models.Object.objects.using(self.db)\
+            .filter(objid=objid)\
+            .values_list("payload", flat=True)\
+            .first()
+        if data is None:
+            return None
+        payload = zlib.decompress(data)
+        if contents and payload.endswith(STRIPPED_CONTENTS):
+            return None
+        return payload
+
+    def get_cached_payloads(self, objids):
+        """Looks up several objects in the local cache at once
+
+        Returns a dict mapping the ID of each given object that's in the
+        local cache to its cached payload, or to None if its payload isn't
+        cached and must be fetched with get_object(). Pass at most a few
+        hundred IDs per call.
+        """
+        rows = models.Object.objects.using(self.db)\
+            .filter(objid__in=objids)\
+            .values_list("objid", "payload")
+        payloads = {}
+        for objid, data in rows:
+            payload = None if data is None else zlib.decompress(data)
+            if payload is not None and payload.endswith(STRIPPED_CONTENTS):
+                payload = None
+            payloads[bytes(objid)] = payload
+        return payloads
+
+    def _commit_object(self, objid, obj, relations, path, metadata,
+                       uploaded_size):
+        """Saves the Object and its relations for an object that was just
+        uploaded"""
+        with atomic_immediate(using=self.db):
+            manifest.record_upload(self, path, metadata)
             try:
-                obj = models.Object.objects.using(self.db).get(objid=objid)
+                # Two workers may race to push identical payloads (e.g. two
+                # ranges of a file with the same contents). Both uploads
+                # wrote the same object, so the loser just uses the
+                # winner's row.
+                return models.Object.objects.using(self.db).get(objid=objid)
             except models.Object.DoesNotExist:
-                # Object wasn't in the database.
                 obj.objid = objid
-                obj.uploaded_size = len(view)
+                obj.uploaded_size = uploaded_size
                 obj.save(using=self.db, force_insert=True)
                 for r in relations:
                     r.parent = obj
                 models.ObjectRelation.objects.using(self.db).bulk_create(
                     relations
                 )
-
-                to_upload = self.encrypter.encrypt_bytes(
-                    self.compress_bytes(
-                        view
-                    )
-                )
-
-                self.storage.upload_file(
-                    self._get_path(objid),
-                    util.BytesReader(to_upload),
+                models.Object.add_references(
+                    self.db, [r.child_id for r in relations]
                 )
 
         return obj
 
-    def get_object(self, objid, key=None):
+    def get_object(self, objid, key=None, use_cache=True, contents=True):
         """Retrieves the object from the remote datastore.
 
         :param objid: The object ID to retrieve
@@ -348,22 +650,88 @@ class Repository:
         retrieving this object's payload, such as the checksum not matching
         or a problem decrypting the payload.
 
+        Tree and inode payloads in the local cache are returned from there
+        without contacting the remote repository. Pass use_cache=False to
+        skip looking in the local cache, when the caller knows the object
+        isn't there.
+
+        Pass contents=False if only the object's type and metadata are
+        needed. A cached inode whose inline file contents were removed is
+        then returned as it is, with None in place of the contents.
+
+        """
+        if use_cache:
+            cached = self._get_cached_payload(objid, contents)
+            if cached is not None:
+                return cached
+
+        try:
+            # For local repositories this may be a memory map of the object
+            # file, which is decrypted and decompressed without copying it
+            # first
+            buf = self.storage.download_buffer(self._get_path(objid))
+        except Exception as e:
+            raise CorruptedRepository(
+                "Failed to read object {}: {}".format(objid.hex(), e)) from e
+        return self._decode_object(buf, objid, key)
+
+    async def get_object_async(self, objid, key=None, use_cache=True):
+        """Retrieves the object from the remote datastore through
+        async_storage
+
+        This is the coroutine version of get_object(), with the same
+        arguments, return value and exceptions.
         """
+        loop = asyncio.get_event_loop()
+        if use_cache:
+            cached = await loop.run_in_executor(
+                self.async_storage.executor,
+                self._get_cached_payload, objid,
+            )
+            if cached is not None:
+                return cached
+
+        try:
+            buf = await self.async_storage.download_buffer(
+                self._get_path(objid))
+        except Exception as e:
+            raise CorruptedRepository(
+                "Failed to read object {}: {}".format(objid.hex(), e)) from e
+        return await loop.run_in_executor(
+            self.async_storage.executor,
+            self._decode_object, buf, objid, key,
+        )
+
+    def _decode_object(self, buf, objid, key):
+        """Decrypts, decompresses and verifies a downloaded object"""
         try:
-            _, file = self.storage.download_file(self._get_path(objid))
             contents = self.decompress_bytes(
-                self.encrypter.decrypt_bytes(file.read(), key))
+                self.encrypter.decrypt_bytes(buf, key))
         except Exception as e:
             raise CorruptedRepository(
                 "Failed to read object {}: {}".format(objid.hex(), e)) from e
 
-        digest = self.encrypter.calculate_objid(contents)
-        if not hmac.compare_digest(digest, objid):
+        if not self._verify_objid(contents, objid):
             raise CorruptedRepository("Object payload does not "
                                       "match its hash for objid "
                                       "{}".format(objid))
         return contents
 
+    def _verify_objid(self, contents, objid):
+        """Checks the payload hashes to the given objid
+
+        Objects pushed before the repository's hash function was changed
+        are checked against the previous hash functions.
+        """
+        digest = self.encrypter.calculate_objid(contents)
+        if hmac.compare_digest(digest, objid):
+            return True
+        for objid_hash in self.settings.get('OBJID_HASH_HISTORY', "[]"):
+            digest = self.encrypter.calculate_objid(contents, objid_hash)
+            if hmac.compare_digest(digest, objid):
+                return True
+        return False
+
     def put_snapshot(self, snapshot):
         """Adds a new snapshot index file to the storage backend
 
@@ -378,7 +746,9 @@ class Repository:
         contents.seek(0)
         to_upload = self.encrypter.encrypt_bytes(
             self.compress_bytes(contents.getbuffer()))
-        self.storage.upload_file(path, util.BytesReader(to_upload))
+        self._upload_file(path, util.BytesReader(to_upload))
+        snapshot.name = path
+        snapshot.save(update_fields=["name"])
 
     ############################
     # These next methods define the high level interface to this repository.
@@ -439,6 +809,15 @@ class Repository:
         from . import backup
         backup.backup(self, progress)
 
+    def prune(self, expired, progress=None, full=False):
+        """Deletes the given snapshots and the objects only they referenced
+
+        See documentation in the backathon.prune module
+
+        """
+        from . import prune
+        return prune.prune(self, expired, progress, full)
+
     def save_metadata(self):
         """Updates the metadata file in the remote repository
 
@@ -448,16 +827,71 @@ class Repository:
         local cache
         """
         data = {"encryption": self.encrypter.get_public_params(),
-                "compression": self.compression, }
+                "compression": self.compression,
+                "objid_hash": self.objid_hash, }
         buf = io.BytesIO(json.dumps(data).encode("utf-8"))
-        self.storage.upload_file("backathon.json", buf)
+        self._upload_file("backathon.json", buf)
 
-    def restore(self, obj, path, password):
+    @property
+    def key_agent(self):
+        return keyagent.KeyAgentClient()
+
+    def _key_agent_name(self):
+        # Identifies this repository's key to the agent. The public
+        # parameters include the salt and the encrypted private key, so they
+        # are unique to the repository.
+        params = json.dumps(self.encrypter.get_public_params(),
+                            sort_keys=True)
+        return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+    def get_decryption_key(self, password=None):
+        """Returns the key for decrypting objects
+
+        If no password is given, asks the key agent for the key, and raises
+        KeyRequired if it doesn't have it.
+        """
+        if password is None and self.encrypter.password_required:
+            data = self.key_agent.get(self._key_agent_name())
+            if data is None:
+                raise KeyRequired()
+            try:
+                return self.encrypter.import_key(data)
+            except encryption.DecryptionError:
+                raise KeyRequired()
+        return self.encrypter.get_decryption_key(password)
+
+    def unlock(self, password, lifetime=None):
+        """Derives the decryption key and hands it to the key agent
+
+        The agent is started if it isn't already running. Subsequent calls
+        to get_decryption_key() without a password will get the key from
+        the agent until the lifetime (in seconds) expires.
+        """
+        if lifetime is None:
+            lifetime = self.key_agent_lifetime
+        key = self.encrypter.get_decryption_key(password)
+        agent = self.key_agent
+        agent.start()
+        agent.put(self._key_agent_name(), self.encrypter.export_key(key),
+                  lifetime)
+
+    def lock(self):
+        """Removes this repository's key from the key agent"""
+        self.key_agent.forget(self._key_agent_name())
+
+    def restore(self, obj, path, password=None, incremental=False,
+                compare_chunks=False, key=None):
         """Restores the given object to the given path
 
+        If key is given, it's used as the decryption key. Otherwise it's
+        derived from the password, or fetched from the key agent if password
+        is None.
+
         See docstring on the restore.restore_item() function for more details.
         """
-        key = self.encrypter.get_decryption_key(password)
+        if key is None:
+            key = self.get_decryption_key(password)
 
         from . import restore
-        restore.restore_item(self, obj, path, key)
+        restore.restore_item(self, obj, path, key, incremental=incremental,
+                             compare_chunks=compare_chunks)
@@ -1,16 +1,30 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import pathlib
 import logging
 import os
+import stat
+import threading
 
 import umsgpack
 
+from django.db import connections
+
+from . import backup
+from . import chunker
 from . import models
 from .exceptions import CorruptedRepository
 from . import util
 
 logger = logging.getLogger("backathon.restore")
 
-def restore_item(repo, obj, path, key=None):
+# Number of tree entries looked up in the local cache per query
+ENTRY_BATCH_SIZE = 500
+
+def restore_item(repo, obj, path, key=None, incremental=False,
+                 compare_chunks=False):
     """Restore the given object to the given path
 
     The last component of path is the item we're restoring. If it
@@ -27,6 +41,11 @@ def restore_item(repo, obj, path, key=None):
     :type path: str|pathlib.Path
     :param key: The key to decrypt files if decryption was enabled
     :type key: None | nacl.public.PrivateKey
+    :param incremental: If True, files at the destination whose size and
+        mtime match the snapshot are skipped
+    :param compare_chunks: With incremental, files at the destination that
+        don't match are compared chunk by chunk, and only chunks that differ
+        are fetched and rewritten
 
     Many kinds of errors can occur during a restore, as repository and local
     cache data is read in, parsed, and cross referenced with other local and
@@ -43,16 +62,672 @@ def restore_item(repo, obj, path, key=None):
     this function is to restore as much as possible and log anything that
     couldn't be restored.
 
+    Objects are fetched in parallel by a RestoreEngine, unless
+    repo.restore_concurrency is 1 and the I/O mode is "threads", in which
+    case the tree is walked one object at a time. Either way, blobs shared
+    by several files or chunks are downloaded once and reused.
+
+    Files are created with their data ranges preallocated. Chunks of all
+    zeros aren't fetched; they're left as holes, so sparse files stay
+    sparse.
+
     """
     assert repo.db == obj._state.db
 
+    state = _RestoreState(repo, key, obj, incremental, compare_chunks)
+    if repo.restore_concurrency > 1 or repo.io_mode == "asyncio":
+        RestoreEngine(state).run(obj, path)
+    else:
+        _restore_serial(state, obj, path)
+
+def zero_chunk_objid(repo):
+    """Returns the object ID of the blob for a full size chunk of zeros"""
+    chunk = bytes(chunker.FixedChunker.chunk_size)
+    return repo.encrypter.calculate_objid(
+        backup._pack_blob(chunk).getbuffer()
+    )
+
+def count_shared_blobs(repo, obj):
+    """Returns a dict mapping the IDs of blobs referenced more than once in
+    the tree under obj to their number of references
+
+    References are counted from the object relations in the local cache,
+    which hold one relation per chunk of a file, so this is the number of
+    times a restore of the tree uses each blob.
+    """
+    query = """
+    WITH RECURSIVE walk(id) AS (
+        SELECT %s
+        UNION ALL
+        SELECT child_id FROM object_relations
+        INNER JOIN walk ON walk.id=parent_id
+    ) SELECT walk.id, COUNT(*) FROM walk
+    INNER JOIN objects ON objects.objid=walk.id
+    WHERE objects.type='blob'
+    GROUP BY walk.id HAVING COUNT(*) > 1
+    """
+    with connections[repo.db].cursor() as c:
+        c.execute(query, (bytes(obj.objid),))
+        return {bytes(objid): count for objid, count in c}
+
+class SharedBlobs:
+    """Holds the payloads of blobs a restore will use again
+
+    Blobs referenced more than once in the tree being restored are counted
+    up front. After each use, a blob's payload is kept until its last use,
+    in a cache of up to repo.restore_cache_size bytes. If the cache fills
+    up, the least recently used payloads are dropped and fetched again when
+    they're next needed.
+    """
+    def __init__(self, repo, obj):
+        self.refs = count_shared_blobs(repo, obj)
+        self.max_size = repo.restore_cache_size
+        self.size = 0
+        self._cache = collections.OrderedDict()
+
+    def __contains__(self, objid):
+        return objid in self.refs
+
+    def get(self, objid):
+        """Returns the cached payload of a blob, or None"""
+        payload = self._cache.get(objid)
+        if payload is not None:
+            self._cache.move_to_end(objid)
+        return payload
+
+    def used(self, objid, payload=None):
+        """Records a use of a blob, caching its payload if it will be used
+        again
+
+        A payload already cached is kept until the blob's last use.
+
+        :param payload: The blob's payload, or None if it wasn't fetched for
+            this use, e.g. because it couldn't be or the file being restored
+            already had the chunk
+        """
+        refs = self.refs.get(objid)
+        if refs is None:
+            return
+        if refs == 1:
+            del self.refs[objid]
+            old = self._cache.pop(objid, None)
+            if old is not None:
+                self.size -= len(old)
+            return
+        self.refs[objid] = refs - 1
+
+        if payload is None or len(payload) > self.max_size:
+            return
+        old = self._cache.pop(objid, None)
+        if old is not None:
+            self.size -= len(old)
+        self._cache[objid] = payload
+        self.size += len(payload)
+        while self.size > self.max_size:
+            _, evicted = self._cache.popitem(last=False)
+            self.size -= len(evicted)
+
+class _RestoreState:
+    """Holds what a restore of one tree needs besides the objects"""
+    def __init__(self, repo, key, obj, incremental=False,
+                 compare_chunks=False):
+        self.repo = repo
+        self.key = key
+        self.shared = SharedBlobs(repo, obj)
+        self.zero_objid = zero_chunk_objid(repo)
+        self.incremental = incremental
+        self.compare_chunks = compare_chunks
+
+    def open_file(self, path, obj_info, payload_type, payload_contents):
+        """Opens a file to restore into
+
+        Returns (fd, compare). compare is True if the file is kept and each
+        chunk should be compared with it before being written. fd is None
+        if the file already matches the snapshot, or it couldn't be opened
+        and an error was logged.
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        compare = False
+        if self.incremental:
+            try:
+                st = os.lstat(str(path))
+            except FileNotFoundError:
+                st = None
+            except OSError as e:
+                logger.error("Error reading {}: {}".format(pathstr(path), e))
+                return None, False
+
+            if st is not None and stat.S_ISREG(st.st_mode):
+                if (st.st_size == obj_info['size'] and
+                        st.st_mtime_ns == obj_info['mtime']):
+                    logger.info("Skipping unchanged file {}".format(
+                        pathstr(path)
+                    ))
+                    _set_file_properties(path, obj_info)
+                    return None, False
+                if self.compare_chunks and payload_type == "chunklist":
+                    flags = os.O_RDWR | os.O_CREAT
+                    compare = True
+
+        logger.info("Restoring file {}".format(pathstr(path)))
+        fd = _open_file(path, obj_info, payload_type, payload_contents,
+                        self.zero_objid, flags)
+        return fd, compare
+
+    def chunk_matches(self, fd, pos, length, chunk_id):
+        """Returns whether the file already holds the given chunk"""
+        try:
+            data = os.pread(fd, length, pos)
+        except OSError:
+            return False
+        if len(data) != length:
+            return False
+        return chunk_id == self.repo.encrypter.calculate_objid(
+            backup._pack_blob(data).getbuffer()
+        )
+
+def _restore_serial(state, obj, path):
+    """Restores an object by walking the tree depth first, fetching one
+    object at a time"""
+    repo = state.repo
     # Important: if you print or log an error involving the path, pass it
     # through pathstr() first to sanitize any undecodable unicode surrogates
     path = pathlib.Path(path)
 
-    payload = repo.get_object(obj.objid, key)
-    payload_items = unpack_payload(payload)
+    # Each directory being restored has an iterator over its entries on the
+    # stack, with its properties to set once they're all restored
+    objid = bytes(obj.objid)
+    payload = repo.get_cached_payloads([objid]).get(objid)
+    stack = [(iter([(path, objid, payload)]), None, None)]
+    while stack:
+        entries, dirpath, dirinfo = stack[-1]
+        try:
+            path, objid, payload = next(entries)
+        except StopIteration:
+            stack.pop()
+            if dirinfo is not None:
+                _set_file_properties(dirpath, dirinfo)
+            continue
+
+        if payload is None:
+            try:
+                payload = repo.get_object(objid, state.key, use_cache=False)
+            except CorruptedRepository as e:
+                logger.error("Can't restore {}: {}".format(pathstr(path), e))
+                continue
+        parsed = _parse_object(payload, path, objid)
+        if parsed is None:
+            continue
+        obj_type, obj_info, obj_contents = parsed
+
+        if obj_type == "inode":
+            _restore_file_serial(state, path, obj_info, obj_contents)
+
+        elif obj_type == "tree":
+            if not _make_dir(path, obj_info):
+                continue
+            stack.append((_tree_entries(repo, path, obj_contents), path,
+                          obj_info))
+
+        else:
+            raise NotImplementedError("Restore not implemented for {} "
+                                      "object type".format(obj_type))
+
+def _restore_file_serial(state, path, obj_info, obj_contents):
+    repo = state.repo
+    shared = state.shared
+    if not _check_file_path(path):
+        return
+
+    obj_payload_type, obj_payload_contents = obj_contents
+
+    fd, compare = state.open_file(path, obj_info, obj_payload_type,
+                                  obj_payload_contents)
+    if fd is None:
+        return
+
+    try:
+        if obj_payload_type == "chunklist":
+            for pos, chunk_id, length in _chunk_ranges(
+                    obj_payload_contents, obj_info['size']):
+                if compare:
+                    if state.chunk_matches(fd, pos, length, chunk_id):
+                        shared.used(chunk_id)
+                        continue
+                elif chunk_id == state.zero_objid:
+                    continue
+
+                payload = shared.get(chunk_id)
+                if payload is None:
+                    try:
+                        payload = repo.get_object(chunk_id, state.key,
+                                                  use_cache=False)
+                    except CorruptedRepository as e:
+                        shared.used(chunk_id)
+                        _log_chunk_error(path, pos, e)
+                        continue
+
+                shared.used(chunk_id, payload)
+                _write_chunk(fd, path, pos, payload)
+        elif obj_payload_type == "immediate":
+            assert isinstance(obj_payload_contents, bytes)
+            _pwrite_all(fd, obj_payload_contents, 0)
+
+        else:
+            raise AssertionError("Invalid inode payload type")
+
+    except OSError as e:
+        logger.error("Error writing {}: {}".format(
+            pathstr(path), e
+        ))
+        _close_file(fd, path)
+        return
+
+    _set_file_properties(path, obj_info, fd)
+    _close_file(fd, path)
+
+class RestoreEngine:
+    """Restores a tree with many objects downloading at once
+
+    The calling thread walks the tree, creates directories and files.
+    Every object it needs (trees, inodes, and the blobs of each file) is a
+    fetch job. Jobs run in order through a pool that downloads, decrypts and
+    verifies objects, with up to window jobs in flight ahead of the one
+    being processed. The pool also writes each blob into its file with
+    os.pwrite(), so writes to different parts of a file proceed in
+    parallel. The blobs of a file are queued ahead of the rest of the
+    walk, so they're prefetched while earlier chunks of the same file are
+    written, and only the files near the front of the queue are open at
+    once.
+
+    The walk is depth first. Each directory's entries are looked up in the
+    local cache in batches as they're needed, along with their cached
+    payloads, so memory use grows with the depth of the tree rather than
+    its size.
+
+    The pool is a thread pool of repo.restore_concurrency workers, or in the
+    asyncio I/O mode an event loop fetching up to repo.async_max_in_flight
+    objects through the async storage.
+
+    In an incremental restore, chunks of files being compared are each
+    checked against the file by a worker before being fetched.
+
+    Objects are fetched without checking the local cache again, since tree
+    and inode payloads that are cached come from the batched lookups.
+
+    Blobs used more than once in the tree are fetched once. While one is in
+    flight, later jobs for it wait on the same fetch, and after that they
+    take it from the SharedBlobs cache.
+
+    A directory's properties are set once everything in it is restored, so
+    restoring its contents doesn't change its mtime, and a read-only
+    directory can still be filled.
+
+    Errors are logged and the restore carries on, as with restore_item().
+    """
+    def __init__(self, state):
+        repo = state.repo
+        self.state = state
+        self.repo = repo
+        self.key = state.key
+        self.use_asyncio = repo.io_mode == "asyncio"
+        if self.use_asyncio:
+            self.window = repo.async_max_in_flight
+        else:
+            self.concurrency = repo.restore_concurrency
+            # Enough to keep the workers busy while this thread writes
+            self.window = self.concurrency * 2
+
+        # Jobs submitted to the pool. Jobs waiting to be submitted are
+        # the chunks of files being restored, then the entries of
+        # directories being restored, deepest first.
+        self._submitted = collections.deque()
+        self._chunks = collections.deque()
+        self._dirs = []
+        # Fetches of shared blobs that haven't been used yet
+        self._in_flight = {}
+
+    def run(self, obj, path):
+        with contextlib.ExitStack() as stack:
+            if self.use_asyncio:
+                submit = self._start_loop(stack)
+                self._get = lambda objid: submit(
+                    self.repo.get_object_async(objid, self.key,
+                                               use_cache=False)
+                )
+                self._get_and_write = lambda *args: submit(
+                    self._get_and_write_async(*args)
+                )
+                self._compare = lambda *args: submit(
+                    self._compare_async(*args)
+                )
+            else:
+                self.repo.storage.set_concurrency(self.concurrency)
+                executor = stack.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(self.concurrency)
+                )
+                self._get = lambda objid: executor.submit(
+                    self.repo.get_object, objid, self.key, False
+                )
+                self._get_and_write = lambda *args: executor.submit(
+                    self._get_and_write_sync, *args
+                )
+                self._compare = lambda objid, node, pos, length: \
+                    executor.submit(self.state.chunk_matches, node.fd, pos,
+                                    length, objid)
+
+            objid = bytes(obj.objid)
+            self._dirs.append(iter([_ObjectJob(
+                objid, pathlib.Path(path), None,
+                self.repo.get_cached_payloads([objid]).get(objid),
+            )]))
+            try:
+                self._process_jobs()
+            finally:
+                for job in self._submitted:
+                    job.future.cancel()
+
+    def _start_loop(self, stack):
+        """Runs an event loop in a thread for the duration of the restore,
+        and returns a function that submits coroutines to it"""
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        stack.callback(stop)
+
+        return lambda coro: asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def _get_and_write_sync(self, objid, node, pos, length):
+        if node.compare and self.state.chunk_matches(node.fd, pos, length,
+                                                     objid):
+            return
+        node.write_chunk(pos, self.repo.get_object(objid, self.key, False))
+
+    async def _get_and_write_async(self, objid, node, pos, length):
+        loop = asyncio.get_event_loop()
+        if node.compare and await loop.run_in_executor(
+                None, self.state.chunk_matches, node.fd, pos, length, objid):
+            return
+        payload = await self.repo.get_object_async(objid, self.key,
+                                                   use_cache=False)
+        await loop.run_in_executor(None, node.write_chunk, pos, payload)
+
+    async def _compare_async(self, objid, node, pos, length):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.state.chunk_matches, node.fd, pos, length, objid)
+
+    def _process_jobs(self):
+        while True:
+            while len(self._submitted) < self.window:
+                job = self._next_job()
+                if job is None:
+                    break
+                job.future = job.start(self)
+                self._submitted.append(job)
+
+            if not self._submitted:
+                return
+            job = self._submitted.popleft()
+            try:
+                payload = job.future.result()
+            except CorruptedRepository as e:
+                self._used(job, None)
+                job.failed(e)
+            else:
+                self._used(job, payload)
+                job.process(self, payload)
+
+    def _fetch(self, objid):
+        """Returns a future for an object's payload"""
+        shared = self.state.shared
+        if objid not in shared:
+            return self._get(objid)
+
+        payload = shared.get(objid)
+        if payload is not None:
+            return _completed(payload)
+        try:
+            return self._in_flight[objid]
+        except KeyError:
+            future = self._in_flight[objid] = self._get(objid)
+            return future
+
+    def _used(self, job, payload):
+        if job.objid in self.state.shared:
+            if self._in_flight.get(job.objid) is job.future:
+                del self._in_flight[job.objid]
+            self.state.shared.used(job.objid, payload)
+
+    def _next_job(self):
+        if self._chunks:
+            return self._chunks.popleft()
+        while self._dirs:
+            job = next(self._dirs[-1], None)
+            if job is not None:
+                return job
+            self._dirs.pop()
+        return None
+
+    def add_tree(self, node, entries):
+        """Queues the entries of a directory ahead of the other
+        directories' entries
+
+        Entries are looked up as they're needed, so only a batch of each
+        directory's entries is held in memory.
+        """
+        def jobs():
+            for path, objid, payload in _tree_entries(self.repo, node.path,
+                                                      entries):
+                node.remaining += 1
+                yield _ObjectJob(objid, path, node, payload)
+            node.done()
+        self._dirs.append(jobs())
+
+    def add_chunks(self, node, chunks):
+        """Queues the chunks of a file ahead of any other waiting jobs"""
+        jobs = []
+        for pos, chunk_id, length in _chunk_ranges(chunks,
+                                                   node.info['size']):
+            job = _ChunkJob(chunk_id, node, pos, length)
+            if node.compare and chunk_id in self.state.shared:
+                job = _CompareJob(job)
+            jobs.append(job)
+        node.remaining += len(jobs)
+        self._chunks.extendleft(reversed(jobs))
+
+class _Node:
+    """A file or directory being restored
+
+    Its properties are set when the last job under it is done, and then
+    its parent is told it's done. Files are written through the open file
+    descriptor fd. If compare is set, the file's existing chunks are
+    compared with the snapshot's and only the differing ones written.
+    """
+    def __init__(self, path, info, parent, fd=None, compare=False):
+        self.path = path
+        self.info = info
+        self.parent = parent
+        self.fd = fd
+        self.compare = compare
+        self.failed = False
+        # The creator holds one count until it has queued all the jobs
+        self.remaining = 1
+
+    def done(self):
+        node = self
+        while node is not None:
+            node.remaining -= 1
+            if node.remaining:
+                return
+            if not node.failed:
+                _set_file_properties(node.path, node.info, node.fd)
+            if node.fd is not None:
+                _close_file(node.fd, node.path)
+            node = node.parent
+
+    def write_chunk(self, pos, payload):
+        """Writes a blob payload into the file at pos
+
+        This runs in the engine's workers, so write errors are logged here
+        and mark the file failed.
+        """
+        if self.failed:
+            return
+        try:
+            _write_chunk(self.fd, self.path, pos, payload)
+        except OSError as e:
+            logger.error("Error writing {}: {}".format(pathstr(self.path), e))
+            self.failed = True
+
+class _ObjectJob:
+    """Restores a tree or inode object to a path
+
+    payload is the object's payload from the local cache, if it's cached.
+    """
+    future = None
+
+    def __init__(self, objid, path, parent, payload=None):
+        self.objid = objid
+        self.path = path
+        self.parent = parent
+        self.payload = payload
+
+    def start(self, engine):
+        if self.payload is not None:
+            payload, self.payload = self.payload, None
+            return _completed(payload)
+        return engine._fetch(self.objid)
+
+    def _done(self):
+        if self.parent is not None:
+            self.parent.done()
+
+    def failed(self, e):
+        logger.error("Can't restore {}: {}".format(pathstr(self.path), e))
+        self._done()
+
+    def process(self, engine, payload):
+        path = self.path
+        parsed = _parse_object(payload, path, self.objid)
+        if parsed is None:
+            self._done()
+            return
+        obj_type, obj_info, obj_contents = parsed
+
+        if obj_type == "inode":
+            if not _check_file_path(path):
+                self._done()
+                return
 
+            obj_payload_type, obj_payload_contents = obj_contents
+            fd, compare = engine.state.open_file(
+                path, obj_info, obj_payload_type, obj_payload_contents,
+            )
+            if fd is None:
+                self._done()
+                return
+            node = _Node(path, obj_info, self.parent, fd, compare)
+
+            if obj_payload_type == "chunklist":
+                engine.add_chunks(node, obj_payload_contents)
+            elif obj_payload_type == "immediate":
+                assert isinstance(obj_payload_contents, bytes)
+                try:
+                    _pwrite_all(fd, obj_payload_contents, 0)
+                except OSError as e:
+                    logger.error("Error writing {}: {}".format(
+                        pathstr(path), e
+                    ))
+                    node.failed = True
+            else:
+                raise AssertionError("Invalid inode payload type")
+            node.done()
+
+        elif obj_type == "tree":
+            if not _make_dir(path, obj_info):
+                self._done()
+                return
+
+            engine.add_tree(_Node(path, obj_info, self.parent), obj_contents)
+
+        else:
+            raise NotImplementedError("Restore not implemented for {} "
+                                      "object type".format(obj_type))
+
+class _ChunkJob:
+    """Writes one chunk of a file"""
+    future = None
+
+    def __init__(self, objid, node, pos, length):
+        self.objid = objid
+        self.node = node
+        self.pos = pos
+        self.length = length
+
+    def start(self, engine):
+        if not self.node.compare and self.objid == engine.state.zero_objid:
+            # Left as a hole in the file
+            return _completed(None)
+        if self.objid in engine.state.shared:
+            # The payload is written once it's processed, and may be
+            # reused. In compare mode a _CompareJob has already found that
+            # the file differs.
+            return engine._fetch(self.objid)
+        return engine._get_and_write(self.objid, self.node, self.pos,
+                                     self.length)
+
+    def failed(self, e):
+        _log_chunk_error(self.node.path, self.pos, e)
+        self.node.done()
+
+    def process(self, engine, payload):
+        if payload is not None:
+            self.node.write_chunk(self.pos, payload)
+        self.node.done()
+
+class _CompareJob:
+    """Compares a chunk of a shared blob with the file being restored over
+
+    If they differ, the chunk's _ChunkJob is queued to fetch the blob, so
+    the fetch and the cached payload are shared with the blob's other uses.
+    """
+    future = None
+    # Not a use of the blob. The queued _ChunkJob is, or if the file
+    # already has the chunk, process() records the use.
+    objid = None
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+
+    def start(self, engine):
+        chunk = self.chunk
+        return engine._compare(chunk.objid, chunk.node, chunk.pos,
+                               chunk.length)
+
+    def failed(self, e):
+        self.chunk.failed(e)
+
+    def process(self, engine, matches):
+        if matches:
+            engine.state.shared.used(self.chunk.objid)
+            self.chunk.node.done()
+        else:
+            engine._chunks.appendleft(self.chunk)
+
+def _completed(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+def _parse_object(payload, path, objid):
+    """Returns the (type, info, contents) of an object payload, or logs an
+    error and returns None if it's invalid"""
+    payload_items = unpack_payload(payload)
     try:
         obj_type = next(payload_items)
         obj_info = next(payload_items)
@@ -61,130 +736,185 @@ def restore_item(repo, obj, path, key=None):
         logger.error("Can't restore {}: Object {} has invalid cached "
                      "data. Rebuilding the local cache may fix this "
                      "problem.".format(
-            pathstr(path), obj.objid
+            pathstr(path), objid
         ))
-        return
+        return None
+    return obj_type, obj_info, obj_contents
+
+def _check_file_path(path):
+    if path.exists() and not path.is_file():
+        logger.error("Can't restore path {}: it already exists but isn't "
+                     "a file".format(pathstr(path)))
+        return False
+    return True
+
+def _open_file(path, obj_info, payload_type, payload_contents, zero_objid,
+               flags):
+    """Opens a file to restore with the given flags, preallocating space
+    for its data
+
+    Returns the file descriptor, or logs an error and returns None.
+    """
+    try:
+        fd = os.open(str(path), flags, 0o666)
+    except OSError as e:
+        logger.error("Error writing {}: {}".format(pathstr(path), e))
+        return None
 
-    if obj_type == "inode":
-        if path.exists() and not path.is_file():
-            logger.error("Can't restore path {}: it already exists but isn't "
-                         "a file".format(pathstr(path)))
-            return
-        logger.info("Restoring file {}".format(pathstr(path)))
+    if payload_type == "chunklist":
+        try:
+            _preallocate(fd, obj_info['size'], payload_contents, zero_objid)
+        except OSError as e:
+            logger.error("Error writing {}: {}".format(pathstr(path), e))
+            _close_file(fd, path)
+            return None
+    return fd
 
-        obj_payload_type, obj_payload_contents = obj_contents
+def _preallocate(fd, size, chunks, zero_objid):
+    """Allocates disk space for the data chunks of a file and sets its size
 
-        try:
-            with path.open("wb") as fileout:
-                if obj_payload_type == "chunklist":
-                    for pos, chunk_id in obj_payload_contents:
-
-                        try:
-                            blob_payload = unpack_payload(
-                                repo.get_object(chunk_id, key)
-                            )
-                        except CorruptedRepository as e:
-                            logger.error("Could not restore chunk of {} at byte {}: "
-                                         "{}".format(
-                                pathstr(path), pos, e
-                            ))
-                            continue
-
-                        try:
-                            blob_type = next(blob_payload)
-                            blob_contents = next(blob_payload)
-                        except umsgpack.UnpackException:
-                            logger.error(
-                                "Could not restore chunk of {} at byte {}: "
-                                "invalid or corrupted data".format(
-                                    pathstr(path), pos
-                                )
-                            )
-                            continue
-
-                        if blob_type != "blob":
-                            logger.error(
-                                "Could not restore chunk of {} at byte {}: object of "
-                                "type blob expected".format(
-                                    pathstr(path), pos
-                                )
-                            )
-                            continue
-
-                        fileout.seek(pos)
-                        fileout.write(blob_contents)
-                elif obj_payload_type == "immediate":
-                    assert isinstance(obj_payload_contents, bytes)
-                    fileout.write(obj_payload_contents)
-
-                else:
-                    raise AssertionError("Invalid inode payload type")
+    Zero chunks are left unallocated, as holes. Allocating everything up
+    front lets the filesystem lay the file out contiguously, whatever order
+    the chunks are written in.
+    """
+    ranges = []
+    for pos, chunk_id, length in _chunk_ranges(chunks, size):
+        if chunk_id == zero_objid or length <= 0:
+            continue
+        if ranges and ranges[-1][1] == pos:
+            ranges[-1][1] = pos + length
+        else:
+            ranges.append([pos, pos + length])
+
+    if hasattr(os, "posix_fallocate"):
+        for start, end in ranges:
+            try:
+                os.posix_fallocate(fd, start, end - start)
+            except OSError:
+                # Not supported by this filesystem. The chunks are written
+                # anyways, so this only costs some fragmentation.
+                break
+
+    os.ftruncate(fd, size)
+
+def _chunk_ranges(chunks, size):
+    """Yields (pos, chunk_id, length) for each chunk of a file's chunk
+    list"""
+    ends = [pos for pos, _ in chunks[1:]] + [size]
+    for (pos, chunk_id), end in zip(chunks, ends):
+        yield pos, chunk_id, end - pos
+
+def _close_file(fd, path):
+    try:
+        os.close(fd)
+    except OSError as e:
+        logger.error("Error writing {}: {}".format(pathstr(path), e))
+
+def _make_dir(path, obj_info):
+    """Makes the directory if it doesn't exist. Returns False and logs an
+    error if it can't be made."""
+    if path.exists() and not path.is_dir():
+        logger.error("Can't restore path {}: it already exists but isn't "
+                     "a directory".format(pathstr(path)))
+        return False
 
+    if not path.exists():
+        try:
+            path.mkdir(mode=obj_info['mode'])
         except OSError as e:
-            logger.error("Error writing {}: {}".format(
+            logger.error("Could not make directory {}: {}".format(
                 pathstr(path), e
             ))
-            return
-
-        _set_file_properties(path, obj_info)
+            return False
+    return True
 
-    elif obj_type == "tree":
-        if path.exists() and not path.is_dir():
-            logger.error("Can't restore path {}: it already exists but isn't "
-                         "a directory".format(pathstr(path)))
-            return
+def _tree_entries(repo, path, entries):
+    """Yields (path, objid, payload) for the entries of a tree
 
-        if not path.exists():
-            try:
-                path.mkdir(mode=obj_info['mode'])
-            except OSError as e:
-                logger.error("Could not make directory {}: {}".format(
-                    pathstr(path), e
-                ))
-                return
-
-        _set_file_properties(path, obj_info)
-
-        for name, objid in obj_contents:
-            name = os.fsdecode(name)
-            try:
-                childobj = models.Object.objects.using(repo.db).get(objid=objid)
-            except models.Object.DoesNotExist:
+    Entries are looked up in the local cache ENTRY_BATCH_SIZE at a time,
+    which also gets their cached payloads. payload is None if the object
+    must be fetched. Entries missing from the local cache are logged and
+    skipped.
+    """
+    for i in range(0, len(entries), ENTRY_BATCH_SIZE):
+        batch = entries[i:i + ENTRY_BATCH_SIZE]
+        found = repo.get_cached_payloads([objid for _, objid in batch])
+        for name, objid in batch:
+            entry_path = path / os.fsdecode(name)
+            if objid not in found:
                 logger.error("Could not restore {}: referenced object does "
                              "not exist in the local cache. Rebuilding the "
                              "local cache may help fix this problem".format(
-                    pathstr(path / name)
+                    pathstr(entry_path)
                 ))
-                return
+                continue
+            yield entry_path, objid, found[objid]
+
+def _log_chunk_error(path, pos, e):
+    logger.error("Could not restore chunk of {} at byte {}: "
+                 "{}".format(
+        pathstr(path), pos, e
+    ))
+
+def _write_chunk(fd, path, pos, payload):
+    """Writes the contents of a blob payload to the file at the given
+    position, or logs an error if the payload isn't a valid blob"""
+    blob_payload = unpack_payload(payload)
+    try:
+        blob_type = next(blob_payload)
+        blob_contents = next(blob_payload)
+    except umsgpack.UnpackException:
+        logger.error(
+            "Could not restore chunk of {} at byte {}: "
+            "invalid or corrupted data".format(
+                pathstr(path), pos
+            )
+        )
+        return
 
-            restore_item(repo, childobj, path / name, key)
+    if blob_type != "blob":
+        logger.error(
+            "Could not restore chunk of {} at byte {}: object of "
+            "type blob expected".format(
+                pathstr(path), pos
+            )
+        )
+        return
 
-    else:
-        raise NotImplementedError("Restore not implemented for {} "
-                                  "object type".format(obj_type))
+    _pwrite_all(fd, blob_contents, pos)
+
+def _pwrite_all(fd, data, pos):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, pos)
+        view = view[written:]
+        pos += written
 
-def _set_file_properties(path, obj_info):
+def _set_file_properties(path, obj_info, fd=None):
     """Sets the file properties of the given path
 
     :type path: pathlib.Path
     :type obj_info: dict
+    :param fd: If given, the properties are set through this open file
+        descriptor of the path instead
 
     Sets: owner, group, mode, atime, mtime
     """
+    target = str(path) if fd is None else fd
     try:
-        os.chown(str(path), obj_info['uid'], obj_info['gid'])
+        os.chown(target, obj_info['uid'], obj_info['gid'])
     except OSError as e:
         logger.warning("Could not chown {}: {}".format(
             pathstr(path), e
         ))
     try:
-        os.chmod(str(path), obj_info['mode'])
+        os.chmod(target, obj_info['mode'])
     except OSError as e:
         logger.warning("Could not chmod {}: {}".format(
             pathstr(path), e
         ))
     try:
-        os.utime(str(path), ns=(obj_info['atime'], obj_info['mtime']))
+        os.utime(target, ns=(obj_info['atime'], obj_info['mtime']))
     except OSError as e:
         logger.warning("Could not set mtime on {}: {}".format(
             pathstr(path), e
@@ -1,6 +1,11 @@
+import mmap
 import pathlib
 import shutil
 import os
+import threading
+import uuid
+
+from . import util
 
 class StorageBase:
     """Base class defining the storage interface"""
@@ -28,37 +33,113 @@ class StorageBase:
         """
         raise NotImplementedError()
 
+    def download_buffer(self, name, byte_range=None):
+        """Downloads a file and returns its contents
+
+        :param name: The name of the file to download
+        :param byte_range: An optional (start, end) tuple of byte offsets to
+            download only part of the file. end is exclusive, or None to read
+            to the end of the file.
+        :returns: A bytes-like object. This may be a read-only buffer such
+            as a memory map rather than a bytes object.
+        """
+        _, file = self.download_file(name)
+        with file:
+            if byte_range is None:
+                return file.read()
+            start, end = byte_range
+            file.seek(start)
+            return file.read(-1 if end is None else end - start)
+
     def delete(self, name):
         """Deletes a file"""
         raise NotImplementedError()
 
-    def get_files_by_prefix(self, prefix):
+    def get_files_by_prefix(self, prefix, start_name=None):
         """Returns all files that have the given prefix
 
         The prefix can be a directory or a file prefix. All files below that
         prefix in the tree will be returned.
+
+        Files are returned in order of their names. If start_name is given,
+        the listing starts at the first name equal to or after it, which
+        lets a long listing be resumed where it left off.
+
+        Each file is described by a metadata dict with at least 'fileName',
+        and with 'contentLength' where the backend provides it.
         """
         raise NotImplementedError()
 
+    def set_concurrency(self, concurrency):
+        """Tells the backend how many threads will use it at once
+
+        Backends that keep pools of connections or other per-request
+        resources size them with this.
+        """
+        pass
+
+    def flush(self):
+        """Makes all previously uploaded files durable
+
+        Backends that acknowledge uploads before they are durable must
+        finish persisting them before this returns. This is called before
+        writing anything that refers to previously uploaded files, such as
+        snapshots.
+        """
+        pass
+
 class FilesystemStorage(StorageBase):
-    """A filesystem storage class with an api compatible with our B2 class"""
+    """A filesystem storage class with an api compatible with our B2 class
+
+    With fast_writes enabled, uploads avoid most of the per-file overhead of
+    the default path: directory file descriptors are opened once and cached,
+    files are written relative to them with a single writev() from the
+    source buffer, and each file is written to a temporary name, fsynced,
+    and renamed into place so readers never see a partial file and a file
+    is never seen under its name before its contents are durable. The
+    renames are made durable in batches, by fsyncing the directories they
+    were made in whenever flush() is called or too many renames are
+    pending, instead of once per file.
+    """
 
-    def __init__(self, base_dir):
+    # Number of renames to let pend before fsyncing their directories
+    # automatically
+    MAX_PENDING = 256
+
+    # Files at least this large are memory mapped by download_buffer()
+    # instead of being read into a new bytes object. Below this, the cost
+    # of setting up the mapping outweighs the copy.
+    MMAP_THRESHOLD = 2**16
+
+    def __init__(self, base_dir, fast_writes=False):
         self.base_dir = pathlib.Path(base_dir)
+        self.fast_writes = fast_writes
+
+        self._lock = threading.Lock()
+        self._dir_fds = {} # directory name -> fd
+        self._pending = 0 # renames not yet fsynced
+        self._dirty_dirs = set() # directory fds with unsynced renames
 
     def _get_metadata(self, path: pathlib.Path):
         # Not all metadata that B2 calls return is computed here. Feel free
         # to add more as we need it.
         return {
-            'fileName': str(path.relative_to(self.base_dir))
+            'fileName': str(path.relative_to(self.base_dir)),
+            'contentLength': path.stat().st_size,
         }
 
     def get_params(self):
-        return {
-            'base_dir': self.base_dir
+        params = {
+            'base_dir': str(self.base_dir),
         }
+        if self.fast_writes:
+            params['fast_writes'] = True
+        return params
 
     def upload_file(self, name, content):
+        if self.fast_writes:
+            return self._fast_upload_file(name, content)
+
         path = self.base_dir / name
 
         os.makedirs(path.parent, exist_ok=True)
@@ -67,44 +148,146 @@ class FilesystemStorage(StorageBase):
 
         return self._get_metadata(path)
 
+    def _get_dir_fd(self, dirname):
+        try:
+            return self._dir_fds[dirname]
+        except KeyError:
+            pass
+        os.makedirs(os.path.join(str(self.base_dir), dirname), exist_ok=True)
+        fd = os.open(os.path.join(str(self.base_dir), dirname),
+                     os.O_RDONLY | os.O_DIRECTORY)
+        with self._lock:
+            if dirname in self._dir_fds:
+                # Another thread opened it first
+                os.close(fd)
+            else:
+                self._dir_fds[dirname] = fd
+            return self._dir_fds[dirname]
+
+    def _fast_upload_file(self, name, content):
+        dirname, basename = os.path.split(name)
+        dir_fd = self._get_dir_fd(dirname)
+
+        if isinstance(content, util.BytesReader):
+            buffers = [memoryview(content.buf)[content.pos:]]
+        else:
+            buffers = list(iter(lambda: content.read(2**20), b""))
+        size = sum(len(b) for b in buffers)
+
+        tmpname = ".{}.{}.tmp".format(basename, uuid.uuid4().hex)
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644,
+                     dir_fd=dir_fd)
+        try:
+            while buffers:
+                written = os.writev(fd, buffers)
+                # writev() may write less than requested. Drop the
+                # buffers that were written completely and trim the next.
+                while buffers and written >= len(buffers[0]):
+                    written -= len(buffers[0])
+                    buffers.pop(0)
+                if written:
+                    buffers[0] = memoryview(buffers[0])[written:]
+            # The contents must be durable before the file appears under
+            # its name. The caller records the object as stored once this
+            # returns.
+            os.fsync(fd)
+            os.rename(tmpname, basename,
+                      src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except BaseException:
+            try:
+                os.unlink(tmpname, dir_fd=dir_fd)
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
+            os.close(fd)
+
+        with self._lock:
+            self._pending += 1
+            self._dirty_dirs.add(dir_fd)
+            flush = self._pending >= self.MAX_PENDING
+        if flush:
+            self.flush()
+
+        return {'fileName': name, 'contentLength': size}
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty_dirs
+            self._pending = 0
+            self._dirty_dirs = set()
+
+        # File contents were fsynced before their renames, so only the
+        # directory entries are left
+        for fd in dirty:
+            os.fsync(fd)
+
+    def close(self):
+        """Flushes pending writes and closes cached directory descriptors"""
+        self.flush()
+        with self._lock:
+            for fd in self._dir_fds.values():
+                os.close(fd)
+            self._dir_fds.clear()
+
     def download_file(self, name):
         path = self.base_dir / name
 
         return self._get_metadata(path), path.open("rb")
 
-    def delete(self, name):
+    def download_buffer(self, name, byte_range=None):
         path = self.base_dir / name
 
-        path.unlink()
-
-    def get_files_by_prefix(self, prefix):
-        path = self.base_dir / prefix
+        with path.open("rb") as fileobj:
+            size = os.fstat(fileobj.fileno()).st_size
+            start, end = byte_range or (0, None)
+            end = size if end is None else min(end, size)
+            if end - start < self.MMAP_THRESHOLD:
+                return os.pread(fileobj.fileno(), max(end - start, 0), start)
+            # The mapping stays valid after the file is closed
+            buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            if byte_range is None:
+                return buf
+            return memoryview(buf)[start:end]
 
-        # This is a little tricky because the last component of the path
-        # could be a directory name, a file name, a partial directory name,
-        # a partial file name, or both a partial directory and file name. We
-        # won't usually have to do anything like that, but this keeps the
-        # same api as the B2 list file names API.
+    def delete(self, name):
+        path = self.base_dir / name
 
-        # Short circuit single file case
-        if path.is_file():
-            yield self._get_metadata(path)
-            return
+        path.unlink()
 
-        if not path.is_dir():
-            prefix = path.name
-            path = path.parent
-        else:
-            prefix = ""
+    @staticmethod
+    def _is_tempfile(name):
+        # Left behind by an interrupted fast write
+        return name.startswith(".") and name.endswith(".tmp")
 
-        for entry in os.scandir(path):
-            if entry.name.startswith(prefix):
-                if entry.is_file():
-                    yield self._get_metadata(pathlib.Path(entry))
-                elif entry.is_dir():
-                    for dirpath, dirnames, filenames in os.walk(entry):
-                        for fname in filenames:
-                            path = pathlib.Path(dirpath) / fname
-                            yield self._get_metadata(path)
+    def get_files_by_prefix(self, prefix, start_name=None):
+        # Files are listed in the same order as the B2 list file names API:
+        # sorted by their full names. All files in a directory sort together
+        # under the directory's name plus a slash, so the tree is walked in
+        # order by sorting each directory's entries that way.
+        yield from self._list_sorted("", prefix, start_name or "")
 
+    def _list_sorted(self, dirname, prefix, start_name):
+        entries = []
+        for entry in os.scandir(os.path.join(str(self.base_dir), dirname)):
+            if self._is_tempfile(entry.name):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                entries.append((dirname + entry.name + "/", entry))
+            else:
+                entries.append((dirname + entry.name, entry))
+        entries.sort(key=lambda e: e[0])
 
+        for name, entry in entries:
+            if not (name.startswith(prefix) or prefix.startswith(name)):
+                continue
+            if name < start_name and not start_name.startswith(name):
+                # Everything under this name sorts before start_name
+                continue
+            if name.endswith("/"):
+                yield from self._list_sorted(name, prefix, start_name)
+            elif name.startswith(prefix):
+                yield {
+                    'fileName': name,
+                    'contentLength': entry.stat().st_size,
+                }
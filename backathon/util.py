@@ -1,3 +1,8 @@
+import contextlib
+import io
+import threading
+import time
+
 from django.db import DEFAULT_DB_ALIAS
 from django.db.transaction import Atomic, get_connection
 
@@ -63,8 +68,181 @@ class BytesReader:
             ret = bytes(ret)
         return ret
 
-    def seek(self, pos):
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += len(self.buf)
         self.pos = pos
+        return pos
+
+
+class MemoryBudget:
+    """A byte-accounted limit on the amount of data held in memory at once
+
+    Workers call acquire() with the number of bytes they're about to read
+    into memory, and release() once that data has been dealt with. When the
+    budget is exhausted, acquire() blocks until enough space is released by
+    other workers. This keeps memory usage bounded no matter how many
+    workers are running or how large the objects are.
+
+    A single request larger than the whole budget is let through once
+    nothing else is in flight, otherwise it would block forever.
+
+    The peak attribute records the most bytes that were in flight at once.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        with self._cond:
+            while self.used and self.used + size > self.limit:
+                self._cond.wait()
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, size):
+        """Context manager that holds size bytes of the budget"""
+        self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+class ConcurrencyLimiter:
+    """An adaptive limit on the number of requests in flight to a storage
+    service, shared by all the threads using it
+
+    The limit starts at initial_limit and, until the first request is
+    throttled, grows by one for each successful request, doubling about
+    every round trip. The first throttled request halves it. After that it
+    follows additive increase, multiplicative decrease (AIMD): each
+    successful request raises the limit by 1/limit, so it grows by about one
+    per limit's worth of requests, and a throttled request (429, 503, or a
+    timeout) cuts it by DECREASE. Requests that started before the last
+    decrease don't decrease it again, so a burst of errors from one overload
+    only counts once. Within one of the limit that was last throttled, the
+    increase slows by PROBE_FACTOR, so the limit settles just under the
+    highest concurrency the service sustains instead of repeatedly
+    overshooting it.
+
+    Requests that fail with an exception other than a throttling error
+    don't change the limit.
+
+    A Retry-After from the service pauses all new requests until it has
+    passed, instead of each thread sleeping on its own and then retrying
+    all at once.
+
+    Use it as:
+
+        with limiter.request() as slot:
+            ...make the request...
+            if throttled:
+                slot.throttled(retry_after)
+    """
+    # Multiplier applied to the limit when a request is throttled
+    DECREASE = 0.7
+    # How much slower the limit grows near the last throttled limit. Every
+    # probe past the service's capacity costs a Retry-After pause for all
+    # threads, so probes should be rare.
+    PROBE_FACTOR = 100
+
+    def __init__(self, max_limit, min_limit=1, initial_limit=4):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(min(max_limit, max(min_limit, initial_limit)))
+        # The number of requests allowed in flight when a request was last
+        # throttled
+        self.ceiling = None
+        self.in_flight = 0
+        # Requests don't start before this time.monotonic() value
+        self.resume_at = 0
+        # Incremented on each decrease
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    def set_max(self, max_limit):
+        with self._cond:
+            self.max_limit = max_limit
+            self.limit = min(self.limit, max_limit)
+            self._cond.notify_all()
+
+    def acquire(self):
+        """Waits for a free slot and returns it"""
+        with self._cond:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                elif self.in_flight >= max(self.min_limit, int(self.limit)):
+                    self._cond.wait()
+                else:
+                    break
+            self.in_flight += 1
+            return _LimiterSlot(self, self._epoch)
+
+    def _release(self, slot, completed=True):
+        with self._cond:
+            self.in_flight -= 1
+            if not completed:
+                # Failed some other way, which says nothing about the
+                # service's capacity
+                self._cond.notify_all()
+                return
+            if slot.was_throttled:
+                if slot.epoch == self._epoch:
+                    # Leaving the initial doubling phase, the limit may be
+                    # far past the service's capacity, so halve it
+                    decrease = 0.5 if self.ceiling is None else self.DECREASE
+                    self.ceiling = int(self.limit)
+                    self.limit = max(self.min_limit, self.limit * decrease)
+                    self._epoch += 1
+                if slot.retry_after:
+                    self.resume_at = max(self.resume_at,
+                                         time.monotonic() + slot.retry_after)
+            else:
+                if self.ceiling is None:
+                    increase = 1
+                elif self.limit + 1 >= self.ceiling:
+                    increase = 1 / (self.limit * self.PROBE_FACTOR)
+                else:
+                    increase = 1 / self.limit
+                self.limit = min(self.max_limit, self.limit + increase)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def request(self):
+        """Context manager that holds a slot for one request"""
+        slot = self.acquire()
+        try:
+            yield slot
+        except BaseException:
+            # A throttled request usually raises so it can be retried, but
+            # it still says the service is at capacity
+            self._release(slot, completed=slot.was_throttled)
+            raise
+        self._release(slot)
+
+class _LimiterSlot:
+    def __init__(self, limiter, epoch):
+        self.limiter = limiter
+        self.epoch = epoch
+        self.was_throttled = False
+        self.retry_after = None
+
+    def throttled(self, retry_after=None):
+        """Marks the request as throttled by the service"""
+        self.was_throttled = True
+        self.retry_after = retry_after
 
 
 class AtomicImmediate(Atomic):
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Measures B2 upload and download throughput against a local stand-in
+
+Usage: benchmarks/bench_b2.py [--count N] [--size BYTES]
+                              [--concurrency N ...] [--asyncio]
+                              [stand-in options]
+
+For each concurrency level, starts a fresh B2 stand-in (tests/b2stub.py) in
+a separate process, uploads COUNT objects of SIZE bytes through B2Bucket
+from that many threads, then downloads them all the same way. Reports
+objects per second in each direction and the errors the stand-in returned.
+With --asyncio, the requests are issued from an event loop through
+aiostorage.ExecutorAdapter. The adapter runs them in its own pool of that
+many threads, so this measures the overhead of the asyncio interface over
+the same blocking transport, not a different transport.
+
+The stand-in options (--latency, --bandwidth, --error-rate, etc.) are
+passed through to the stand-in. Its random failures are seeded, so runs
+with the same options are comparable.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os.path
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+import requests
+
+from backathon import aiostorage
+from backathon import b2
+from backathon.util import BytesReader
+
+STUB_OPTIONS = [
+    ("--latency", float), ("--jitter", float), ("--bandwidth", float),
+    ("--error-rate", float), ("--error-status", int),
+    ("--retry-after", int), ("--max-in-flight", int),
+    ("--token-lifetime", float), ("--seed", int),
+]
+
+def start_stub(args):
+    cmd = [sys.executable, "-m", "tests.b2stub"]
+    for option, _ in STUB_OPTIONS:
+        value = getattr(args, option[2:].replace("-", "_"))
+        if value is not None:
+            cmd.extend([option, str(value)])
+    if args.error_kinds:
+        cmd.append("--error-kinds")
+        cmd.extend(args.error_kinds)
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    auth_url = proc.stdout.readline().strip()
+    return proc, auth_url
+
+def run_threads(func, items, concurrency):
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(func, items))
+
+def run_asyncio(coro_func, items):
+    # The adapter's thread pool limits how many requests run at once
+    async def run_all():
+        await asyncio.gather(*(coro_func(item) for item in items))
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_all())
+    finally:
+        loop.close()
+
+def bench(args, concurrency, payload):
+    proc, auth_url = start_stub(args)
+    try:
+        bucket = b2.B2Bucket("account", "key", "bucket", auth_url=auth_url)
+        bucket.set_concurrency(concurrency)
+        names = ["objects/{:08d}".format(i) for i in range(args.count)]
+
+        if args.asyncio:
+            storage = aiostorage.ExecutorAdapter(bucket, concurrency)
+            start = time.perf_counter()
+            run_asyncio(lambda name: storage.upload_file(
+                name, BytesReader(payload)), names)
+            upload_time = time.perf_counter() - start
+            start = time.perf_counter()
+            run_asyncio(storage.download_buffer, names)
+            download_time = time.perf_counter() - start
+            storage.close()
+        else:
+            start = time.perf_counter()
+            run_threads(lambda name: bucket.upload_file(
+                name, BytesReader(payload)), names, concurrency)
+            upload_time = time.perf_counter() - start
+            start = time.perf_counter()
+            run_threads(bucket.download_buffer, names, concurrency)
+            download_time = time.perf_counter() - start
+
+        stats = requests.get(
+            auth_url.replace("/b2api/v1/b2_authorize_account",
+                             "/stub/stats")
+        ).json()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    return (args.count / upload_time, args.count / download_time,
+            stats['errors'])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--size", type=int, default=2**16)
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 4, 16, 64])
+    parser.add_argument("--asyncio", action="store_true")
+    for option, type_ in STUB_OPTIONS:
+        parser.add_argument(option, type=type_)
+    parser.add_argument("--error-kinds", nargs="+",
+                        choices=["api", "upload", "download"])
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size)
+
+    print("{:>11} {:>12} {:>14} {}".format(
+        "concurrency", "upload obj/s", "download obj/s", "errors"))
+    for concurrency in args.concurrency:
+        up, down, errors = bench(args, concurrency, payload)
+        print("{:>11} {:>12.0f} {:>14.0f} {}".format(
+            concurrency, up, down,
+            " ".join("{}:{}".format(k, v) for k, v in sorted(errors.items()))
+            or "-"))
+
+if __name__ == "__main__":
+    main()
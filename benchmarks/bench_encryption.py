@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Compares the throughput of the encryption classes in objects per second
+
+Usage: benchmarks/bench_encryption.py [--count N] [--sizes SIZE ...]
+
+For each payload size, encrypts and then decrypts COUNT random payloads
+with each encryption class and reports objects per second for each
+direction.
+"""
+import argparse
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import nacl.pwhash.argon2id
+import nacl.utils
+
+from backathon import encryption
+
+PASSWORD = "benchmark password"
+
+def make_encrypters():
+    # Key derivation speed isn't what's being measured here
+    for cls in [encryption.NaclSealedBox, encryption.NaclHybridBox]:
+        cls.OPSLIMIT = nacl.pwhash.argon2id.OPSLIMIT_MIN
+        cls.MEMLIMIT = nacl.pwhash.argon2id.MEMLIMIT_MIN
+
+    return [
+        ("NullEncryption", encryption.NullEncryption.init_new()),
+        ("NaclSealedBox", encryption.NaclSealedBox.init_new(PASSWORD)),
+        ("NaclHybridBox", encryption.NaclHybridBox.init_new(PASSWORD)),
+    ]
+
+def bench(encrypter, payloads):
+    key = encrypter.get_decryption_key(PASSWORD)
+
+    start = time.perf_counter()
+    cyphertexts = [encrypter.encrypt_bytes(p) for p in payloads]
+    encrypt_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for c in cyphertexts:
+        encrypter.decrypt_bytes(c, key)
+    decrypt_time = time.perf_counter() - start
+
+    overhead = len(cyphertexts[0]) - len(payloads[0])
+    return (len(payloads) / encrypt_time, len(payloads) / decrypt_time,
+            overhead)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[256, 4096, 2**20])
+    args = parser.parse_args()
+
+    encrypters = make_encrypters()
+
+    print("{:<16} {:>9} {:>14} {:>14} {:>9}".format(
+        "class", "size", "encrypt obj/s", "decrypt obj/s", "overhead"))
+    for size in args.sizes:
+        # Keep the total amount of data reasonable for large payloads
+        count = max(10, min(args.count, 2**30 // size))
+        payloads = [nacl.utils.random(size) for _ in range(count)]
+        for name, encrypter in encrypters:
+            enc, dec, overhead = bench(encrypter, payloads)
+            print("{:<16} {:>9} {:>14.0f} {:>14.0f} {:>9}".format(
+                name, size, enc, dec, overhead))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Measures Object.collect_garbage() on a large synthetic cache database
+
+Usage: benchmarks/bench_gc.py [--objects N] [--snapshots N] [--fanout N]
+                              [--changed N] [--expire FRACTION]
+                              [--db PATH] [--verify]
+
+Builds a cache database of about OBJECTS objects shaped like SNAPSHOTS
+backups of a mostly unchanged tree: a root tree of directories, each holding
+FANOUT files of one inode and one blob. Each snapshot changes CHANGED files
+in one directory, adding new inodes and blobs, a new version of that
+directory and a new root. The oldest EXPIRE fraction of snapshots is then
+deleted, and collect_garbage() is timed.
+
+The defaults build 10 million objects and 500 snapshots, which takes a while
+and a few gigabytes of disk. Pass smaller numbers for a quick run. With
+--db, the database is kept at PATH, and an existing one is reused instead of
+being built again. With --verify, the reachable objects are counted
+exactly to report how much of the garbage was collected.
+
+Only the tables collect_garbage() reads are filled in. Reference counts and
+payloads aren't.
+"""
+import argparse
+import datetime
+import hashlib
+import os.path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from backathon.main import setup
+setup()
+
+from django.db import connections
+from django.db.transaction import atomic
+
+from backathon import models
+from backathon.repository import Repository
+
+# Rows inserted per executemany() call
+BATCH_SIZE = 100000
+
+def objid(num):
+    return hashlib.sha256(num.to_bytes(8, "little")).digest()
+
+class Builder:
+    """Inserts objects and relations in batches, numbering objects in
+    order"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.next_num = 0
+        self.objects = []
+        self.relations = []
+
+    def add(self, type, children=()):
+        num = self.next_num
+        self.next_num += 1
+        self.objects.append((objid(num), type, 0))
+        self.relations.extend((objid(num), objid(c)) for c in children)
+        if len(self.objects) >= BATCH_SIZE or \
+                len(self.relations) >= BATCH_SIZE:
+            self.flush()
+        return num
+
+    def flush(self):
+        self.cursor.executemany(
+            "INSERT INTO objects (objid, type, refcount) VALUES (?, ?, ?)",
+            self.objects,
+        )
+        self.cursor.executemany(
+            "INSERT INTO object_relations (parent_id, child_id) "
+            "VALUES (?, ?)",
+            self.relations,
+        )
+        self.objects.clear()
+        self.relations.clear()
+
+def build(repo, args):
+    per_snapshot = 2 * args.changed + 2
+    base_files = max(
+        (args.objects - args.snapshots * per_snapshot) // 2, args.fanout)
+    num_dirs = max(base_files // args.fanout, 1)
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    with atomic(using=repo.db), connections[repo.db].cursor() as c:
+        b = Builder(c)
+
+        # dirs[d][f] is the current inode of file f in directory d, and
+        # dir_ids[d] the current version of directory d
+        dirs = []
+        for _ in range(num_dirs):
+            dirs.append([b.add("inode", [b.add("blob")])
+                         for _ in range(args.fanout)])
+        dir_ids = [b.add("tree", files) for files in dirs]
+
+        snapshots = []
+        for s in range(args.snapshots):
+            if s > 0:
+                d = s % num_dirs
+                for j in range(args.changed):
+                    f = (s * args.changed + j) % args.fanout
+                    dirs[d][f] = b.add("inode", [b.add("blob")])
+                dir_ids[d] = b.add("tree", dirs[d])
+            root = b.add("tree", dir_ids)
+            snapshots.append(("/data", objid(root),
+                              start + datetime.timedelta(days=s)))
+        b.flush()
+
+        c.executemany(
+            "INSERT INTO snapshots (path, root_id, date) VALUES (?, ?, ?)",
+            snapshots,
+        )
+        c.execute("ANALYZE")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--objects", type=int, default=10000000)
+    parser.add_argument("--snapshots", type=int, default=500)
+    parser.add_argument("--fanout", type=int, default=1000)
+    parser.add_argument("--changed", type=int, default=100)
+    parser.add_argument("--expire", type=float, default=0.1)
+    parser.add_argument("--db")
+    parser.add_argument("--verify", action="store_true")
+    args = parser.parse_args()
+
+    if args.db is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        dbfile = os.path.join(tmpdir.name, "cache.sqlite")
+    else:
+        dbfile = args.db
+    exists = os.path.exists(dbfile)
+    repo = Repository(dbfile)
+
+    if exists:
+        print("Using existing database {}".format(dbfile))
+    else:
+        start = time.perf_counter()
+        build(repo, args)
+        snapshots = models.Snapshot.objects.using(repo.db)
+        expire = int(snapshots.count() * args.expire)
+        snapshots.filter(
+            id__in=snapshots.order_by("date")
+            .values_list("id", flat=True)[:expire]
+        ).delete()
+        print("Built database in {:.1f}s".format(time.perf_counter() - start))
+
+    num_objects = models.Object.objects.using(repo.db).count()
+    print("{} objects, {} relations, {} snapshots".format(
+        num_objects,
+        models.ObjectRelation.objects.using(repo.db).count(),
+        models.Snapshot.objects.using(repo.db).count(),
+    ))
+
+    start = time.perf_counter()
+    collected = sum(1 for _ in models.Object.collect_garbage(repo.db))
+    elapsed = time.perf_counter() - start
+    print("Collected {} garbage objects in {:.1f}s ({:.0f} objects/s)".format(
+        collected, elapsed, num_objects / elapsed))
+
+    if args.verify:
+        with connections[repo.db].cursor() as c:
+            c.execute("SELECT COUNT(*) FROM ({})".format(
+                models.REACHABLE_QUERY))
+            reachable, = c.fetchone()
+        garbage = num_objects - reachable
+        print("{} garbage objects in total, {:.1%} collected".format(
+            garbage, collected / garbage if garbage else 1))
+
+if __name__ == "__main__":
+    main()
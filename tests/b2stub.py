@@ -0,0 +1,520 @@
+"""
+A minimal local stand-in for the Backblaze B2 API
+
+Implements just enough of the B2 API for B2Bucket to be tested without
+network access or an account. Files are kept in memory. Only one account
+and the buckets given to the constructor exist.
+
+The server can also simulate a slow or overloaded service, for testing the
+retry paths and for benchmarking concurrency settings offline:
+
+* latency: seconds added to every request, plus up to jitter seconds more
+* bandwidth: bytes per second shared by all request and response bodies
+* error_rate: fraction of requests that fail with error_status (503 or 429)
+  instead of being handled. error_kinds selects which requests can fail:
+  "api", "upload" and "download".
+* max_in_flight: requests beyond this many at once get a 429
+* token_lifetime: seconds before authorization tokens expire
+
+429 responses carry a Retry-After header of retry_after seconds. Random
+failures are drawn from a generator seeded with seed, so runs are
+repeatable.
+
+Run it as a separate process with: python -m tests.b2stub [options]
+It prints its authorization URL and serves until interrupted. GET
+/stub/stats on the server returns its call and error counts.
+"""
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+class B2Stub(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, account_id="account", application_key="key",
+                 buckets=("bucket",), port=0,
+                 latency=0, jitter=0, bandwidth=None,
+                 error_rate=0, error_status=503, error_kinds=("upload",),
+                 retry_after=1, max_in_flight=None, token_lifetime=None,
+                 seed=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.account_id = account_id
+        self.application_key = application_key
+        self.buckets = {name: uuid.uuid4().hex for name in buckets}
+        self.lock = threading.Lock()
+
+        self.tokens = {} # token -> expiration time, or None
+        self.files = {} # (bucket id, name) -> file dict
+        self.large_files = {} # file id -> {"info": dict, "parts": dict}
+
+        # Number of upcoming uploads (of files or parts) to fail with a 503
+        self.fail_uploads = 0
+
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = _Throttle(bandwidth)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_kinds = set(error_kinds)
+        self.retry_after = retry_after
+        self.max_in_flight = max_in_flight
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+
+        self.in_flight = 0
+        # Count of calls to each API, for checking transaction costs, and of
+        # each error returned
+        self.calls = {}
+        self.errors = {}
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    @property
+    def auth_url(self):
+        return self.url + "/b2api/v1/b2_authorize_account"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,),
+                                  daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def get_file(self, bucket_name, name):
+        return self.files.get((self.buckets[bucket_name], name))
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+class _Throttle:
+    """Limits the combined rate of all transfers to a number of bytes per
+    second
+
+    Transfers reserve time slots in turn, so concurrent transfers share the
+    bandwidth.
+    """
+    PIECE_SIZE = 2**16
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            start = max(time.monotonic(), self.next_free)
+            self.next_free = start + size / self.rate
+            wait = self.next_free - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+class _Error(Exception):
+    def __init__(self, status, code, message="", retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+        self.retry_after = retry_after
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one write, without waiting on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=()):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, e):
+        with self.server.lock:
+            self.server.errors[e.status] = \
+                self.server.errors.get(e.status, 0) + 1
+        headers = []
+        if e.retry_after is not None:
+            headers.append(("Retry-After", str(e.retry_after)))
+        self.send_json({"status": e.status, "code": e.code,
+                        "message": e.message}, e.status, headers)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        pieces = []
+        while length > 0:
+            piece = self.rfile.read(min(length, _Throttle.PIECE_SIZE))
+            if not piece:
+                break
+            self.server.throttle.consume(len(piece))
+            pieces.append(piece)
+            length -= len(piece)
+        return b"".join(pieces)
+
+    def write_body(self, content):
+        view = memoryview(content)
+        for i in range(0, len(view), _Throttle.PIECE_SIZE):
+            piece = view[i:i+_Throttle.PIECE_SIZE]
+            self.server.throttle.consume(len(piece))
+            self.wfile.write(piece)
+
+    def check_token(self):
+        token = self.headers.get("Authorization")
+        with self.server.lock:
+            try:
+                expires = self.server.tokens[token]
+            except KeyError:
+                valid = False
+            else:
+                valid = expires is None or time.monotonic() < expires
+        if not valid:
+            raise _Error(401, "expired_auth_token", "Authorization token "
+                                                     "expired")
+
+    def count(self, name):
+        with self.server.lock:
+            self.server.calls[name] = self.server.calls.get(name, 0) + 1
+
+    def handle_request(self, kind, handler):
+        """Runs the handler for one request, simulating latency, overload
+        and failures first"""
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            overloaded = server.max_in_flight is not None and \
+                server.in_flight > server.max_in_flight
+            inject = kind in server.error_kinds and \
+                server.random.random() < server.error_rate
+            delay = server.latency + server.random.uniform(0, server.jitter)
+        try:
+            if delay:
+                time.sleep(delay)
+            if overloaded:
+                raise _Error(429, "too_many_requests", "Too many requests",
+                             server.retry_after)
+            if inject:
+                status = server.error_status
+                raise _Error(
+                    status,
+                    "too_many_requests" if status == 429
+                    else "service_unavailable",
+                    "Injected failure",
+                    server.retry_after if status == 429 else None,
+                )
+            handler()
+        except _Error as e:
+            self.send_error_json(e)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def do_POST(self):
+        path = urllib.parse.urlparse(self.path).path
+        # Always read the body so the connection can be reused, even if the
+        # request fails
+        body = self.read_body()
+        if path.startswith("/b2api/v1/"):
+            api_name = path[len("/b2api/v1/"):]
+            self.count(api_name)
+
+            def handle():
+                handler = getattr(self, "api_" + api_name, None)
+                if handler is None:
+                    raise _Error(404, "not_found", "No such API")
+                if api_name != "b2_authorize_account":
+                    self.check_token()
+                self.send_json(handler(json.loads(body.decode("utf-8"))))
+            self.handle_request("api", handle)
+        elif path.startswith("/upload/"):
+            self.count("b2_upload_file")
+            self.handle_request("upload", lambda: self.send_json(
+                self.upload_file(path[len("/upload/"):], body)))
+        elif path.startswith("/upload_part/"):
+            self.count("b2_upload_part")
+            self.handle_request("upload", lambda: self.send_json(
+                self.upload_part(path[len("/upload_part/"):], body)))
+        else:
+            self.send_error_json(_Error(404, "not_found"))
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/stub/stats":
+            self.send_json(self.server.stats())
+        elif path.startswith("/file/"):
+            self.count("b2_download_file_by_name")
+            bucket_name, _, name = path[len("/file/"):].partition("/")
+
+            def handle():
+                self.check_token()
+                self.download_file(bucket_name, urllib.parse.unquote(name))
+            self.handle_request("download", handle)
+        else:
+            self.send_error_json(_Error(404, "not_found"))
+
+    ####################
+    # API calls
+    ####################
+
+    def api_b2_authorize_account(self, data):
+        expected = "Basic " + base64.b64encode("{}:{}".format(
+            self.server.account_id, self.server.application_key,
+        ).encode("ASCII")).decode("ASCII")
+        if self.headers.get("Authorization") != expected:
+            raise _Error(401, "unauthorized")
+        token = uuid.uuid4().hex
+        lifetime = self.server.token_lifetime
+        with self.server.lock:
+            self.server.tokens[token] = None if lifetime is None else \
+                time.monotonic() + lifetime
+        return {
+            "accountId": self.server.account_id,
+            "authorizationToken": token,
+            "apiUrl": self.server.url,
+            "downloadUrl": self.server.url,
+            "recommendedPartSize": 100 * 10**6,
+            "absoluteMinimumPartSize": 5 * 10**6,
+        }
+
+    def api_b2_list_buckets(self, data):
+        return {"buckets": [
+            {"bucketName": name, "bucketId": bucket_id,
+             "accountId": self.server.account_id}
+            for name, bucket_id in self.server.buckets.items()
+        ]}
+
+    def api_b2_get_upload_url(self, data):
+        # Upload URLs are authorized with the same token as the call that
+        # got them, so they expire along with it
+        return {"bucketId": data['bucketId'],
+                "uploadUrl": self.server.url + "/upload/" + data['bucketId'],
+                "authorizationToken": self.headers.get("Authorization")}
+
+    def api_b2_start_large_file(self, data):
+        file_id = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.large_files[file_id] = {
+                "info": {"bucketId": data['bucketId'],
+                         "fileName": data['fileName'],
+                         "contentType": data['contentType']},
+                "parts": {},
+            }
+        return {"fileId": file_id, "fileName": data['fileName'],
+                "bucketId": data['bucketId']}
+
+    def api_b2_get_upload_part_url(self, data):
+        if data['fileId'] not in self.server.large_files:
+            raise _Error(400, "bad_request", "No such large file")
+        return {"fileId": data['fileId'],
+                "uploadUrl": self.server.url + "/upload_part/" +
+                             data['fileId'],
+                "authorizationToken": self.headers.get("Authorization")}
+
+    def api_b2_finish_large_file(self, data):
+        with self.server.lock:
+            try:
+                large = self.server.large_files.pop(data['fileId'])
+            except KeyError:
+                raise _Error(400, "bad_request", "No such large file")
+        parts = large['parts']
+        if sorted(parts) != list(range(1, len(parts) + 1)) or len(parts) < 2:
+            raise _Error(400, "bad_request", "Missing or too few parts")
+        sha1s = [hashlib.sha1(parts[n]).hexdigest()
+                 for n in range(1, len(parts) + 1)]
+        if sha1s != data['partSha1Array']:
+            raise _Error(400, "bad_request", "Part sha1 mismatch")
+        content = b"".join(parts[n] for n in range(1, len(parts) + 1))
+        info = large['info']
+        return self.store(info['bucketId'], info['fileName'], content,
+                          "none", data['fileId'])
+
+    def api_b2_cancel_large_file(self, data):
+        with self.server.lock:
+            self.server.large_files.pop(data['fileId'], None)
+        return {"fileId": data['fileId']}
+
+    def api_b2_list_file_names(self, data):
+        bucket_id = data['bucketId']
+        prefix = data.get('prefix') or ""
+        start = data.get('startFileName') or ""
+        count = data.get('maxFileCount', 100)
+        with self.server.lock:
+            names = sorted(name for b, name in self.server.files
+                           if b == bucket_id and name.startswith(prefix)
+                           and name >= start)
+            next_name = names[count] if len(names) > count else None
+            return {"files": [self.server.files[bucket_id, name]['info']
+                              for name in names[:count]],
+                    "nextFileName": next_name}
+
+    def api_b2_hide_file(self, data):
+        key = (data['bucketId'], data['fileName'])
+        with self.server.lock:
+            if key not in self.server.files:
+                raise _Error(400, "no_such_file")
+            del self.server.files[key]
+        return {"fileName": data['fileName'], "action": "hide"}
+
+    ####################
+    # Uploads and downloads
+    ####################
+
+    def maybe_fail_upload(self):
+        with self.server.lock:
+            if self.server.fail_uploads > 0:
+                self.server.fail_uploads -= 1
+                fail = True
+            else:
+                fail = False
+        if fail:
+            raise _Error(503, "service_unavailable", "Injected failure")
+
+    def upload_file(self, bucket_id, content):
+        self.check_token()
+        self.maybe_fail_upload()
+        if hashlib.sha1(content).hexdigest() != \
+                self.headers['X-Bz-Content-Sha1']:
+            raise _Error(400, "bad_request", "Sha1 did not match data")
+        name = urllib.parse.unquote(self.headers['X-Bz-File-Name'])
+        return self.store(bucket_id, name, content,
+                          self.headers['X-Bz-Content-Sha1'])
+
+    def upload_part(self, file_id, content):
+        self.check_token()
+        self.maybe_fail_upload()
+        sha1 = hashlib.sha1(content).hexdigest()
+        if sha1 != self.headers['X-Bz-Content-Sha1']:
+            raise _Error(400, "bad_request", "Sha1 did not match data")
+        part_number = int(self.headers['X-Bz-Part-Number'])
+        with self.server.lock:
+            try:
+                large = self.server.large_files[file_id]
+            except KeyError:
+                raise _Error(400, "bad_request", "No such large file")
+            large['parts'][part_number] = content
+        return {"fileId": file_id, "partNumber": part_number,
+                "contentLength": len(content), "contentSha1": sha1}
+
+    def store(self, bucket_id, name, content, sha1, file_id=None):
+        info = {
+            "fileId": file_id or uuid.uuid4().hex,
+            "fileName": name,
+            "contentLength": len(content),
+            "contentSha1": sha1,
+            "contentType": "application/octet-stream",
+            "uploadTimestamp": int(time.time() * 1000),
+            "fileInfo": {},
+            "action": "upload",
+        }
+        with self.server.lock:
+            self.server.files[bucket_id, name] = {"info": info,
+                                                  "content": content}
+        return info
+
+    def download_file(self, bucket_name, name):
+        try:
+            bucket_id = self.server.buckets[bucket_name]
+            f = self.server.files[bucket_id, name]
+        except KeyError:
+            raise _Error(404, "not_found", "File not present")
+        info = f['info']
+        content = f['content']
+        # Large files have a contentSha1 of "none", as in B2
+        sha1 = info['contentSha1']
+
+        byte_range = self.headers.get("Range")
+        if byte_range is not None:
+            # Only the single "bytes=start-[end]" form is supported
+            start, _, end = byte_range[len("bytes="):].partition("-")
+            start = int(start)
+            end = len(content) - 1 if not end else \
+                min(int(end), len(content) - 1)
+            if start > end:
+                raise _Error(416, "range_not_satisfiable")
+            total = len(content)
+            content = content[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, end, total))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Content-Type", info['contentType'])
+        self.send_header("X-Bz-File-Id", info['fileId'])
+        self.send_header("X-Bz-File-Name", urllib.parse.quote(name))
+        self.send_header("X-Bz-Content-Sha1", sha1)
+        self.send_header("X-Bz-Upload-Timestamp",
+                         str(info['uploadTimestamp']))
+        self.end_headers()
+        self.write_body(content)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs a local stand-in for the B2 API")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--account-id", default="account")
+    parser.add_argument("--application-key", default="key")
+    parser.add_argument("--bucket", action="append", dest="buckets")
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--bandwidth", type=float,
+                        help="Bytes per second")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=503,
+                        choices=[429, 503])
+    parser.add_argument("--error-kinds", nargs="+", default=["upload"],
+                        choices=["api", "upload", "download"])
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-in-flight", type=int)
+    parser.add_argument("--token-lifetime", type=float)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = B2Stub(
+        account_id=args.account_id,
+        application_key=args.application_key,
+        buckets=args.buckets or ["bucket"],
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        error_kinds=args.error_kinds,
+        retry_after=args.retry_after,
+        max_in_flight=args.max_in_flight,
+        token_lifetime=args.token_lifetime,
+        seed=args.seed,
+    )
+    print(server.auth_url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever(0.05)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
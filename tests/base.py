@@ -1,7 +1,8 @@
-from contextlib import ExitStack
+from contextlib import ExitStack, contextmanager
 import tempfile
 import os.path
 import pathlib
+import unittest.mock
 
 from django.test import TestCase
 
@@ -68,3 +69,19 @@ class TestBase(TestCase):
         pathobj.write_text(contents, encoding="UTF-8")
         return pathobj
 
+    @contextmanager
+    def record_downloads(self):
+        """Records the names of files downloaded from the storage backend
+        within the block
+
+        Yields the list the names are appended to.
+        """
+        downloaded = []
+        download_buffer = self.repo.storage.download_buffer
+        def record(name, *args, **kwargs):
+            downloaded.append(name)
+            return download_buffer(name, *args, **kwargs)
+
+        with unittest.mock.patch.object(self.repo.storage, "download_buffer",
+                                        record):
+            yield downloaded
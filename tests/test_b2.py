@@ -0,0 +1,337 @@
+import concurrent.futures
+import io
+import os
+import time
+import unittest
+import unittest.mock
+
+from backathon import b2
+from backathon.util import BytesReader
+from .b2stub import B2Stub
+from . import test_restore
+
+class B2TestBase(unittest.TestCase):
+    """Runs a B2 stand-in server for each test"""
+    # Keyword arguments for the B2Stub
+    stub_options = {}
+
+    def setUp(self):
+        self.server = B2Stub(**self.stub_options)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def get_bucket(self):
+        return b2.B2Bucket("account", "key", "bucket",
+                           auth_url=self.server.auth_url)
+
+class TestB2Bucket(B2TestBase):
+    def setUp(self):
+        super().setUp()
+        self.bucket = self.get_bucket()
+
+    def test_upload_download(self):
+        self.bucket.upload_file("dir/file", BytesReader(b"contents"))
+        metadata, f = self.bucket.download_file("dir/file")
+        with f:
+            self.assertEqual(b"contents", f.read())
+        self.assertEqual("dir/file", metadata['fileName'])
+
+    def test_download_corrupt(self):
+        self.bucket.upload_file("file", BytesReader(b"contents"))
+        self.server.get_file("bucket", "file")['content'] = b"c0ntents"
+        with self.assertRaises(IOError):
+            self.bucket.download_buffer("file")
+
+    def test_download_buffer(self):
+        self.bucket.upload_file("file", BytesReader(b"contents"))
+        buf = self.bucket.download_buffer("file")
+        self.assertIsInstance(buf, bytearray)
+        self.assertEqual(b"contents", buf)
+
+    def test_download_range(self):
+        self.bucket.upload_file("file", BytesReader(b"0123456789"))
+        self.assertEqual(b"234",
+                         self.bucket.download_buffer("file", (2, 5)))
+        self.assertEqual(b"789",
+                         self.bucket.download_buffer("file", (7, None)))
+
+    def test_upload_retry(self):
+        self.server.fail_uploads = 2
+        self.bucket.upload_file("file", io.BytesIO(b"contents"))
+        self.assertEqual(3, self.server.calls['b2_upload_file'])
+        self.assertEqual(
+            b"contents",
+            self.server.get_file("bucket", "file")['content'],
+        )
+
+    def test_upload_gives_up(self):
+        self.server.fail_uploads = b2.B2Bucket.UPLOAD_TRIES
+        with self.assertRaises(b2.B2ResponseError):
+            self.bucket.upload_file("file", io.BytesIO(b"contents"))
+
+    def test_get_files_by_prefix(self):
+        for name in ["a/1", "a/2", "b/1"]:
+            self.bucket.upload_file(name, BytesReader(name.encode()))
+        self.assertEqual(
+            ["a/1", "a/2"],
+            [f['fileName'] for f in self.bucket.get_files_by_prefix("a/")]
+        )
+
+    def test_delete(self):
+        self.bucket.upload_file("file", BytesReader(b"contents"))
+        self.bucket.delete("file")
+        self.assertIsNone(self.server.get_file("bucket", "file"))
+        # Deleting a missing file is not an error
+        self.bucket.delete("file")
+
+class TestB2Concurrency(B2TestBase):
+    def test_shared_authorization(self):
+        """Threads share the authorization and reuse upload URLs"""
+        bucket = self.get_bucket()
+        bucket.set_concurrency(4)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            list(executor.map(
+                lambda i: bucket.upload_file(str(i), BytesReader(b"x")),
+                range(40),
+            ))
+        self.assertEqual(1, self.server.calls['b2_authorize_account'])
+        self.assertEqual(1, self.server.calls['b2_list_buckets'])
+        self.assertLessEqual(self.server.calls['b2_get_upload_url'], 4)
+        self.assertEqual(40, self.server.calls['b2_upload_file'])
+
+    def test_failed_url_discarded(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("a", BytesReader(b"x"))
+        self.server.fail_uploads = 1
+        bucket.upload_file("b", BytesReader(b"x"))
+        self.assertEqual(2, self.server.calls['b2_get_upload_url'])
+        self.assertEqual(1, bucket._upload_urls.discarded)
+
+    def test_expired_url_refreshed(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("a", BytesReader(b"x"))
+        with unittest.mock.patch.object(b2._UploadUrlPool, "MAX_AGE", 0):
+            bucket.upload_file("b", BytesReader(b"x"))
+        self.assertEqual(2, self.server.calls['b2_get_upload_url'])
+
+    def test_expired_auth_token(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("a", BytesReader(b"x"))
+        self.server.tokens.clear()
+        self.assertEqual(
+            ["a"],
+            [f['fileName'] for f in bucket.get_files_by_prefix("")],
+        )
+        self.assertEqual(2, self.server.calls['b2_authorize_account'])
+
+    def test_expired_auth_token_download_gives_up(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("a", BytesReader(b"x"))
+        # Every new token has already expired
+        self.server.token_lifetime = 0
+        self.server.tokens.clear()
+        with self.assertRaises(b2.B2ResponseError):
+            bucket.download_buffer("a")
+        self.assertEqual(b2.B2Bucket.DOWNLOAD_TRIES + 1,
+                         self.server.calls['b2_authorize_account'])
+
+    def test_expired_auth_token_api_gives_up(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("a", BytesReader(b"x"))
+        self.server.token_lifetime = 0
+        self.server.tokens.clear()
+        with self.assertRaises(b2.B2ResponseError):
+            list(bucket.get_files_by_prefix(""))
+        self.assertEqual(b2.B2Bucket.API_AUTH_TRIES + 1,
+                         self.server.calls['b2_authorize_account'])
+
+class TestB2StubLatency(B2TestBase):
+    stub_options = {"latency": 0.1, "bandwidth": 2**20}
+
+    def test_slow_transfers(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("file", BytesReader(b"x"))
+        start = time.monotonic()
+        bucket.download_buffer("file")
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+        contents = os.urandom(2**19)
+        start = time.monotonic()
+        bucket.upload_file("big", BytesReader(contents))
+        # Half a second at the bandwidth limit, plus the latency
+        self.assertGreaterEqual(time.monotonic() - start, 0.55)
+
+class TestB2StubTokenExpiry(B2TestBase):
+    stub_options = {"token_lifetime": 0.2}
+
+    def test_token_expires(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("a", BytesReader(b"x"))
+        time.sleep(0.3)
+        bucket.upload_file("b", BytesReader(b"x"))
+        self.assertEqual(b"x", bytes(bucket.download_buffer("b")))
+        self.assertEqual(2, self.server.calls['b2_authorize_account'])
+        self.assertIn(401, self.server.errors)
+
+class TestB2StubErrors(B2TestBase):
+    stub_options = {"error_rate": 0.5, "error_status": 429,
+                    "error_kinds": ("api",), "retry_after": 0}
+
+    def test_api_calls_retried(self):
+        bucket = self.get_bucket()
+        for i in range(5):
+            bucket.upload_file(str(i), BytesReader(b"x"))
+        self.assertEqual(
+            [str(i) for i in range(5)],
+            [f['fileName'] for f in bucket.get_files_by_prefix("")],
+        )
+        self.assertGreater(self.server.errors[429], 0)
+
+    def test_download_errors(self):
+        self.server.error_kinds = {"download"}
+        self.server.error_rate = 1
+        bucket = self.get_bucket()
+        bucket.upload_file("file", BytesReader(b"x"))
+        with self.assertRaises(IOError):
+            bucket.download_buffer("file")
+
+class TestB2BackPressure(B2TestBase):
+    stub_options = {"max_in_flight": 2, "retry_after": 0, "latency": 0.02}
+
+    def test_upload_throttled(self):
+        """Uploads rejected with 429 are retried, and the limit shrinks"""
+        bucket = self.get_bucket()
+        bucket.set_concurrency(8)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(
+                lambda i: bucket.upload_file(str(i), BytesReader(b"x")),
+                range(40),
+            ))
+        self.assertEqual(40, len(self.server.files))
+        self.assertGreater(self.server.errors[429], 0)
+        self.assertLess(bucket.limiter.limit, 8 * bucket.part_concurrency)
+
+    def test_download_retried(self):
+        bucket = self.get_bucket()
+        bucket.upload_file("file", BytesReader(b"x"))
+        self.server.error_kinds = {"download"}
+        self.server.error_status = 429
+        self.server.error_rate = 0.5
+        for _ in range(10):
+            self.assertEqual(b"x", bytes(bucket.download_buffer("file")))
+        self.assertGreater(self.server.errors[429], 0)
+
+class TestB2AuthCache(B2TestBase):
+    def setUp(self):
+        super().setUp()
+        self.cache = {}
+
+    def get_bucket(self):
+        bucket = super().get_bucket()
+        bucket.auth_loader = lambda: self.cache.get("auth")
+        bucket.on_auth = lambda data: self.cache.__setitem__("auth", data)
+        return bucket
+
+    def test_cache_reused(self):
+        self.get_bucket().upload_file("a", BytesReader(b"x"))
+        self.assertEqual(
+            self.server.buckets["bucket"],
+            self.cache["auth"]["bucket_id"],
+        )
+
+        self.get_bucket().upload_file("b", BytesReader(b"x"))
+        self.assertEqual(1, self.server.calls['b2_authorize_account'])
+        self.assertEqual(1, self.server.calls['b2_list_buckets'])
+
+    def test_cache_expired(self):
+        self.get_bucket().upload_file("a", BytesReader(b"x"))
+        self.cache["auth"]["expires"] = 0
+        self.get_bucket().upload_file("b", BytesReader(b"x"))
+        self.assertEqual(2, self.server.calls['b2_authorize_account'])
+        self.assertGreater(self.cache["auth"]["expires"], 0)
+
+    def test_cache_other_bucket(self):
+        self.get_bucket().upload_file("a", BytesReader(b"x"))
+        self.cache["auth"]["bucket_name"] = "other"
+        self.get_bucket().upload_file("b", BytesReader(b"x"))
+        self.assertEqual(2, self.server.calls['b2_authorize_account'])
+
+    def test_cached_token_expired(self):
+        """A cached token rejected by B2 is refreshed transparently"""
+        self.get_bucket().upload_file("a", BytesReader(b"x"))
+        self.server.tokens.clear()
+        _, f = self.get_bucket().download_file("a")
+        with f:
+            self.assertEqual(b"x", f.read())
+        self.assertEqual(2, self.server.calls['b2_authorize_account'])
+        self.assertIn(self.cache["auth"]["auth"]["authorization_token"],
+                      self.server.tokens)
+
+class TestB2LargeFile(B2TestBase):
+    def setUp(self):
+        super().setUp()
+        self.bucket = self.get_bucket()
+        self.bucket.LARGE_FILE_THRESHOLD = 1000
+        self.bucket.PART_SIZE = 300
+        self.contents = os.urandom(2000)
+
+    def test_large_upload(self):
+        self.bucket.upload_file("file", BytesReader(self.contents))
+        self.assertEqual(7, self.server.calls['b2_upload_part'])
+        self.assertEqual(1, self.server.calls['b2_finish_large_file'])
+        self.assertNotIn('b2_upload_file', self.server.calls)
+
+        _, f = self.bucket.download_file("file")
+        with f:
+            self.assertEqual(self.contents, f.read())
+
+    def test_part_retry(self):
+        self.server.fail_uploads = 2
+        self.bucket.upload_file("file", BytesReader(self.contents))
+        self.assertEqual(9, self.server.calls['b2_upload_part'])
+        self.assertEqual(
+            self.contents,
+            self.server.get_file("bucket", "file")['content'],
+        )
+
+    def test_cancel_on_failure(self):
+        self.server.fail_uploads = 100
+        with self.assertRaises(b2.B2ResponseError):
+            self.bucket.upload_file("file", BytesReader(self.contents))
+        self.assertEqual(1, self.server.calls['b2_cancel_large_file'])
+        self.assertEqual({}, self.server.large_files)
+        self.assertIsNone(self.server.get_file("bucket", "file"))
+
+class TestRestoreWithB2(test_restore.TestRestore):
+    """Runs the restore tests against the B2 stand-in, with large objects
+    uploaded in parts"""
+    def setUp(self):
+        super().setUp()
+        self.server = B2Stub()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.repo.set_storage("b2", {
+            "account_id": "account",
+            "application_key": "key",
+            "bucket_name": "bucket",
+            "auth_url": self.server.auth_url,
+        })
+        self.stack.enter_context(unittest.mock.patch.multiple(
+            b2.B2Bucket, LARGE_FILE_THRESHOLD=2**16, PART_SIZE=2**15,
+        ))
+
+    def test_auth_cached(self):
+        """The authorization is saved in the repository settings and used by
+        later runs"""
+        self.create_file("file", "contents")
+        self.repo.scan()
+        self.repo.backup()
+
+        # Simulates a new run
+        del self.repo.__dict__['storage']
+        ss = self.snapshot.get()
+        self.repo.restore(ss.root, self.restoredir, self.password)
+        self.assert_restored_file("file", "contents")
+
+        self.assertEqual(1, self.server.calls['b2_authorize_account'])
+        self.assertEqual(1, self.server.calls['b2_list_buckets'])
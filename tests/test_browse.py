@@ -0,0 +1,175 @@
+import argparse
+import contextlib
+import io
+import os
+import stat
+import unittest.mock
+
+from backathon import browse
+from backathon import encryption
+from backathon import keyagent
+from backathon.commands import CommandError
+from backathon.commands import browse as browse_command
+from .base import TestBase
+
+class TestBrowse(TestBase):
+    def setUp(self):
+        super().setUp()
+        self.contents = os.urandom(2**20 * 2 + 100)
+        self.create_file("dir/big", "").write_bytes(self.contents)
+        self.create_file("dir/sub/small.txt", "contents")
+        self.create_file("other.txt", "other")
+        self.repo.scan()
+        self.repo.backup()
+        self.ss = self.snapshot.get()
+
+    def test_resolve(self):
+        self.assertEqual(self.ss.root, browse.resolve(self.repo, self.ss, ""))
+        self.assertEqual(self.ss.root, browse.resolve(self.repo, self.ss, "/"))
+        obj = browse.resolve(self.repo, self.ss, "dir/sub/small.txt")
+        self.assertEqual(
+            self.fsentry.get(path=self.path("dir/sub/small.txt")).obj,
+            obj,
+        )
+
+    def test_resolve_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            browse.resolve(self.repo, self.ss, "dir/nope")
+        with self.assertRaises(NotADirectoryError):
+            browse.resolve(self.repo, self.ss, "other.txt/x")
+
+    def test_resolve_undecodable_name(self):
+        name = os.fsdecode(b"bad\xffname")
+        self.create_file("dir/" + name, "undecodable")
+        self.repo.scan()
+        self.repo.backup()
+        ss = self.snapshot.latest("date")
+
+        obj = browse.resolve(self.repo, ss, "dir/" + name)
+        out = io.BytesIO()
+        browse.cat(self.repo, obj, out)
+        self.assertEqual(b"undecodable", out.getvalue())
+
+    def test_ls(self):
+        entries = browse.ls(self.repo, browse.resolve(self.repo, self.ss,
+                                                      "dir"))
+        self.assertEqual(["big", "sub"], [e.name for e in entries])
+        self.assertEqual(["inode", "tree"], [e.obj.type for e in entries])
+        self.assertEqual(len(self.contents), entries[0].obj.file_size)
+
+        with self.assertRaises(NotADirectoryError):
+            browse.ls(self.repo, entries[0].obj)
+
+    def test_stat(self):
+        obj = browse.resolve(self.repo, self.ss, "dir/big")
+        info = browse.stat(self.repo, obj)
+        st = os.stat(self.path("dir/big"))
+        self.assertEqual("inode", info['type'])
+        self.assertEqual(st.st_mode, info['mode'])
+        self.assertEqual(st.st_size, info['size'])
+        self.assertTrue(stat.S_ISDIR(
+            browse.stat(self.repo, self.ss.root)['mode']))
+
+    def test_find(self):
+        self.assertEqual(
+            ["dir", "dir/big", "dir/sub", "dir/sub/small.txt", "other.txt"],
+            [path for path, _ in browse.find(self.repo, self.ss.root)],
+        )
+        self.assertEqual(
+            ["dir/sub/small.txt", "other.txt"],
+            [path for path, _ in browse.find(self.repo, self.ss.root,
+                                             "*.txt")],
+        )
+
+    def test_cat(self):
+        obj = browse.resolve(self.repo, self.ss, "dir/big")
+        out = io.BytesIO()
+        with self.record_downloads() as downloaded:
+            browse.cat(self.repo, obj, out)
+        self.assertEqual(self.contents, out.getvalue())
+        # Only the file's chunks are fetched
+        self.assertEqual(3, len(downloaded))
+
+        with self.assertRaises(IsADirectoryError):
+            browse.cat(self.repo, self.ss.root, out)
+
+class TestBrowseCommand(TestBase):
+    """Drives the browse command on an encrypted repository"""
+    password = "This is my password!"
+
+    def setUp(self):
+        super().setUp()
+
+        # Set the ops limit and mem limit low so the tests don't take forever
+        import nacl.pwhash.argon2id
+        self.stack.enter_context(
+            unittest.mock.patch.object(encryption.NaclSealedBox, "OPSLIMIT",
+                                       nacl.pwhash.argon2id.OPSLIMIT_MIN)
+        )
+        self.stack.enter_context(
+            unittest.mock.patch.object(encryption.NaclSealedBox, "MEMLIMIT",
+                                       nacl.pwhash.argon2id.MEMLIMIT_MIN)
+        )
+        self.repo.set_encrypter(
+            encryption.NaclSealedBox.init_new(self.password))
+
+        # No key agent holds the key, so the command asks for the password
+        self.stack.enter_context(
+            unittest.mock.patch.object(keyagent.KeyAgentClient, "get",
+                                       return_value=None)
+        )
+        self.getpass = self.stack.enter_context(
+            unittest.mock.patch("getpass.getpass", return_value=self.password)
+        )
+
+        self.contents = os.urandom(2**20 + 100)
+        self.create_file("dir/big", "").write_bytes(self.contents)
+        self.create_file("dir/sub/small.txt", "contents")
+        self.repo.scan()
+        self.repo.backup()
+        self.ss = self.snapshot.get()
+
+    def run_command(self, *args):
+        command = browse_command.Command(None)
+        command.get_repo = lambda: self.repo
+        parser = argparse.ArgumentParser()
+        command.add_arguments(parser)
+        options = parser.parse_args([str(self.ss.id)] + list(args))
+
+        out = io.TextIOWrapper(io.BytesIO(), write_through=True)
+        with contextlib.redirect_stdout(out), \
+                contextlib.redirect_stderr(io.StringIO()):
+            command.handle(options)
+        return out.buffer.getvalue()
+
+    def test_ls(self):
+        lines = self.run_command("ls", "dir").decode().splitlines()
+        self.assertEqual(["big", "sub/"], [l.split()[-1] for l in lines])
+        # Listings come from the local cache
+        self.getpass.assert_not_called()
+
+    def test_stat(self):
+        output = self.run_command("stat", "dir/big").decode()
+        self.assertIn("Type: inode", output)
+        self.assertIn("Size: {}".format(len(self.contents)), output)
+        self.getpass.assert_not_called()
+
+    def test_stat_uncached(self):
+        # As in caches from before payloads were kept locally
+        self.object.update(payload=None)
+        output = self.run_command("stat", "dir/sub/small.txt").decode()
+        self.assertIn("Size: 8", output)
+        self.getpass.assert_called_once_with()
+
+    def test_cat(self):
+        self.assertEqual(self.contents, self.run_command("cat", "dir/big"))
+
+    def test_find(self):
+        self.assertEqual(
+            b"sub\nsub/small.txt\n",
+            self.run_command("find", "dir", "--name", "s*"),
+        )
+
+    def test_missing(self):
+        with self.assertRaises(CommandError):
+            self.run_command("ls", "dir/missing")
@@ -513,3 +513,91 @@ class TestBackup(TestBase):
             self.backupdir: {name: "file contents"}
         })
 
+
+    def test_backup_file_ranges(self):
+        """Tests that a large file split into ranges and pushed in parallel
+        produces the same chunks as a file chunked serially"""
+        contents = "".join(
+            "{:08d}".format(i) for i in range(2**20 * 5 // 8 + 1000)
+        )
+
+        self.repo.backup_concurrency = 1
+        self.create_file("file1", contents)
+        self.repo.scan()
+        self.repo.backup()
+
+        self.repo.backup_concurrency = 4
+        # Two chunks per range
+        self.repo.backup_range_size = 2**21
+        self.create_file("file2", contents)
+        self.repo.scan()
+        self.repo.backup()
+
+        self.assert_backupsets(
+            {self.backupdir: {'file1': contents}},
+            {self.backupdir: {'file1': contents, 'file2': contents}},
+        )
+
+        chunklists = []
+        for name in ["file1", "file2"]:
+            entry = self.fsentry.get(path=self.path(name))
+            payload = unpack_payload(self.repo.get_object(entry.obj.objid))
+            next(payload)
+            next(payload)
+            chunklists.append(next(payload)[1])
+        self.assertEqual(6, len(chunklists[0]))
+        self.assertListEqual(chunklists[0], chunklists[1])
+
+    def test_backup_file_chunks_asyncio(self):
+        """Tests that chunks pushed from an event loop match those from
+        a file chunked serially, within the memory budget"""
+        contents = "".join(
+            "{:08d}".format(i) for i in range(2**20 * 5 // 8 + 1000)
+        )
+
+        self.repo.backup_concurrency = 1
+        self.repo.backup_memory_limit = 2**21
+        self.create_file("file1", contents)
+        self.repo.scan()
+        self.repo.backup()
+
+        self.repo.io_mode = "asyncio"
+        self.repo.backup_range_size = 2**21
+        self.addCleanup(lambda: self.repo.async_storage.close())
+        self.create_file("file2", contents)
+        self.repo.scan()
+        self.repo.backup()
+
+        self.assertEqual(0, self.repo.memory_budget.used)
+        self.assertLessEqual(self.repo.memory_budget.peak, 2**21)
+        chunklists = []
+        for name in ["file1", "file2"]:
+            entry = self.fsentry.get(path=self.path(name))
+            payload = unpack_payload(self.repo.get_object(entry.obj.objid))
+            next(payload)
+            next(payload)
+            chunklists.append(next(payload)[1])
+        self.assertEqual(6, len(chunklists[0]))
+        self.assertListEqual(chunklists[0], chunklists[1])
+
+    def test_backup_memory_budget(self):
+        """Tests that parallel range workers stay within the memory budget"""
+        contents = "".join(
+            "{:08d}".format(i) for i in range(2**20 * 6 // 8)
+        )
+        # A budget built before the limit is changed isn't used
+        self.assertEqual(2**28, self.repo.memory_budget.limit)
+        self.repo.backup_concurrency = 4
+        self.repo.backup_range_size = 2**20
+        self.repo.backup_memory_limit = 2**21
+        self.create_file("file1", contents)
+        self.repo.scan()
+        self.repo.backup()
+
+        self.assertEqual(2**21, self.repo.memory_budget.limit)
+        self.assertEqual(0, self.repo.memory_budget.used)
+        self.assertGreater(self.repo.memory_budget.peak, 0)
+        self.assertLessEqual(self.repo.memory_budget.peak, 2**21)
+        self.assert_backupsets(
+            {self.backupdir: {'file1': contents}},
+        )
@@ -0,0 +1,126 @@
+from contextlib import ExitStack
+import os.path
+import pathlib
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import nacl.pwhash.argon2id
+
+from backathon import encryption
+from backathon import keyagent
+from backathon.repository import KeyRequired
+from .base import TestBase
+
+class AgentMixin:
+    def start_agent(self):
+        tmpdir = self.stack.enter_context(tempfile.TemporaryDirectory())
+        self.sock_path = os.path.join(tmpdir, "agent", "agent.sock")
+        self.agent = keyagent.KeyAgent(self.sock_path)
+        self.stack.callback(self.agent.server_close)
+        thread = threading.Thread(target=self.agent.serve_forever,
+                                  daemon=True)
+        thread.start()
+        self.stack.callback(self.agent.shutdown)
+        self.client = keyagent.KeyAgentClient(self.sock_path)
+
+class TestKeyAgent(AgentMixin, unittest.TestCase):
+    def setUp(self):
+        self.stack = ExitStack()
+        self.addCleanup(self.stack.close)
+        self.start_agent()
+
+    def test_put_get(self):
+        self.client.put("repo", b"secret", 60)
+        self.assertEqual(b"secret", self.client.get("repo"))
+        self.assertIsNone(self.client.get("other"))
+
+    def test_forget(self):
+        self.client.put("repo", b"secret", 60)
+        self.client.forget("repo")
+        self.assertIsNone(self.client.get("repo"))
+
+    def test_expire(self):
+        self.client.put("repo", b"secret", 0)
+        self.assertIsNone(self.client.get("repo"))
+
+    def test_socket_permissions(self):
+        self.assertEqual(0o600, os.stat(self.sock_path).st_mode & 0o777)
+        self.assertEqual(
+            0o700,
+            os.stat(os.path.dirname(self.sock_path)).st_mode & 0o777
+        )
+
+    def test_run_exits_without_keys(self):
+        sock_path = self.sock_path + "-run"
+        agent = keyagent.KeyAgent(sock_path)
+        agent.run(startup_grace=0)
+        self.assertFalse(os.path.exists(sock_path))
+
+    def test_not_running(self):
+        client = keyagent.KeyAgentClient(self.sock_path + "-missing")
+        self.assertFalse(client.is_running())
+        self.assertIsNone(client.get("repo"))
+
+class TestRepositoryUnlock(AgentMixin, TestBase):
+    def setUp(self):
+        super().setUp()
+        self.start_agent()
+        self.stack.enter_context(
+            unittest.mock.patch.dict(os.environ,
+                                     {"BACKATHON_AGENT_SOCK": self.sock_path})
+        )
+
+        self.password = "This is my password!"
+        self.stack.enter_context(
+            unittest.mock.patch.object(encryption.NaclSealedBox, "OPSLIMIT",
+                                       nacl.pwhash.argon2id.OPSLIMIT_MIN)
+        )
+        self.stack.enter_context(
+            unittest.mock.patch.object(encryption.NaclSealedBox, "MEMLIMIT",
+                                       nacl.pwhash.argon2id.MEMLIMIT_MIN)
+        )
+        self.repo.set_encrypter(
+            encryption.NaclHybridBox.init_new(self.password)
+        )
+
+    def test_key_required(self):
+        with self.assertRaises(KeyRequired):
+            self.repo.get_decryption_key()
+
+    def test_restore_with_agent(self):
+        pathlib.Path(self.backupdir, "file").write_text("contents")
+        self.repo.scan()
+        self.repo.backup()
+
+        self.repo.unlock(self.password)
+
+        # Key derivation must not happen again
+        with unittest.mock.patch.object(
+                encryption.NaclSealedBox, "_get_symmetric_key",
+                side_effect=AssertionError("Key derived")):
+            restoredir = self.stack.enter_context(
+                tempfile.TemporaryDirectory()
+            )
+            ss = self.snapshot.get()
+            self.repo.restore(ss.root, restoredir)
+
+        self.assertEqual(
+            "contents",
+            pathlib.Path(restoredir, "file").read_text(),
+        )
+
+        self.repo.lock()
+        with self.assertRaises(KeyRequired):
+            self.repo.get_decryption_key()
+
+    def test_wrong_repository_key(self):
+        other = encryption.NaclHybridBox.init_new(self.password)
+        self.client.put(
+            self.repo._key_agent_name(),
+            other.export_key(other.get_decryption_key(self.password)),
+            60
+        )
+        with self.assertRaises(KeyRequired):
+            self.repo.get_decryption_key()
@@ -0,0 +1,78 @@
+import unittest.mock
+
+from backathon import manifest
+from backathon import models
+from .base import TestBase
+
+class TestManifest(TestBase):
+    def setUp(self):
+        super().setUp()
+        self.remote = models.RemoteFile.objects.using(self.db)
+        for i in range(5):
+            self.create_file("file{}".format(i), "contents{}".format(i))
+        self.repo.scan()
+        self.repo.backup()
+
+    def remote_names(self):
+        return sorted(
+            f['fileName'] for f in self.repo.storage.get_files_by_prefix("")
+        )
+
+    def test_uploads_recorded(self):
+        self.assertEqual(
+            self.remote_names(),
+            sorted(self.remote.values_list("name", flat=True)),
+        )
+        for obj in self.object.all():
+            f = self.remote.get(name=self.repo._get_path(obj.objid))
+            self.assertEqual(obj.uploaded_size, f.size)
+
+    def test_reconcile(self):
+        self.remote.filter(name__startswith="objects/").first().delete()
+        self.remote.create(name="objects/zzz/gone", size=1)
+        self.remote.filter(name__startswith="snapshots/").update(size=None)
+
+        stats, complete = manifest.reconcile(self.repo)
+        self.assertTrue(complete)
+        self.assertEqual(1, stats['added'])
+        self.assertEqual(1, stats['removed'])
+        self.assertEqual(1, stats['updated'])
+        self.assertEqual(
+            self.remote_names(),
+            sorted(self.remote.values_list("name", flat=True)),
+        )
+        self.assertFalse(self.remote.filter(size__isnull=True).exists())
+
+    def test_reconcile_resumes(self):
+        names = self.remote_names()
+        self.remote.all().delete()
+        self.remote.create(name="zzz", size=1)
+
+        with unittest.mock.patch.object(manifest, "PAGE_SIZE", 2):
+            stats, complete = manifest.reconcile(self.repo, max_pages=1)
+            self.assertFalse(complete)
+            self.assertEqual(2, self.remote.exclude(name="zzz").count())
+
+            listed = []
+            real_listing = self.repo.storage.get_files_by_prefix
+            def listing(prefix, start_name=None):
+                listed.append(start_name)
+                return real_listing(prefix, start_name)
+            with unittest.mock.patch.object(self.repo.storage,
+                                            "get_files_by_prefix", listing):
+                stats, complete = manifest.reconcile(self.repo)
+            self.assertTrue(complete)
+            self.assertEqual([names[1]], listed)
+
+        self.assertEqual(
+            names,
+            sorted(self.remote.values_list("name", flat=True)),
+        )
+        self.assertNotIn('MANIFEST_CHECKPOINT', self.repo.settings)
+
+    def test_missing_objects(self):
+        self.assertEqual([], list(manifest.missing_objects(self.repo)))
+        obj = self.object.first()
+        self.remote.filter(name=self.repo._get_path(obj.objid)).delete()
+        self.assertEqual([obj.objid],
+                         list(manifest.missing_objects(self.repo)))
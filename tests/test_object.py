@@ -1,8 +1,9 @@
 import datetime
+import os
 
 import pytz
 
-from django.db import IntegrityError
+from django.db import IntegrityError, connections
 from django.db.transaction import atomic
 from django.test import TransactionTestCase
 
@@ -209,3 +210,62 @@ class TestObject(TestBase, TransactionTestCase):
             self.assertTrue(
                 objid.startswith("obj_B") or objid == "root_B"
             )
+
+    def test_check_refcounts(self):
+        # Objects inserted directly don't have their references counted
+        self._insert_objects(
+            ("A", ["B", "C"]),
+            ("B", ["C"]),
+            ("C", []),
+        )
+        self.snapshot.create(root_id=b"A",
+                             date=datetime.datetime(2018, 1,1, tzinfo=pytz.UTC))
+
+        wrong = models.Object.check_refcounts(self.db)
+        self.assertEqual(
+            [(b"A", 0, 1), (b"B", 0, 1), (b"C", 0, 2)],
+            sorted(wrong),
+        )
+        self.assertEqual(3, models.Object.unreferenced(self.db).count())
+
+        models.Object.check_refcounts(self.db, repair=True)
+        self.assertEqual([], models.Object.check_refcounts(self.db))
+        self.assertEqual(0, models.Object.unreferenced(self.db).count())
+
+    def test_add_references(self):
+        self._insert_objects(("A", []), ("B", []))
+        models.Object.add_references(self.db, [b"A", b"B", b"A"])
+        self.assertEqual(2, self.object.get(objid=b"A").refcount)
+        self.assertEqual(1, self.object.get(objid=b"B").refcount)
+
+        models.Object.add_references(self.db, [b"A"], -1)
+        self.assertEqual(1, self.object.get(objid=b"A").refcount)
+
+        # Counts can't go negative
+        with self.assertRaises(IntegrityError):
+            models.Object.add_references(self.db, [b"B", b"B"], -1)
+
+    def test_collect_garbage_shared(self):
+        # Real object IDs, and a tree shared by many snapshots
+        N = 200
+        shared = [os.urandom(32) for _ in range(N)]
+        garbage = [os.urandom(32) for _ in range(N)]
+        self._insert_objects(
+            *[(objid, [child]) for objid, child in zip(shared, shared[1:])],
+            (shared[-1], []),
+            *[(objid, []) for objid in garbage]
+        )
+        for _ in range(20):
+            self.snapshot.create(root_id=shared[0],
+                                 date=datetime.datetime(2018, 1,1,
+                                                        tzinfo=pytz.UTC))
+
+        # The shared tree is walked once, not once per snapshot
+        with connections[self.db].cursor() as c:
+            c.execute("SELECT COUNT(*) FROM ({})".format(
+                models.REACHABLE_QUERY))
+            self.assertEqual(N, c.fetchone()[0])
+
+        collected = {bytes(g.objid) for g in
+                     models.Object.collect_garbage(self.db)}
+        self.assertEqual(set(garbage), collected)
@@ -0,0 +1,183 @@
+import datetime
+import types
+import unittest
+import unittest.mock
+
+from backathon import models
+from backathon import prune
+from .base import TestBase
+
+def make_snapshots(*dates, path="/root"):
+    return [
+        types.SimpleNamespace(id=i, path=path, date=date)
+        for i, date in enumerate(dates)
+    ]
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+class TestSelectExpired(unittest.TestCase):
+    def test_keep_last(self):
+        snapshots = make_snapshots(*(utc(2020, 1, d) for d in range(1, 6)))
+        expired = prune.select_expired(snapshots, keep_last=2)
+        self.assertEqual([0, 1, 2], [s.id for s in expired])
+
+    def test_keep_daily(self):
+        snapshots = make_snapshots(
+            utc(2020, 1, 1, 10), utc(2020, 1, 1, 20),
+            utc(2020, 1, 2, 10), utc(2020, 1, 2, 20),
+            utc(2020, 1, 3, 10),
+        )
+        expired = prune.select_expired(snapshots, keep_daily=2)
+        # The last snapshot of each of the two most recent days is kept
+        self.assertEqual([0, 1, 2], [s.id for s in expired])
+
+    def test_keep_combined(self):
+        snapshots = make_snapshots(
+            utc(2019, 11, 15), utc(2019, 12, 1), utc(2019, 12, 20),
+            utc(2020, 1, 5), utc(2020, 1, 6),
+        )
+        expired = prune.select_expired(snapshots, keep_last=1,
+                                       keep_monthly=3)
+        self.assertEqual([1, 3], [s.id for s in expired])
+
+    def test_periods_in_utc(self):
+        eastern = datetime.timezone(datetime.timedelta(hours=-5))
+        snapshots = make_snapshots(
+            # Both on January 2nd in UTC
+            datetime.datetime(2020, 1, 1, 20, tzinfo=eastern),
+            utc(2020, 1, 2, 12),
+        )
+        expired = prune.select_expired(snapshots, keep_daily=5)
+        self.assertEqual([0], [s.id for s in expired])
+
+    def test_per_path(self):
+        snapshots = make_snapshots(utc(2020, 1, 1), utc(2020, 1, 2),
+                                   path="/a")
+        snapshots += make_snapshots(utc(2019, 1, 1), path="/b")
+        snapshots[2].id = 2
+        expired = prune.select_expired(snapshots, keep_last=1)
+        self.assertEqual([0], [s.id for s in expired])
+
+    def test_no_rules(self):
+        with self.assertRaises(ValueError):
+            prune.select_expired(make_snapshots(utc(2020, 1, 1)))
+
+class TestPrune(TestBase):
+    def setUp(self):
+        super().setUp()
+        self.pending = models.PendingDelete.objects.using(self.db)
+        self.remote = models.RemoteFile.objects.using(self.db)
+
+        self.create_file("kept", "kept contents")
+        self.create_file("changed", "old contents")
+        self.repo.scan()
+        self.repo.backup()
+        self.old_objid = self.fsentry.get(path=self.path("changed")).obj_id
+
+        self.create_file("changed", "new contents")
+        self.repo.scan()
+        self.repo.backup()
+
+    def remote_names(self):
+        return sorted(
+            f['fileName'] for f in self.repo.storage.get_files_by_prefix("")
+        )
+
+    def test_prune(self):
+        old = self.snapshot.earliest("date")
+        old_name = old.name
+        self.assertIn(old_name, self.remote_names())
+
+        stats = self.repo.prune(prune.select_expired(self.snapshot.all(),
+                                                     keep_last=1))
+        self.assertEqual(1, stats['snapshots'])
+        self.assertEqual(0, stats['failed'])
+        self.assertEqual(1, self.snapshot.count())
+
+        # The old snapshot, the old file's inode and blob, and the old root
+        # tree are gone
+        self.assertEqual(4, stats['objects'] + stats['snapshots'])
+        self.assertEqual(4, stats['files'])
+        self.assertFalse(self.object.filter(objid=self.old_objid).exists())
+        self.assertNotIn(old_name, self.remote_names())
+        self.assertNotIn(self.repo._get_path(self.old_objid),
+                         self.remote_names())
+
+        # Everything left is still referenced and in the manifest
+        self.assertEqual(
+            self.remote_names(),
+            sorted(self.remote.values_list("name", flat=True)),
+        )
+        self.assertEqual(0, self.pending.count())
+        self.assertEqual([], list(models.Object.collect_garbage(self.db)))
+        self.assertEqual([], models.Object.check_refcounts(self.db))
+
+    def test_refcounts(self):
+        self.assertEqual([], models.Object.check_refcounts(self.db))
+        self.assertEqual(0, models.Object.unreferenced(self.db).count())
+        # Referenced by both snapshots' root trees
+        kept = self.fsentry.get(path=self.path("kept")).obj
+        self.assertEqual(2, kept.refcount)
+
+        self.repo.prune(prune.select_expired(self.snapshot.all(),
+                                             keep_last=1))
+        kept.refresh_from_db()
+        self.assertEqual(1, kept.refcount)
+        self.assertEqual([], models.Object.check_refcounts(self.db))
+
+    def test_full(self):
+        # An object left unreferenced by a count that's gone wrong is still
+        # found by the full sweep
+        self.object.filter(objid=self.old_objid).update(refcount=5)
+        self.repo.prune(prune.select_expired(self.snapshot.all(),
+                                                     keep_last=1))
+        self.assertTrue(self.object.filter(objid=self.old_objid).exists())
+
+        self.repo.prune([], full=True)
+        self.assertFalse(self.object.filter(objid=self.old_objid).exists())
+        self.assertEqual([], list(models.Object.collect_garbage(self.db)))
+
+    def test_full_keeps_live_objects(self):
+        # A reachable object whose count has wrongly dropped to zero isn't
+        # deleted by a full prune
+        kept = self.fsentry.get(path=self.path("kept")).obj
+        self.object.filter(objid=kept.objid).update(refcount=0)
+        self.repo.prune([], full=True)
+        kept.refresh_from_db()
+        self.assertEqual(2, kept.refcount)
+        self.assertEqual([], models.Object.check_refcounts(self.db))
+
+    def test_failed_delete_retried(self):
+        delete = self.repo.storage.delete
+        def fail_objects(name):
+            if name.startswith("objects/"):
+                raise IOError("Simulated failure")
+            delete(name)
+
+        with unittest.mock.patch.object(self.repo.storage, "delete",
+                                        fail_objects):
+            stats = self.repo.prune(prune.select_expired(
+                self.snapshot.all(), keep_last=1))
+        self.assertEqual(1, stats['files'])
+        self.assertEqual(3, self.pending.count())
+        # The rows are gone even though the files aren't
+        self.assertFalse(self.object.filter(objid=self.old_objid).exists())
+        self.assertIn(self.repo._get_path(self.old_objid),
+                      self.remote_names())
+
+        stats = self.repo.prune([])
+        self.assertEqual(3, stats['files'])
+        self.assertEqual(0, self.pending.count())
+        self.assertNotIn(self.repo._get_path(self.old_objid),
+                         self.remote_names())
+
+    def test_already_deleted(self):
+        name = self.repo._get_path(self.old_objid)
+        self.repo.storage.delete(name)
+        self.pending.create(name=name)
+
+        stats = self.repo.prune([])
+        self.assertEqual(0, stats['failed'])
+        self.assertFalse(self.pending.filter(name=name).exists())
+        self.assertFalse(self.remote.filter(name=name).exists())
@@ -1,3 +1,5 @@
+import contextlib
+import io
 import tempfile
 import pathlib
 import logging
@@ -5,10 +7,15 @@ import stat
 import os
 import unittest.mock
 import hashlib
+import inspect
+import sys
 
 from django.db import connections
+from django.test.utils import CaptureQueriesContext
 
+from backathon import browse
 from backathon import models
+from backathon.restore import unpack_payload, count_shared_blobs
 from .base import TestBase
 
 class AssertionHandler(logging.Handler):
@@ -261,6 +268,23 @@ class TestRestore(TestBase):
             h2.hexdigest()
         )
 
+    def test_restore_sparse_file(self):
+        """Zero chunks are restored as holes without being fetched"""
+        chunk = 2**20
+        contents = os.urandom(chunk) + bytes(chunk * 4) + os.urandom(1000)
+        self.create_file("sparse", "").write_bytes(contents)
+        self.repo.scan()
+        self.repo.backup()
+
+        with self.record_downloads() as downloaded:
+            self.repo.restore(self.snapshot.get().root, self.restoredir,
+                              self.password)
+
+        restored = pathlib.Path(self.restoredir, "sparse")
+        self.assertEqual(contents, restored.read_bytes())
+        self.assertLessEqual(len(downloaded), 2)
+        self.assertLess(restored.stat().st_blocks * 512, chunk * 3)
+
 class TestRestoreWithCompression(TestRestore):
     def setUp(self):
         super().setUp()
@@ -315,4 +339,463 @@ class TestRestoreWithEncryption(TestRestore):
 
 class TestRestoreEncryptionAndCompression(TestRestoreWithCompression,
                                           TestRestoreWithEncryption):
-    pass
\ No newline at end of file
+    pass
+
+class TestRestoreWithHybridEncryption(TestRestoreWithEncryption):
+    def setUp(self):
+        super().setUp()
+
+        from backathon import encryption
+        encrypter = encryption.NaclHybridBox.init_new(self.password)
+        self.repo.set_encrypter(encrypter)
+
+    def test_session_key_saved(self):
+        """Tests that the sealed session key is saved locally and in the
+        repository, and that a key missing from the local settings is loaded
+        from the repository"""
+        self.create_file("file", "contents")
+        self.repo.scan()
+        self.repo.backup()
+
+        encrypter = self.repo.encrypter
+        self.assertEqual(1, len(encrypter.session_keys))
+        keyid, sealed = next(iter(encrypter.session_keys.items()))
+        self.assertEqual(
+            sealed,
+            pathlib.Path(self.datadir, "keys", keyid.hex()).read_bytes(),
+        )
+        self.assertIn(
+            keyid.hex(),
+            self.repo.settings['ENCRYPTION_SETTINGS']['settings'][
+                'session_keys'],
+        )
+
+        encrypter.session_keys.clear()
+        ss = self.snapshot.get()
+        self.repo.restore(ss.root, self.restoredir, self.password)
+        self.assert_restored_file("file", "contents")
+
+class TestRestoreWithFastWrites(TestRestore):
+    def setUp(self):
+        super().setUp()
+        self.repo.set_storage("local", {"base_dir": self.datadir,
+                                        "fast_writes": True})
+        self.addCleanup(self.repo.storage.close)
+
+    def test_no_temp_files(self):
+        for i in range(5):
+            self.create_file("file{}".format(i), "contents{}".format(i))
+        self.repo.scan()
+        self.repo.backup()
+
+        objects = list(pathlib.Path(self.datadir, "objects").glob("*/*"))
+        self.assertEqual(self.object.count(), len(objects))
+        for path in objects:
+            self.assertFalse(path.name.startswith("."))
+        self.assertEqual(0, self.repo.storage._pending)
+
+class TestRestoreWithMmap(TestRestore):
+    """Runs the restore tests with every object read through a memory map"""
+    def setUp(self):
+        super().setUp()
+        from backathon import storage
+        self.stack.enter_context(
+            unittest.mock.patch.object(storage.FilesystemStorage,
+                                       "MMAP_THRESHOLD", 1)
+        )
+
+    def test_object_is_mapped(self):
+        import mmap
+        self.create_file("file", "contents")
+        self.repo.scan()
+        self.repo.backup()
+        root = self.snapshot.get().root
+        buf = self.repo.storage.download_buffer(
+            self.repo._get_path(root.objid))
+        self.assertIsInstance(buf, mmap.mmap)
+
+class TestRestoreHybridEncryptionWithMmap(TestRestoreWithMmap,
+                                          TestRestoreWithHybridEncryption):
+    pass
+
+class TestRestoreSerial(TestRestore):
+    """Runs the restore tests with objects fetched one at a time"""
+    def setUp(self):
+        super().setUp()
+        self.repo.restore_concurrency = 1
+
+class TestRestoreEngine(TestBase):
+    def setUp(self):
+        super().setUp()
+        self.restoredir = self.stack.enter_context(
+            tempfile.TemporaryDirectory()
+        )
+
+    def test_read_only_dir(self):
+        """A directory's mode is set after its contents are restored"""
+        self.create_file("dir/file", "contents")
+        pathlib.Path(self.backupdir, "dir").chmod(0o500)
+        self.addCleanup(pathlib.Path(self.backupdir, "dir").chmod, 0o700)
+        self.repo.scan()
+        self.repo.backup()
+
+        self.repo.restore(self.snapshot.get().root, self.restoredir)
+        restored = pathlib.Path(self.restoredir, "dir")
+        self.addCleanup(restored.chmod, 0o700)
+        self.assertEqual("contents", (restored / "file").read_text())
+        self.assertEqual(0o500, stat.S_IMODE(restored.stat().st_mode))
+
+    def test_missing_chunk(self):
+        """A chunk that can't be fetched is logged, and the rest of the file
+        and tree are still restored"""
+        contents = os.urandom(2**20 * 3)
+        self.create_file("big", "").write_bytes(contents)
+        self.create_file("small", "contents")
+        self.repo.scan()
+        self.repo.backup()
+
+        root = self.snapshot.get().root
+        inode = self.fsentry.get(path=self.path("big")).obj
+        payload = list(unpack_payload(self.repo.get_object(inode.objid)))
+        chunks = payload[2][1]
+        self.assertEqual(3, len(chunks))
+        self.repo.storage.delete(self.repo._get_path(chunks[1][1]))
+
+        with self.assertLogs("backathon.restore", "ERROR") as logs:
+            self.repo.restore(root, self.restoredir)
+        self.assertEqual(1, len(logs.records))
+        self.assertIn("Could not restore chunk", logs.output[0])
+        self.assertEqual(
+            "contents",
+            pathlib.Path(self.restoredir, "small").read_text(),
+        )
+        self.assertEqual(
+            len(contents),
+            pathlib.Path(self.restoredir, "big").stat().st_size,
+        )
+
+class TestPayloadCache(TestBase):
+    """Tests that tree and inode payloads are kept in the local cache"""
+    def setUp(self):
+        super().setUp()
+        self.restoredir = self.stack.enter_context(
+            tempfile.TemporaryDirectory()
+        )
+        self.create_file("file1", "contents1")
+        self.create_file("dir/file2", "contents2")
+        self.repo.scan()
+        self.repo.backup()
+
+    def test_payloads_cached(self):
+        objects = models.Object.objects.using(self.repo.db)
+        self.assertFalse(objects.filter(type="blob", payload__isnull=False))
+        for obj in objects.exclude(type="blob"):
+            self.assertIsNotNone(obj.payload)
+            buf = self.repo.storage.download_buffer(
+                self.repo._get_path(obj.objid))
+            self.assertEqual(
+                self.repo._decode_object(buf, obj.objid, None),
+                self.repo.get_object(obj.objid),
+            )
+
+    def test_restore_downloads_only_blobs(self):
+        with self.record_downloads() as downloaded:
+            self.repo.restore(self.snapshot.get().root, self.restoredir)
+
+        blobs = {
+            self.repo._get_path(objid) for objid in
+            models.Object.objects.using(self.repo.db).filter(type="blob")
+            .values_list("objid", flat=True)
+        }
+        self.assertEqual(2, len(downloaded))
+        self.assertLessEqual(set(downloaded), blobs)
+        self.assertEqual(
+            "contents2",
+            pathlib.Path(self.restoredir, "dir/file2").read_text(),
+        )
+
+    def test_inline_contents_not_cached(self):
+        """Inline file contents are left out of the cached inode payloads,
+        and downloaded when restoring"""
+        self.repo.backup_inline_threshold = 2**20
+        self.create_file("small", "x")
+        contents = os.urandom(500000)
+        self.create_file("large", "").write_bytes(contents)
+        self.repo.scan()
+        self.repo.backup()
+
+        sizes = []
+        for name in ["small", "large"]:
+            obj = self.fsentry.get(path=self.path(name)).obj
+            sizes.append(len(obj.payload))
+            info = browse.stat(self.repo, obj)
+            self.assertEqual(obj.file_size, info['size'])
+        self.assertLess(abs(sizes[0] - sizes[1]), 16)
+
+        self.repo.restore(self.snapshot.latest("date").root, self.restoredir)
+        self.assertEqual(
+            contents,
+            pathlib.Path(self.restoredir, "large").read_bytes(),
+        )
+
+    def test_restore_uncached(self):
+        """Objects pushed before payloads were cached are downloaded"""
+        models.Object.objects.using(self.repo.db).update(payload=None)
+        self.repo.restore(self.snapshot.get().root, self.restoredir)
+        self.assertEqual(
+            "contents2",
+            pathlib.Path(self.restoredir, "dir/file2").read_text(),
+        )
+
+class TestSharedBlobs(TestBase):
+    """Tests that blobs used several times in a restore are fetched once"""
+    def setUp(self):
+        super().setUp()
+        self.restoredir = self.stack.enter_context(
+            tempfile.TemporaryDirectory()
+        )
+        self.contents = os.urandom(2**20 * 3)
+        self.create_file("a", "").write_bytes(self.contents)
+        self.create_file("dir/b", "").write_bytes(self.contents)
+        self.create_file("c", "").write_bytes(os.urandom(2**20 * 3))
+        self.repo.scan()
+        self.repo.backup()
+        self.root = self.snapshot.get().root
+
+    def restore(self, **kwargs):
+        with self.record_downloads() as downloaded:
+            self.repo.restore(self.root, self.restoredir, **kwargs)
+
+        for path in ["a", "dir/b"]:
+            self.assertEqual(
+                self.contents,
+                pathlib.Path(self.restoredir, path).read_bytes(),
+            )
+        return downloaded
+
+    def test_count_shared_blobs(self):
+        counts = count_shared_blobs(self.repo, self.root)
+        self.assertEqual([2, 2, 2], list(counts.values()))
+
+    def test_fetched_once(self):
+        self.assertEqual(6, len(self.restore()))
+
+    def test_fetched_once_serial(self):
+        self.repo.restore_concurrency = 1
+        self.assertEqual(6, len(self.restore()))
+
+    def test_fetched_once_compare(self):
+        """Blobs fetched for a file being compared are kept for their next
+        use"""
+        # Every chunk of the existing file differs
+        pathlib.Path(self.restoredir, "a").write_bytes(
+            os.urandom(len(self.contents)))
+        self.assertEqual(6, len(self.restore(incremental=True,
+                                             compare_chunks=True)))
+
+    def test_fetched_once_compare_serial(self):
+        self.repo.restore_concurrency = 1
+        self.test_fetched_once_compare()
+
+    def test_fetched_once_compare_asyncio(self):
+        self.repo.io_mode = "asyncio"
+        self.addCleanup(lambda: self.repo.async_storage.close())
+        self.test_fetched_once_compare()
+
+    def test_cache_full(self):
+        """Blobs dropped from a full cache are fetched again"""
+        self.repo.restore_concurrency = 1
+        self.repo.restore_cache_size = 0
+        self.assertEqual(9, len(self.restore()))
+
+class TestIncrementalRestore(TestBase):
+    """Tests restoring over a destination that already has some of the
+    files"""
+    def setUp(self):
+        super().setUp()
+        self.restoredir = self.stack.enter_context(
+            tempfile.TemporaryDirectory()
+        )
+        self.contents = os.urandom(2**20 * 3)
+        self.create_file("big", "").write_bytes(self.contents)
+        self.create_file("dir/small", "contents")
+        self.repo.scan()
+        self.repo.backup()
+        self.root = self.snapshot.get().root
+        self.repo.restore(self.root, self.restoredir)
+        self.big = pathlib.Path(self.restoredir, "big")
+
+    def restore(self, **kwargs):
+        with self.record_downloads() as downloaded:
+            self.repo.restore(self.root, self.restoredir, incremental=True,
+                              **kwargs)
+
+        self.assertEqual(self.contents, self.big.read_bytes())
+        self.assertEqual(
+            "contents",
+            pathlib.Path(self.restoredir, "dir/small").read_text(),
+        )
+        return downloaded
+
+    def test_unchanged(self):
+        self.assertEqual([], self.restore())
+
+    def test_changed_file_rewritten(self):
+        with self.big.open("r+b") as f:
+            f.seek(2**20 + 10)
+            f.write(b"x")
+        self.assertEqual(3, len(self.restore()))
+
+    def test_compare_chunks(self):
+        with self.big.open("r+b") as f:
+            f.seek(2**20 + 10)
+            f.write(b"x")
+        self.assertEqual(1, len(self.restore(compare_chunks=True)))
+
+    def test_compare_truncated(self):
+        """An interrupted restore only fetches the missing chunks"""
+        with self.big.open("r+b") as f:
+            f.truncate(2**20)
+        self.assertEqual(2, len(self.restore(compare_chunks=True)))
+
+    def test_compare_extended(self):
+        with self.big.open("ab") as f:
+            f.write(b"extra")
+        self.assertEqual([], self.restore(compare_chunks=True))
+
+    def test_properties_restored(self):
+        self.big.chmod(0o604)
+        self.assertEqual([], self.restore())
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.path("big")).st_mode),
+            stat.S_IMODE(self.big.stat().st_mode),
+        )
+
+class TestIncrementalRestoreSerial(TestIncrementalRestore):
+    def setUp(self):
+        super().setUp()
+        self.repo.restore_concurrency = 1
+
+class TestIncrementalRestoreWithAsyncio(TestIncrementalRestore):
+    def setUp(self):
+        super().setUp()
+        self.repo.io_mode = "asyncio"
+        self.addCleanup(lambda: self.repo.async_storage.close())
+
+class TestRestoreWalk(TestBase):
+    """Tests walking large and deep trees"""
+    def setUp(self):
+        super().setUp()
+        self.restoredir = self.stack.enter_context(
+            tempfile.TemporaryDirectory()
+        )
+
+    def test_entries_batched(self):
+        """Directory entries are looked up in batches, not one query
+        each"""
+        for i in range(510):
+            self.create_file("dir/file{}".format(i), str(i))
+        self.repo.scan()
+        self.repo.backup()
+
+        with CaptureQueriesContext(connections[self.repo.db]) as queries:
+            self.repo.restore(self.snapshot.get().root, self.restoredir)
+        self.assertLess(len(queries), 20)
+        for i in (0, 509):
+            self.assertEqual(str(i), pathlib.Path(
+                self.restoredir, "dir/file{}".format(i)).read_text())
+
+    def test_deep_tree(self):
+        """The walk doesn't recurse for each level of the tree"""
+        depth = 300
+        self.create_file("/".join(["d"] * depth) + "/file", "contents")
+        self.repo.scan()
+        self.repo.backup()
+
+        # Leave room for the restore's own calls, but not one per level
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(len(inspect.stack()) + 150)
+        try:
+            self.repo.restore(self.snapshot.get().root, self.restoredir)
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual("contents", pathlib.Path(
+            self.restoredir, *["d"] * depth, "file").read_text())
+
+class TestRestoreWalkSerial(TestRestoreWalk):
+    def setUp(self):
+        super().setUp()
+        self.repo.restore_concurrency = 1
+
+class TestRestoreWithAsyncio(TestRestore):
+    """Runs the restore tests with the chunks of large files pushed and
+    fetched through the asyncio storage interface"""
+    def setUp(self):
+        super().setUp()
+        self.repo.io_mode = "asyncio"
+        self.repo.async_max_in_flight = 8
+        self.repo.backup_range_size = 2**21
+        self.addCleanup(lambda: self.repo.async_storage.close())
+
+    def test_chunks_in_order(self):
+        contents = os.urandom(2**20 * 5 + 1000)
+        infile = self.create_file("file", "")
+        infile.write_bytes(contents)
+        self.repo.scan()
+        self.repo.backup()
+        ss = self.snapshot.get()
+        self.repo.restore(ss.root, self.restoredir, self.password)
+        self.assertEqual(
+            contents,
+            pathlib.Path(self.restoredir, "file").read_bytes(),
+        )
+
+class TestRestoreWithBlake2b(TestRestore):
+    def setUp(self):
+        super().setUp()
+        self.repo.set_objid_hash("blake2b")
+
+class TestObjidHashConversion(TestBase):
+    def test_convert_objid_hash(self):
+        """Tests that converting a repository to a new objid hash re-pushes
+        the backup set, and old snapshots can still be restored"""
+        self.create_file("file", "contents")
+        self.repo.scan()
+        self.repo.backup()
+        self.assertEqual(3, self.object.count())
+
+        self.repo.set_objid_hash("blake2b")
+        self.assertEqual(
+            0,
+            self.fsentry.filter(obj__isnull=False).count()
+        )
+        self.repo.backup()
+
+        # The old objects are still there, plus new copies of everything
+        self.assertEqual(6, self.object.count())
+
+        with tempfile.TemporaryDirectory() as restoredir:
+            for ss in self.snapshot.order_by("date"):
+                path = pathlib.Path(restoredir, str(ss.id))
+                self.repo.restore(ss.root, path, None)
+                self.assertEqual("contents", (path / "file").read_text())
+
+    def test_init_keeps_existing_hash(self):
+        """Tests that re-running init on a repository from before the objid
+        hash setting existed doesn't convert it"""
+        from backathon.commands import init
+        self.create_file("file", "contents")
+        self.repo.scan()
+        self.repo.backup()
+        objs = dict(self.fsentry.values_list("path", "obj_id"))
+        self.assertNotIn("OBJID_HASH", self.repo.settings)
+
+        with unittest.mock.patch.object(init.repository, "Repository",
+                                        return_value=self.repo), \
+                contextlib.redirect_stdout(io.StringIO()):
+            init.Command(None).handle(None)
+
+        self.assertEqual("sha256", self.repo.settings['OBJID_HASH'])
+        self.assertEqual("sha256", self.repo.objid_hash)
+        self.assertEqual(objs,
+                         dict(self.fsentry.values_list("path", "obj_id")))
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from backathon import aiostorage
+from backathon import storage
+from backathon.util import BytesReader
+
+class TestFilesystemStorage(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.storage = storage.FilesystemStorage(tmpdir.name)
+        self.contents = os.urandom(2**17)
+        self.storage.upload_file("dir/file", BytesReader(self.contents))
+
+    def test_download_range(self):
+        for threshold in (1, 2**30):
+            with unittest.mock.patch.object(self.storage, "MMAP_THRESHOLD",
+                                            threshold):
+                self.assertEqual(
+                    self.contents[100:2**16],
+                    bytes(self.storage.download_buffer("dir/file",
+                                                       (100, 2**16))),
+                )
+                self.assertEqual(
+                    self.contents[5:],
+                    bytes(self.storage.download_buffer("dir/file",
+                                                       (5, None))),
+                )
+
+    def test_listing_order(self):
+        for name in ["a", "dir/sub/x", "dir-2", "dir0", "dir/b"]:
+            self.storage.upload_file(name, BytesReader(b"x"))
+        self.assertEqual(
+            ["dir-2", "dir/b", "dir/file", "dir/sub/x", "dir0"],
+            [f['fileName'] for f in self.storage.get_files_by_prefix("dir")],
+        )
+        self.assertEqual(
+            ["dir/file", "dir/sub/x"],
+            [f['fileName'] for f in self.storage.get_files_by_prefix(
+                "dir/", start_name="dir/c")],
+        )
+        self.assertEqual(
+            ["dir/sub/x", "dir0"],
+            [f['fileName'] for f in self.storage.get_files_by_prefix(
+                "", start_name="dir/sub/x")],
+        )
+
+class TestFilesystemStorageFastWrites(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.base_dir = tmpdir.name
+        self.storage = storage.FilesystemStorage(self.base_dir,
+                                                 fast_writes=True)
+        self.addCleanup(self.storage.close)
+
+    def test_auto_flush(self):
+        with unittest.mock.patch.object(self.storage, "MAX_PENDING", 2), \
+                unittest.mock.patch("os.fsync") as fsync:
+            self.storage.upload_file("a/1", BytesReader(b"1"))
+            # Only the file. Its rename is pending.
+            self.assertEqual(1, fsync.call_count)
+            self.storage.upload_file("a/2", BytesReader(b"2"))
+            # The second file, then the directory for both renames
+            self.assertEqual(3, fsync.call_count)
+        with open(os.path.join(self.base_dir, "a", "2"), "rb") as f:
+            self.assertEqual(b"2", f.read())
+
+class TestExecutorAdapter(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.storage = aiostorage.ExecutorAdapter(
+            storage.FilesystemStorage(tmpdir.name), max_in_flight=8,
+        )
+        self.addCleanup(self.storage.close)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_concurrent_upload_download(self):
+        names = ["dir/{:03d}".format(i) for i in range(100)]
+
+        async def upload_download():
+            await asyncio.gather(*(
+                self.storage.upload_file(name, BytesReader(name.encode()))
+                for name in names
+            ))
+            return await asyncio.gather(*(
+                self.storage.download_buffer(name) for name in names
+            ))
+
+        contents = self.run_coro(upload_download())
+        self.assertEqual([name.encode() for name in names],
+                         [bytes(c) for c in contents])
+        self.assertEqual(
+            b"01",
+            bytes(self.run_coro(
+                self.storage.download_buffer("dir/001", (5, 7)))),
+        )
+
+    def test_list_files(self):
+        for i in range(5):
+            self.run_coro(self.storage.upload_file(
+                "dir/{}".format(i), BytesReader(b"x")))
+        page = self.run_coro(self.storage.list_files("dir/", max_count=3))
+        self.assertEqual(["dir/0", "dir/1", "dir/2"],
+                         [f['fileName'] for f in page])
+        page = self.run_coro(self.storage.list_files("dir/", "dir/3"))
+        self.assertEqual(["dir/3", "dir/4"], [f['fileName'] for f in page])
+
+    def test_delete(self):
+        self.run_coro(self.storage.upload_file("file", BytesReader(b"x")))
+        self.run_coro(self.storage.delete("file"))
+        self.assertEqual([], self.run_coro(self.storage.list_files("")))
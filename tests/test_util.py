@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+
+from backathon import util
+
+class TestConcurrencyLimiter(unittest.TestCase):
+    def test_slow_start(self):
+        limiter = util.ConcurrencyLimiter(64)
+        self.assertEqual(4, limiter.limit)
+        for _ in range(4):
+            with limiter.request():
+                pass
+        self.assertEqual(8, limiter.limit)
+
+    def test_additive_increase(self):
+        limiter = util.ConcurrencyLimiter(8)
+        limiter.ceiling = 100
+        limiter.limit = 2.0
+        for _ in range(4):
+            with limiter.request():
+                pass
+        self.assertGreater(limiter.limit, 3)
+        self.assertLess(limiter.limit, 4)
+        for _ in range(100):
+            with limiter.request():
+                pass
+        self.assertEqual(8, limiter.limit)
+
+    def test_probe_slowly(self):
+        limiter = util.ConcurrencyLimiter(64)
+        limiter.ceiling = 10
+        limiter.limit = 9.0
+        for _ in range(10):
+            with limiter.request():
+                pass
+        self.assertLess(limiter.limit, 9.02)
+
+    def test_decrease_once_per_overload(self):
+        limiter = util.ConcurrencyLimiter(8)
+        slots = [limiter.acquire() for _ in range(4)]
+        for slot in slots:
+            slot.throttled()
+            limiter._release(slot)
+        # Only the first throttled request of the batch counts, and the
+        # first decrease halves the limit
+        self.assertEqual(2, limiter.limit)
+        self.assertEqual(4, limiter.ceiling)
+
+        with limiter.request() as slot:
+            slot.throttled()
+        self.assertAlmostEqual(2 * limiter.DECREASE, limiter.limit)
+
+    def test_min_limit(self):
+        limiter = util.ConcurrencyLimiter(8, min_limit=2)
+        for _ in range(5):
+            with limiter.request() as slot:
+                slot.throttled()
+        self.assertEqual(2, limiter.limit)
+
+    def test_limits_in_flight(self):
+        limiter = util.ConcurrencyLimiter(2)
+        first = limiter.acquire()
+        limiter.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (limiter.acquire(), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter._release(first)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_retry_after_pauses_all(self):
+        limiter = util.ConcurrencyLimiter(8)
+        with limiter.request() as slot:
+            slot.throttled(0.2)
+        start = time.monotonic()
+        with limiter.request():
+            pass
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_exception_leaves_limit(self):
+        limiter = util.ConcurrencyLimiter(8)
+        limiter.limit = 4.0
+        with self.assertRaises(ValueError):
+            with limiter.request():
+                raise ValueError()
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_throttled_exception_decreases_limit(self):
+        # Requests that time out are marked throttled and then raise so
+        # they can be retried
+        limiter = util.ConcurrencyLimiter(8)
+        limiter.limit = 8.0
+        with self.assertRaises(ConnectionError):
+            with limiter.request() as slot:
+                slot.throttled()
+                raise ConnectionError()
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)